@@ -34,11 +34,14 @@ from __future__ import print_function
 
 import collections
 import copy
+import hashlib
+import json
 import os
 import subprocess
-import time
 import traceback
 
+from concurrent import futures
+
 from absl import app
 from absl import flags
 from absl import logging
@@ -48,6 +51,7 @@ import jsonschema
 from deploy.rule_generator import rule_generator
 from deploy.utils import field_generation
 from deploy.utils import forseti
+from deploy.utils import instrumentation
 from deploy.utils import runner
 from deploy.utils import utils
 
@@ -75,6 +79,26 @@ flags.DEFINE_string('apply_binary', None,
 flags.DEFINE_string('rule_generator_binary', None,
                     ('Path to rule generator binary. '
                      'Set automatically by the Bazel rule.'))
+flags.DEFINE_integer('max_concurrent_steps', 1,
+                     ('Maximum number of independent steps of a single project '
+                      'to run at the same time.'))
+flags.DEFINE_integer('max_concurrent_projects', 1,
+                     ('Maximum number of projects to deploy at the same time. '
+                      'The audit logs and Forseti projects are always '
+                      'deployed first, one at a time.'))
+flags.DEFINE_boolean('incremental', False,
+                     ('Skip updating deployed projects whose config has not '
+                      'changed since their last successful deployment.'))
+flags.DEFINE_boolean('disable_unlisted_apis', False,
+                     ('Disable APIs enabled in a project but not wanted by its '
+                      'config. APIs enabled by default in new projects or '
+                      'needed by the deployment or the project\'s resources, '
+                      'and APIs other enabled APIs depend on, are kept. The '
+                      'APIs of the Forseti project are never disabled.'))
+flags.DEFINE_boolean('plan', False,
+                     ('Only log the steps that would be run for each project '
+                      'and an estimate of the number of commands they would '
+                      'run, without deploying anything.'))
 
 # Name of the Log Sink created in the data_project deployment manager template.
 _LOG_SINK_NAME = 'audit-logs-to-bigquery'
@@ -82,9 +106,66 @@ _LOG_SINK_NAME = 'audit-logs-to-bigquery'
 # Roles to temporarily grant the deployment manager service account to function.
 _DEPLOYMENT_MANAGER_ROLES = ['roles/owner', 'roles/storage.admin']
 
+# Name of the deployment of the data_project.py template in each data project.
+_DATA_PROJECT_DEPLOYMENT_NAME = 'data-project-deployment'
+
 # IAM binding changes can take some time to propagate to child resources, so
-# wait to give it enough time.
+# wait to give it enough time. The policy shows changes before they are
+# enforced, and the roles of the DM service account cannot be probed, so this
+# is a minimum wait after the bindings show in the policy.
 _IAM_PROPAGATAION_WAIT_TIME_SECS = 60
+# Maximum time to wait for IAM binding changes to show in the policy and
+# propagate.
+_IAM_PROPAGATION_MAX_WAIT_TIME_SECS = 120
+
+# Maximum number of services enabled by a single command (the limit of the
+# Service Usage API).
+_MAX_SERVICES_PER_ENABLE = 20
+
+# Services never disabled by --disable_unlisted_apis: those enabled by default
+# in new projects, and those the deployment steps and templates rely on
+# without listing them in the config (e.g. Stackdriver alerts and log sinks).
+_KEPT_SERVICES = frozenset([
+    'bigquery-json.googleapis.com',
+    'bigquery.googleapis.com',
+    'bigquerystorage.googleapis.com',
+    'cloudapis.googleapis.com',
+    'clouddebugger.googleapis.com',
+    'cloudresourcemanager.googleapis.com',
+    'cloudtrace.googleapis.com',
+    'datastore.googleapis.com',
+    'deploymentmanager.googleapis.com',
+    'iam.googleapis.com',
+    'iamcredentials.googleapis.com',
+    'logging.googleapis.com',
+    'monitoring.googleapis.com',
+    'servicemanagement.googleapis.com',
+    'serviceusage.googleapis.com',
+    'sql-component.googleapis.com',
+    'stackdriver.googleapis.com',
+    'storage-api.googleapis.com',
+    'storage-component.googleapis.com',
+    'storage.googleapis.com',
+])
+
+# Services used by the resources under these keys of a project's config, and
+# so never disabled by --disable_unlisted_apis, even if not listed.
+_PROJECT_RESOURCE_SERVICES = {
+    'gce_firewall_rules': 'compute.googleapis.com',
+    'gce_instances': 'compute.googleapis.com',
+    'pubsub': 'pubsub.googleapis.com',
+}
+# Services used by the resources under these keys of a project's resources.
+_RESOURCE_SERVICES = {
+    'chc_datasets': 'healthcare.googleapis.com',
+    'gce_firewalls': 'compute.googleapis.com',
+    'gce_instances': 'compute.googleapis.com',
+    'gke_clusters': 'container.googleapis.com',
+    'gke_workloads': 'container.googleapis.com',
+    'iam_custom_roles': 'iam.googleapis.com',
+    'pubsubs': 'pubsub.googleapis.com',
+    'vpc_networks': 'compute.googleapis.com',
+}
 
 # Restriction for project lien.
 _LIEN_RESTRICTION = 'resourcemanager.projects.delete'
@@ -102,17 +183,27 @@ ProjectConfig = collections.namedtuple(
         'audit_logs_project',
         # Extra steps to perform for this project.
         'extra_steps',
+        # Deep copy of the configs the project is deployed from, taken before
+        # any step changes them (see snapshot_config), or None.
+        'original',
     ])
+# The original config is optional.
+ProjectConfig.__new__.__defaults__ = (None,)
 
 Step = collections.namedtuple(
     'Step',
     [
+        # Unique ID of this step within a project's steps.
+        'id',
         # Function that implements this step.
         'func',
         # Description of the step.
         'description',
         # Whether this step should be run when updating a project.
         'updatable',
+        # IDs of the earlier steps that must complete before this step can run,
+        # or None if this step depends on all earlier steps.
+        'depends_on',
     ])
 
 
@@ -133,9 +224,11 @@ def create_new_project(config):
     logging.info('Deploying without a parent organization or folder.')
   # Create the new project.
   runner.run_gcloud_command(create_project_command, project_id=None)
-  generated_fields = field_generation.get_generated_fields_ref(
-      project_id, config.root)
-  generated_fields['project_number'] = utils.get_project_number(project_id)
+  project_number = utils.get_project_number(project_id)
+  with field_generation.GENERATED_FIELDS_LOCK:
+    generated_fields = field_generation.get_generated_fields_ref(
+        project_id, config.root)
+    generated_fields['project_number'] = project_number
 
 
 def setup_billing(config):
@@ -158,11 +251,10 @@ def enable_services_apis(config):
   because deployment-management does not have all the APIs' access, which might
   triger PERMISSION_DENIED errors.
 
+  Only services which are not enabled yet are enabled.
+
   Args:
     config (ProjectConfig): The config of a single project to setup.
-
-  Returns:
-    List[string]: commands to remove APIs not found in the enabled set.
   """
   project_id = config.project['project_id']
 
@@ -180,12 +272,62 @@ def enable_services_apis(config):
   if 'gke_clusters' in resources:
     want_apis.add('container.googleapis.com')
 
-  want_apis = list(want_apis)
+  enabled_apis = utils.get_enabled_services(project_id)
+  missing_apis = sorted(want_apis - enabled_apis)
+  if not missing_apis:
+    logging.info('All %d wanted APIs are already enabled.', len(want_apis))
+  else:
+    logging.info('Enabling %d APIs: %s', len(missing_apis),
+                 ', '.join(missing_apis))
+    batches = [
+        missing_apis[i:i + _MAX_SERVICES_PER_ENABLE]
+        for i in range(0, len(missing_apis), _MAX_SERVICES_PER_ENABLE)
+    ]
+    # Each command waits for its operation, so wait for them concurrently.
+    with futures.ThreadPoolExecutor(max_workers=len(batches)) as executor:
+      list(
+          executor.map(
+              lambda batch: runner.run_gcloud_command(
+                  ['services', 'enable'] + batch, project_id=project_id),
+              batches))
+
+  if FLAGS.disable_unlisted_apis:
+    _disable_unlisted_apis(config, enabled_apis, want_apis)
+
+
+def _disable_unlisted_apis(config, enabled_apis, want_apis):
+  """Disables the enabled services that a project does not use.
 
-  # Send in batches to avoid hitting quota limits.
-  for i in range(0, len(want_apis), 10):
-    runner.run_gcloud_command(
-        ['services', 'enable'] + want_apis[i:i + 10], project_id=project_id)
+  The services of the Forseti project are never disabled, as the Forseti
+  installer enables the services it needs without listing them in the config.
+
+  Args:
+    config (ProjectConfig): The config of a single project to setup.
+    enabled_apis (Set[string]): The services enabled in the project.
+    want_apis (Set[string]): The services enabled for the project's config.
+  """
+  project_id = config.project['project_id']
+  forseti_project = config.root.get('forseti', {}).get('project', {})
+  if project_id == forseti_project.get('project_id'):
+    logging.info('Keeping all enabled APIs of the Forseti project.')
+    return
+
+  kept_apis = want_apis | _KEPT_SERVICES
+  resources = config.project.get('resources', {})
+  for key, api in _PROJECT_RESOURCE_SERVICES.items():
+    if config.project.get(key):
+      kept_apis.add(api)
+  for key, api in _RESOURCE_SERVICES.items():
+    if resources.get(key):
+      kept_apis.add(api)
+
+  for api in sorted(enabled_apis - kept_apis):
+    try:
+      runner.run_gcloud_command(['services', 'disable', api],
+                                project_id=project_id)
+    except subprocess.CalledProcessError as e:
+      # Services other enabled services depend on cannot be disabled.
+      logging.warning('Failed to disable %s, keeping it: %s', api, e)
 
 
 def grant_deployment_manager_access(config):
@@ -194,20 +336,39 @@ def grant_deployment_manager_access(config):
     logging.info('DM service account will be granted access through CFT.')
     return
 
+  # The roles are only needed to update the data project deployment, and
+  # would be revoked right after it.
+  if _is_data_project_deployment_unchanged(config):
+    logging.info('Data project deployment is unchanged, not granting the DM '
+                 'service account its roles.')
+    return
+
   project_id = config.project['project_id']
 
   # Grant deployment manager service account (temporary) owners access.
   dm_service_account = utils.get_deployment_manager_service_account(project_id)
-  for role in _DEPLOYMENT_MANAGER_ROLES:
-    runner.run_gcloud_command([
-        'projects', 'add-iam-policy-binding', project_id, '--member',
-        dm_service_account, '--role', role
-    ],
-                              project_id=None)
+  bindings = {role: [dm_service_account] for role in _DEPLOYMENT_MANAGER_ROLES}
+  if utils.project_has_iam_bindings(project_id, bindings):
+    logging.info('DM service account already has its roles.')
+    return
+
+  if FLAGS.batch_iam_policy_updates:
+    utils.update_project_iam_bindings(project_id, add_bindings=bindings)
+  else:
+    for role in _DEPLOYMENT_MANAGER_ROLES:
+      runner.run_gcloud_command([
+          'projects', 'add-iam-policy-binding', project_id, '--member',
+          dm_service_account, '--role', role
+      ],
+                                project_id=None)
 
-  logging.info('Sleeping for %d seconds to let IAM updates propagate.',
-               _IAM_PROPAGATAION_WAIT_TIME_SECS)
-  runner.run(time.sleep, _IAM_PROPAGATAION_WAIT_TIME_SECS)
+  if not utils.wait_for_project_iam_bindings(
+      project_id,
+      bindings,
+      _IAM_PROPAGATION_MAX_WAIT_TIME_SECS,
+      min_wait_secs=_IAM_PROPAGATAION_WAIT_TIME_SECS):
+    logging.warning('IAM bindings of %s did not propagate within %d seconds.',
+                    project_id, _IAM_PROPAGATION_MAX_WAIT_TIME_SECS)
 
 
 def deploy_gcs_audit_logs(config):
@@ -253,10 +414,7 @@ def deploy_gcs_audit_logs(config):
 
 def _is_service_enabled(service_name, project_id):
   """Check if the service_name is already enabled."""
-  enabled_services = runner.run_gcloud_command(
-      ['services', 'list', '--format', 'value(NAME)'], project_id=project_id)
-  services_list = enabled_services.strip().split('\n')
-  return service_name in services_list
+  return service_name in utils.get_enabled_services(project_id)
 
 
 def get_data_bucket_name(data_bucket, project_id):
@@ -273,16 +431,18 @@ def get_data_bucket_name(data_bucket, project_id):
     return data_bucket['name']
 
 
-def deploy_project_resources(config):
-  """Deploys resources into the new data project."""
-  if FLAGS.enable_new_style_resources:
-    logging.info('Project resources will be deployed through CFT.')
-    return
+def _get_data_project_deployment(config):
+  """Gets the deployment of the data_project.py template for a project.
+
+  Args:
+    config (ProjectConfig): The config of a single project to setup.
 
+  Returns:
+    dict: The dictionary representation of the deployment manager YAML config.
+  """
   setup_account = utils.get_gcloud_user()
   has_organization = bool(config.root['overall'].get('organization_id'))
   project_id = config.project['project_id']
-  dm_service_account = utils.get_deployment_manager_service_account(project_id)
 
   # Build a deployment config for the data_project.py deployment manager
   # template.
@@ -314,7 +474,7 @@ def deploy_project_resources(config):
     data_bucket.pop('name_suffix', '')
 
   path = os.path.join(os.path.dirname(__file__), 'templates/data_project.py')
-  dm_template_dict = {
+  return {
       'imports': [{
           'path': path
       }],
@@ -325,6 +485,41 @@ def deploy_project_resources(config):
       }]
   }
 
+
+def _is_data_project_deployment_unchanged(config):
+  """Checks whether an update would leave the data project deployment as is.
+
+  Only checked with --diff_deployments, which skips unchanged deployments.
+
+  Args:
+    config (ProjectConfig): The config of a single project to setup.
+
+  Returns:
+    bool: True if the deployment is skipped as unchanged.
+  """
+  if not FLAGS.diff_deployments:
+    return False
+  return utils.is_deployment_unchanged(
+      _get_data_project_deployment(config), _DATA_PROJECT_DEPLOYMENT_NAME,
+      config.project['project_id'])
+
+
+def deploy_project_resources(config):
+  """Deploys resources into the new data project."""
+  if FLAGS.enable_new_style_resources:
+    logging.info('Project resources will be deployed through CFT.')
+    return
+
+  # The DM service account was not granted its roles, so there is nothing to
+  # revoke either.
+  if _is_data_project_deployment_unchanged(config):
+    logging.info('Data project deployment is unchanged, skipping it.')
+    return
+
+  project_id = config.project['project_id']
+  dm_service_account = utils.get_deployment_manager_service_account(project_id)
+  dm_template_dict = _get_data_project_deployment(config)
+
   # API iam.googleapis.com is necessary when using custom roles
   iam_api_disable = False
   if not _is_service_enabled('iam.googleapis.com', project_id):
@@ -333,15 +528,22 @@ def deploy_project_resources(config):
     iam_api_disable = True
   try:
     # Create the deployment.
-    utils.run_deployment(dm_template_dict, 'data-project-deployment',
+    utils.run_deployment(dm_template_dict, _DATA_PROJECT_DEPLOYMENT_NAME,
                          project_id)
 
-    for role in _DEPLOYMENT_MANAGER_ROLES:
-      runner.run_gcloud_command([
-          'projects', 'remove-iam-policy-binding', project_id, '--member',
-          dm_service_account, '--role', role
-      ],
-                                project_id=None)
+    if FLAGS.batch_iam_policy_updates:
+      utils.update_project_iam_bindings(
+          project_id,
+          remove_bindings={
+              role: [dm_service_account] for role in _DEPLOYMENT_MANAGER_ROLES
+          })
+    else:
+      for role in _DEPLOYMENT_MANAGER_ROLES:
+        runner.run_gcloud_command([
+            'projects', 'remove-iam-policy-binding', project_id, '--member',
+            dm_service_account, '--role', role
+        ],
+                                  project_id=None)
 
   finally:
     # Disable iam.googleapis.com if it is enabled in this function
@@ -442,8 +644,9 @@ def create_compute_images(config):
   Args:
     config (ProjectConfig): config of the project.
   """
-  gce_instances = config.project.get('gce_instances', [])
-  gce_instances.extend(
+  # Build a new list, so the config is unchanged.
+  gce_instances = (
+      config.project.get('gce_instances', []) +
       config.project.get('resources', {}).get('gce_instances', []))
   if not gce_instances:
     logging.info('No GCS Images required.')
@@ -551,6 +754,7 @@ def create_compute_vms(config):
     # due to vm running
     logging.info(('Potential failure due to updating a running vm. '
                   'Retrying with vm shutdown.'))
+    instrumentation.record_retry('create_compute_vms')
 
     vm_names_to_shutdown = [
         instance['name']
@@ -576,9 +780,9 @@ def create_stackdriver_account(config):
 
   message = """
   ------------------------------------------------------------------------------
-  To create email alerts, this project needs a Stackdriver account.
+  To create email alerts, project {0} needs a Stackdriver account.
   Create a new Stackdriver account for this project by visiting:
-      https://console.cloud.google.com/monitoring?project={}
+      https://console.cloud.google.com/monitoring?project={0}
 
   Only add this project, and skip steps for adding additional GCP or AWS
   projects. You don't need to install Stackdriver Agents.
@@ -591,11 +795,13 @@ def create_stackdriver_account(config):
   creation of Stackdriver alerts.
   ------------------------------------------------------------------------------
   """.format(project_id)
-  print(message)
+  prompt = 'Stackdriver account created for {} [y/N]?'.format(project_id)
 
   # Keep trying until Stackdriver account is ready, or user skips.
   while True:
-    if not utils.wait_for_yes_no('Account created [y/N]?'):
+    # Print the instructions with the prompt, so that they are not interleaved
+    # with those of other projects deployed concurrently.
+    if not utils.wait_for_yes_no(prompt, message=message):
       logging.warning('Skipping creation of Stackdriver Account.')
       break
 
@@ -700,100 +906,242 @@ def create_alerts(config):
 def add_project_generated_fields(config):
   """Adds a generated_fields block to a project definition."""
   project_id = config.project['project_id']
-  generated_fields = field_generation.get_generated_fields_ref(
+  generated_fields = field_generation.get_generated_fields_copy(
       project_id, config.root)
 
+  new_fields = {}
   if 'log_sink_service_account' not in generated_fields:
-    generated_fields[
-        'log_sink_service_account'] = utils.get_log_sink_service_account(
-            _LOG_SINK_NAME, project_id)
+    new_fields['log_sink_service_account'] = utils.get_log_sink_service_account(
+        _LOG_SINK_NAME, project_id)
 
   gce_instance_info = utils.get_gce_instance_info(project_id)
   if gce_instance_info:
-    generated_fields['gce_instance_info'] = gce_instance_info
+    new_fields['gce_instance_info'] = gce_instance_info
+
+  with field_generation.GENERATED_FIELDS_LOCK:
+    field_generation.get_generated_fields_ref(
+        project_id, config.root).update(new_fields)
 
 
 # The steps to set up a project, so the script can be resumed part way through
-# on error. Each func takes a config dictionary.
+# on error. Each func takes a config dictionary. Steps are listed in an order
+# consistent with their dependencies.
 _SETUP_STEPS = [
     Step(
+        id='create_project',
         func=create_new_project,
         description='Create project',
         updatable=False,
+        depends_on=[],
     ),
     Step(
+        id='setup_billing',
         func=setup_billing,
         description='Set up billing',
         updatable=False,
+        depends_on=['create_project'],
     ),
     Step(
+        id='enable_apis',
         func=enable_services_apis,
         description='Enable APIs',
         updatable=True,
+        depends_on=['setup_billing'],
     ),
     Step(
+        id='grant_deployment_manager_access',
         func=grant_deployment_manager_access,
         description='Enable deployment manager',
         updatable=True,
+        depends_on=['enable_apis'],
     ),
     Step(
+        id='deploy_gcs_audit_logs',
         func=deploy_gcs_audit_logs,
         description='Deploy GCS audit logs',
         updatable=False,
+        depends_on=['create_project'],
     ),
     Step(
+        id='deploy_project_resources',
         func=deploy_project_resources,
         description='Deploy project resources',
         updatable=True,
+        depends_on=['grant_deployment_manager_access', 'deploy_gcs_audit_logs'],
     ),
     Step(
+        id='deploy_bigquery_audit_logs',
         func=deploy_bigquery_audit_logs,
         description='Deploy BigQuery audit logs',
         updatable=False,
+        depends_on=['deploy_project_resources'],
     ),
     Step(
+        id='create_compute_images',
         func=create_compute_images,
         description='Deploy compute images',
         updatable=True,
+        depends_on=['enable_apis'],
     ),
     Step(
+        id='create_compute_vms',
         func=create_compute_vms,
         description='Deploy GCE VMs',
         updatable=True,
+        depends_on=['create_compute_images', 'deploy_project_resources'],
     ),
     Step(
+        id='create_deletion_lien',
         func=create_deletion_lien,
         description='Create deletion lien',
         updatable=True,
+        depends_on=['enable_apis'],
     ),
     Step(
+        id='deploy_new_style_resources',
         func=deploy_new_style_resources,
         description='Deploy new style resources',
         updatable=True,
+        depends_on=['grant_deployment_manager_access', 'create_compute_images'],
     ),
     Step(
+        id='create_stackdriver_account',
         func=create_stackdriver_account,
         description='Create Stackdriver account',
         updatable=True,
+        depends_on=['enable_apis'],
     ),
     Step(
+        id='create_alerts',
         func=create_alerts,
         description='Create Stackdriver alerts',
         updatable=True,
+        depends_on=['create_stackdriver_account', 'deploy_project_resources',
+                    'deploy_new_style_resources'],
     ),
     Step(
+        id='add_project_generated_fields',
         func=add_project_generated_fields,
         description='Generate project fields',
         updatable=True,
+        depends_on=['deploy_bigquery_audit_logs', 'create_compute_vms',
+                    'deploy_new_style_resources'],
     ),
 ]
 
 
+def _get_step_prerequisites(steps):
+  """Gets the IDs of the steps each step depends on.
+
+  Args:
+    steps (List[Step]): The steps of a project, in execution order.
+
+  Returns:
+    dict: a map from step ID to the set of IDs of its prerequisite steps.
+
+  Raises:
+    ValueError: if step IDs are not unique or a step depends on a step that
+      does not come before it.
+  """
+  prerequisites = {}
+  for step in steps:
+    if step.id in prerequisites:
+      raise ValueError('Duplicate step ID: {}'.format(step.id))
+    if step.depends_on is None:
+      prerequisites[step.id] = set(prerequisites)
+      continue
+    unknown = set(step.depends_on) - set(prerequisites)
+    if unknown:
+      raise ValueError('Step {} depends on unknown or later steps: {}'.format(
+          step.id, sorted(unknown)))
+    prerequisites[step.id] = set(step.depends_on)
+  return prerequisites
+
+
+def _get_completed_steps(generated_fields, steps):
+  """Gets the IDs of the steps completed by a previous failed deployment."""
+  if 'completed_steps' in generated_fields:
+    return set(generated_fields['completed_steps'])
+  # Deployments from older versions only recorded the failed step number, and
+  # all steps before it were completed.
+  failed_step = generated_fields.get('failed_step', 1)
+  return set(step.id for step in steps[:failed_step - 1])
+
+
+def snapshot_config(config):
+  """Deep copies the configs a project is deployed from.
+
+  Steps may change the config they are given, so the snapshot must be taken
+  before any step runs.
+
+  Args:
+    config (ProjectConfig): The config of a single project.
+
+  Returns:
+    ProjectConfig: The config, with a deep copy of the overall, project and
+      audit logs project configs as its original config.
+  """
+  return config._replace(original=copy.deepcopy({
+      'overall': config.root.get('overall'),
+      'project': config.project,
+      'audit_logs_project': config.audit_logs_project,
+  }))
+
+
+def get_config_hash(config):
+  """Gets a hash of the effective config a project is deployed from.
+
+  Args:
+    config (ProjectConfig): The config of a single project.
+
+  Returns:
+    str: The hex digest of the project's original config (or current config,
+      if no snapshot was taken) and the config it uses from other projects.
+  """
+  inputs = dict(config.original or snapshot_config(config).original)
+  inputs.update({
+      'forseti': field_generation.get_forseti_service_generated_fields(
+          config.root),
+      'enable_new_style_resources': FLAGS.enable_new_style_resources,
+  })
+  contents = json.dumps(inputs, sort_keys=True, default=str)
+  return hashlib.sha256(contents.encode()).hexdigest()
+
+
+def _get_steps_to_run(config, steps):
+  """Gets how a project would be deployed and the steps that would be run.
+
+  Args:
+    config (ProjectConfig): The config of a single project.
+    steps (List[Step]): The steps of the project, in execution order.
+
+  Returns:
+    (str, List[Step]): The kind of deployment, one of 'create', 'resume',
+      'update' or 'unchanged', and the steps to run, in execution order.
+  """
+  project_id = config.project['project_id']
+  generated_fields = field_generation.get_generated_fields_copy(
+      project_id, config.root)
+  if not field_generation.is_deployed(project_id, config.root):
+    completed_steps = _get_completed_steps(generated_fields, steps)
+    action = 'resume' if completed_steps else 'create'
+    return action, [step for step in steps if step.id not in completed_steps]
+
+  if (FLAGS.incremental and
+      generated_fields.get('config_hash') == get_config_hash(config)):
+    return 'unchanged', []
+  return 'update', [step for step in steps if step.updatable]
+
+
 def setup_project(config, project_yaml, output_yaml_path):
   """Run the full process for initalizing a single new project.
 
+  Steps whose prerequisites have completed are run concurrently, up to
+  --max_concurrent_steps at a time.
+
   Note: for projects that have already been deployed, only the updatable steps
-  will be run.
+  will be run, and with --incremental, none if the project's config is
+  unchanged since its last successful deployment.
 
   Args:
     config (ProjectConfig): The config of a single project to setup.
@@ -805,61 +1153,192 @@ def setup_project(config, project_yaml, output_yaml_path):
   """
   project_id = config.project['project_id']
   steps = _SETUP_STEPS + config.extra_steps
+  prerequisites = _get_step_prerequisites(steps)
+  step_nums = {step.id: step_num for step_num, step in enumerate(steps, 1)}
 
-  starting_step = field_generation.get_generated_fields_copy(
-      project_id, config.root).get('failed_step', 1)
+  action, steps_to_run = _get_steps_to_run(config, steps)
+  if action == 'unchanged':
+    logging.info('%s: config unchanged since last deployment, skipping.',
+                 project_id)
+    return True
 
-  deployed = field_generation.is_deployed(project_id, config.root)
+  # Steps which are not run count as completed for their dependents.
+  completed_steps = set(step.id for step in steps) - set(
+      step.id for step in steps_to_run)
+  deployed = action == 'update'
 
   total_steps = len(steps)
-  for step_num in range(starting_step, total_steps + 1):
-    step = steps[step_num - 1]
-    project_id = config.project['project_id']
+  max_workers = max(FLAGS.max_concurrent_steps, 1)
+
+  def run_step(step):
+    """Runs a step, returning the exception it raised, if any."""
+    step_num = step_nums[step.id]
     logging.info('%s: step %d/%d (%s)', project_id, step_num, total_steps,
                  step.description)
 
-    if deployed and not step.updatable:
-      logging.info('Step %d is not updatable, skipping', step_num)
-      continue
-
     try:
-      step.func(config)
+      with instrumentation.span('step', step.id, project_id):
+        step.func(config)
     except Exception as e:  # pylint: disable=broad-except
       traceback.print_exc()
       logging.error('%s: setup failed on step %s: %s', project_id, step_num, e)
-      logging.error(
-          'Failure information has been written to --output_yaml_path. '
-          'Please ensure the config at --project_yaml is updated with any '
-          'changes from the config at --output_yaml_path and re-run the script'
-          '(Note: only applicable if --output_yaml_path != --project_yaml)')
+      return e
+    return None
+
+  pending_steps = list(steps_to_run)
+  failed_step_nums = []
+  with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    running = {}
+    while pending_steps or running:
+      # Stop starting new steps once a step has failed.
+      if not failed_step_nums:
+        for step in list(pending_steps):
+          if len(running) >= max_workers:
+            break
+          if prerequisites[step.id] <= completed_steps:
+            pending_steps.remove(step)
+            running[executor.submit(run_step, step)] = step
+      if not running:
+        break
+
+      done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+      for future in done:
+        step = running.pop(future)
+        if future.result() is not None:
+          failed_step_nums.append(step_nums[step.id])
+          continue
+        completed_steps.add(step.id)
+        # Cheaply journal the step's changes, they are written to the output
+        # YAML once the project is done.
+        field_generation.record_generated_fields(project_id, output_yaml_path,
+                                                 config.root)
 
-      # only record failed step if project was undeployed, an update can always
-      # start from the beginning
+  if failed_step_nums:
+    logging.error(
+        'Failure information has been written to --output_yaml_path. '
+        'Please ensure the config at --project_yaml is updated with any '
+        'changes from the config at --output_yaml_path and re-run the script'
+        '(Note: only applicable if --output_yaml_path != --project_yaml)')
+
+    # only record failed step if project was undeployed, an update can always
+    # start from the beginning
+    with field_generation.GENERATED_FIELDS_LOCK:
       if not deployed:
+        generated_fields = field_generation.get_generated_fields_ref(
+            project_id, config.root)
+        generated_fields['failed_step'] = min(failed_step_nums)
+        generated_fields['completed_steps'] = [
+            step.id for step in steps if step.id in completed_steps
+        ]
+      else:
+        # The failed update must be retried even if the config is unchanged.
         field_generation.get_generated_fields_ref(
-            project_id, config.root)['failed_step'] = step_num
-        field_generation.rewrite_generated_fields_back(project_yaml,
-                                                       output_yaml_path,
-                                                       config.root)
-
-      return False
+            project_id, config.root).pop('config_hash', None)
+      field_generation.compact_generated_fields(
+          project_yaml, output_yaml_path, config.root, project_id=project_id)
 
-    field_generation.rewrite_generated_fields_back(project_yaml,
-                                                   output_yaml_path,
-                                                   config.root)
+    return False
 
   # if this deployment was resuming from a previous failure, remove the
-  # failed step as it is done
-  if field_generation.is_generated_fields_exist(project_id, config.root):
-    field_generation.get_generated_fields_ref(project_id, config.root,
-                                              False).pop('failed_step', None)
-  field_generation.rewrite_generated_fields_back(project_yaml, output_yaml_path,
-                                                 config.root)
+  # failure information as it is done
+  with field_generation.GENERATED_FIELDS_LOCK:
+    if field_generation.is_generated_fields_exist(project_id, config.root):
+      generated_fields = field_generation.get_generated_fields_ref(
+          project_id, config.root, False)
+      generated_fields.pop('failed_step', None)
+      generated_fields.pop('completed_steps', None)
+      generated_fields['config_hash'] = get_config_hash(config)
+  field_generation.compact_generated_fields(
+      project_yaml, output_yaml_path, config.root, project_id=project_id)
   logging.info('Setup completed successfully.')
 
   return True
 
 
+def deploy_projects(projects, project_yaml, output_yaml_path, max_workers):
+  """Deploys independent projects concurrently.
+
+  A failure in one project does not stop the deployment of the others.
+
+  Args:
+    projects (List[ProjectConfig]): The configs of the projects to deploy. The
+      projects must not depend on each other.
+    project_yaml (str): Path of the project config YAML.
+    output_yaml_path (str): Path to output resulting root config in JSON.
+    max_workers (int): Maximum number of projects to deploy at the same time.
+
+  Returns:
+    List[str]: IDs of the projects that failed to deploy, in the given order.
+  """
+
+  def deploy(config):
+    project_id = config.project['project_id']
+    logging.info('Setting up project %s', project_id)
+    try:
+      with instrumentation.span('project', project_id, project_id):
+        return setup_project(config, project_yaml, output_yaml_path)
+    except Exception as e:  # pylint: disable=broad-except
+      traceback.print_exc()
+      logging.error('%s: setup failed: %s', project_id, e)
+      return False
+
+  with futures.ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+    results = list(executor.map(deploy, projects))
+
+  return [
+      config.project['project_id']
+      for config, ok in zip(projects, results)
+      if not ok
+  ]
+
+
+def plan_projects(projects):
+  """Logs the steps that would be run to deploy the given projects.
+
+  The steps are run in a dry run against a copy of the config to estimate the
+  number of commands each project would run.
+
+  Args:
+    projects (List[ProjectConfig]): The configs of the projects to plan, in
+      deployment order.
+
+  Returns:
+    dict: a map from project ID to the kind of deployment, the IDs of the steps
+      to run and the estimated number of commands, or None if a step could not
+      be dry run.
+  """
+  # Copy all projects together so they keep sharing the root config.
+  projects = copy.deepcopy(projects)
+  dry_run = FLAGS.dry_run
+  FLAGS.dry_run = True
+  plans = {}
+  try:
+    for config in projects:
+      project_id = config.project['project_id']
+      action, steps_to_run = _get_steps_to_run(
+          config, _SETUP_STEPS + config.extra_steps)
+      start_count = runner.get_command_count()
+      num_commands = None
+      try:
+        for step in steps_to_run:
+          step.func(config)
+        num_commands = runner.get_command_count() - start_count
+      except Exception as e:  # pylint: disable=broad-except
+        logging.warning('%s: failed to dry run steps: %s', project_id, e)
+      plans[project_id] = (action, [step.id for step in steps_to_run],
+                           num_commands)
+  finally:
+    FLAGS.dry_run = dry_run
+    # Drop the faked outputs of the dry run.
+    runner.reset_cache()
+
+  for project_id, (action, step_ids, num_commands) in plans.items():
+    logging.info('Plan for %s: %s, %d steps (%s), %s commands', project_id,
+                 action, len(step_ids), ', '.join(step_ids) or 'none',
+                 '?' if num_commands is None else '~{}'.format(num_commands))
+  return plans
+
+
 def install_forseti(config):
   """Install forseti based on the given config."""
   forseti_config = config.root['forseti']
@@ -869,8 +1348,9 @@ def install_forseti(config):
       'service_account': forseti.get_server_service_account(forseti_project_id),
       'server_bucket': forseti.get_server_bucket(forseti_project_id)
   }
-  field_generation.set_forseti_service_generated_fields(generated_field,
-                                                        config.root)
+  with field_generation.GENERATED_FIELDS_LOCK:
+    field_generation.set_forseti_service_generated_fields(generated_field,
+                                                          config.root)
 
 
 def get_forseti_access_granter_step(project_id):
@@ -882,9 +1362,11 @@ def get_forseti_access_granter_step(project_id):
     forseti.grant_access(project_id, service_account)
 
   return Step(
+      id='grant_forseti_access_{}'.format(project_id),
       func=grant_access,
       description='Grant Access to Forseti Service account',
       updatable=False,
+      depends_on=None,
   )
 
 
@@ -913,6 +1395,17 @@ def validate_project_configs(overall, projects):
 def main(argv):
   del argv  # Unused.
 
+  runner.reset_cache()
+  instrumentation.reset()
+  try:
+    _deploy_from_flags()
+  finally:
+    runner.log_cache_stats()
+    instrumentation.write_outputs()
+
+
+def _deploy_from_flags():
+  """Deploys the projects selected by the flags."""
   if FLAGS.enable_new_style_resources:
     logging.info('--enable_new_style_resources is true.')
 
@@ -931,11 +1424,18 @@ def main(argv):
       return
 
   # Read and parse the project configuration YAML file.
-  root_config = utils.load_config(FLAGS.project_yaml)
+  # Generated fields are written back to a fresh round-trip load of the
+  # project YAML, so the faster safe loader can be used here.
+  root_config = utils.load_config(FLAGS.project_yaml, round_trip=False)
   if not root_config:
     logging.error('Error loading project YAML.')
     return
 
+  # Apply generated fields from --state_db, or journaled but not written by an
+  # interrupted run.
+  field_generation.recover_generated_fields(FLAGS.project_yaml,
+                                            FLAGS.output_yaml_path, root_config)
+
   logging.info('Validating project YAML against schema.')
   try:
     utils.validate_config_yaml(root_config)
@@ -953,12 +1453,14 @@ def main(argv):
         '*'
     } or project_config_dict['project_id'] in want_projects
 
+  # Projects which others depend on, deployed one at a time before the rest.
+  prerequisite_projects = []
   projects = []
   audit_logs_project = root_config.get('audit_logs_project')
 
   # Always deploy the remote audit logs project first (if present).
   if want_project(audit_logs_project):
-    projects.append(
+    prerequisite_projects.append(
         ProjectConfig(
             root=root_config,
             project=audit_logs_project,
@@ -970,9 +1472,11 @@ def main(argv):
   if forseti_config and want_project(forseti_config['project']):
     extra_steps = [
         Step(
+            id='install_forseti',
             func=install_forseti,
             description='Install Forseti',
             updatable=False,
+            depends_on=None,
         ),
         get_forseti_access_granter_step(
             forseti_config['project']['project_id']),
@@ -987,7 +1491,8 @@ def main(argv):
         project=forseti_config['project'],
         audit_logs_project=audit_logs_project,
         extra_steps=extra_steps)
-    projects.append(forseti_project_config)
+    # The Forseti instance must exist before access can be granted to it.
+    prerequisite_projects.append(forseti_project_config)
 
   for project_config in root_config.get('projects', []):
     if not want_project(project_config):
@@ -1005,17 +1510,41 @@ def main(argv):
             audit_logs_project=audit_logs_project,
             extra_steps=extra_steps))
 
-  validate_project_configs(root_config['overall'], projects)
+  validate_project_configs(root_config['overall'],
+                           prerequisite_projects + projects)
+
+  # Snapshot the configs before any step changes them, so their hashes are
+  # stable across runs.
+  prerequisite_projects = [snapshot_config(p) for p in prerequisite_projects]
+  projects = [snapshot_config(p) for p in projects]
 
-  logging.info('Found %d projects to deploy', len(projects))
+  logging.info('Found %d projects to deploy',
+               len(prerequisite_projects) + len(projects))
 
-  for config in projects:
-    logging.info('Setting up project %s', config.project['project_id'])
+  if FLAGS.plan:
+    plan_projects(prerequisite_projects + projects)
+    return
+
+  for config in prerequisite_projects:
+    project_id = config.project['project_id']
+    logging.info('Setting up project %s', project_id)
 
-    if not setup_project(config, FLAGS.project_yaml, FLAGS.output_yaml_path):
-      # Don't attempt to deploy additional projects if one project failed.
+    with instrumentation.span('project', project_id, project_id):
+      ok = setup_project(config, FLAGS.project_yaml, FLAGS.output_yaml_path)
+    if not ok:
+      # Don't attempt to deploy additional projects as they depend on this one.
       return
 
+  failed_projects = deploy_projects(projects, FLAGS.project_yaml,
+                                    FLAGS.output_yaml_path,
+                                    FLAGS.max_concurrent_projects)
+  logging.info('Deployed %d of %d projects successfully.',
+               len(projects) - len(failed_projects), len(projects))
+  if failed_projects:
+    logging.error('The following projects failed to deploy: %s',
+                  ', '.join(failed_projects))
+    return
+
   if forseti_config:
     if FLAGS.enable_new_style_resources:
       call = [
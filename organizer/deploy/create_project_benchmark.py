@@ -0,0 +1,258 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""End-to-end benchmark of project deployment against a simulated GCP.
+
+Synthesizes configs with the given numbers of data projects and deploys them
+with create_project, running every gcloud command and binary against an
+in-memory simulation of GCP (see utils/simulated_backend.py). Calls take the
+latency given for their command family, fail at the given rates and are
+limited by the given quotas, so the time taken by the deployment scripts'
+scheduling, caching, retries and rate limiting can be measured without waiting
+on real APIs.
+
+Reports the time taken, the number of calls by command family and the number
+of projects deployed for each config, and optionally writes the trace of every
+call. create_project's flags, e.g. --max_concurrent_projects and
+--api_rate_limits, apply.
+
+Usage:
+  bazel run :create_project_benchmark -- \
+      --deploy_num_projects=1,10,100 \
+      --latencies=services=2,deployment-manager=10,apply=30 \
+      --failure_rates=services=0.05 \
+      --quotas=services=5 \
+      --api_rate_limits=services=4 \
+      --max_concurrent_projects=10
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import tempfile
+import time
+
+from absl import app
+from absl import flags
+from absl import logging
+
+from deploy import create_project
+from deploy.utils import field_generation
+from deploy.utils import runner
+from deploy.utils import simulated_backend
+from deploy.utils import utils
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list('deploy_num_projects', ['1', '10', '100'],
+                  'Numbers of data projects to benchmark deployment with.')
+flags.DEFINE_list('latencies', [],
+                  ('Seconds calls take, as FAMILY=SECS pairs. A family is a '
+                   'gcloud service, optionally followed by a command group '
+                   '(e.g. "deployment-manager operations"), or the name of a '
+                   'binary (e.g. "apply").'))
+flags.DEFINE_list('failure_rates', [],
+                  'Probability calls fail, as FAMILY=RATE pairs.')
+flags.DEFINE_list('quotas', [],
+                  ('Calls allowed per second, as FAMILY=RATE pairs. Calls '
+                   'over the quota fail with a quota error.'))
+flags.DEFINE_float('jitter', 0,
+                   'Latencies vary at random by up to this fraction.')
+flags.DEFINE_integer('seed', None,
+                     'Seed of the random failures and jitter.')
+flags.DEFINE_string('trace_dir', None,
+                    ('Local directory to write the trace of the calls of each '
+                     'benchmark to, as trace_<number of projects>.json.'))
+
+# Number of each kind of resource in a synthesized project.
+_BUCKETS_PER_PROJECT = 2
+_DATASETS_PER_PROJECT = 2
+
+
+def _audit_logs(project_id):
+  """Synthesizes the remote audit logs of a project."""
+  name = project_id.replace('-', '_')
+  return {
+      'logs_gcs_bucket': {
+          'properties': {
+              'name': '{}-logs'.format(project_id),
+              'location': 'US',
+              'storageClass': 'MULTI_REGIONAL',
+          },
+          'ttl_days': 365,
+      },
+      'logs_bq_dataset': {
+          'properties': {
+              'name': name,
+              'location': 'US',
+          },
+      },
+  }
+
+
+def _synthesize_project(index):
+  """Synthesizes the config of a data project."""
+  project_id = 'data-project-{:05d}'.format(index)
+
+  def group(name):
+    return '{}-{}@domain.com'.format(project_id, name)
+
+  return {
+      'project_id': project_id,
+      'owners_group': group('owners'),
+      'auditors_group': group('auditors'),
+      'data_readwrite_groups': [group('readwrite')],
+      'data_readonly_groups': [group('readonly')],
+      'create_deletion_lien': True,
+      'stackdriver_alert_email': group('alerts'),
+      'enabled_apis': ['bigquery-json.googleapis.com', 'pubsub.googleapis.com'],
+      'audit_logs': _audit_logs(project_id),
+      'resources': {
+          'bq_datasets': [{
+              'properties': {
+                  'name': 'dataset_{}'.format(i),
+                  'location': 'US',
+              },
+          } for i in range(_DATASETS_PER_PROJECT)],
+          'gcs_buckets': [{
+              'properties': {
+                  'name': '{}-data-{}'.format(project_id, i),
+                  'location': 'US-CENTRAL1',
+                  'storageClass': 'REGIONAL',
+              },
+          } for i in range(_BUCKETS_PER_PROJECT)],
+      },
+  }
+
+
+def synthesize_config(num_projects):
+  """Synthesizes a config with remote audit logs and no Forseti instance.
+
+  Args:
+    num_projects (int): Number of data projects in the config.
+
+  Returns:
+    dict: The config, without generated fields.
+  """
+  audit_logs = _audit_logs('audit-logs')
+  del audit_logs['logs_gcs_bucket']
+  return {
+      'overall': {
+          'organization_id': '246801357924',
+          'billing_account': '012345-6789AB-CDEF01',
+          'domain': 'domain.com',
+      },
+      'audit_logs_project': {
+          'project_id': 'audit-logs',
+          'owners_group': 'audit-logs-owners@domain.com',
+          'auditors_group': 'audit-logs-auditors@domain.com',
+          'create_deletion_lien': True,
+          'audit_logs': audit_logs,
+      },
+      'projects': [_synthesize_project(i) for i in range(num_projects)],
+  }
+
+
+def parse_family_values(pairs):
+  """Parses FAMILY=VALUE pairs into a map of family to float value."""
+  values = {}
+  for pair in pairs:
+    family, sep, value = pair.partition('=')
+    if not sep:
+      raise ValueError('Expected FAMILY=VALUE, got {}'.format(pair))
+    values[family.strip()] = float(value)
+  return values
+
+
+def benchmark(num_projects, backend, work_dir):
+  """Deploys a synthesized config against a simulated backend.
+
+  Args:
+    num_projects (int): Number of data projects to synthesize.
+    backend (SimulatedBackend): The backend to run commands with.
+    work_dir (str): Local directory to write the configs to.
+
+  Returns:
+    dict: The seconds taken ('secs'), the number of projects in the config
+      ('projects') and deployed ('deployed_projects'), the number of calls
+      ('calls') and failed calls ('failed_calls'), and the number of calls by
+      command family ('calls_by_family').
+  """
+  FLAGS.project_yaml = os.path.join(work_dir,
+                                    'config_{}.yaml'.format(num_projects))
+  FLAGS.output_yaml_path = os.path.join(
+      work_dir, 'output_{}.yaml'.format(num_projects))
+  FLAGS.projects = ['*']
+  config = synthesize_config(num_projects)
+  utils.write_yaml_file(config, FLAGS.project_yaml)
+
+  runner.set_backend(backend)
+  try:
+    start = time.time()
+    create_project.main([])
+    secs = time.time() - start
+  finally:
+    runner.set_backend(None)
+
+  project_ids = [config['audit_logs_project']['project_id']] + [
+      project['project_id'] for project in config['projects']
+  ]
+  output = utils.read_yaml_file(FLAGS.output_yaml_path, round_trip=False)
+  return {
+      'secs': secs,
+      'projects': len(project_ids),
+      'deployed_projects': sum(
+          field_generation.is_deployed(project_id, output)
+          for project_id in project_ids),
+      'calls': len(backend.trace),
+      'failed_calls': sum(1 for call in backend.trace if call.error),
+      'calls_by_family': dict(
+          collections.Counter(call.family for call in backend.trace)),
+  }
+
+
+def main(argv):
+  del argv  # Unused.
+  # All calls go to the simulated backend, so the benchmark is never a dry run.
+  FLAGS.dry_run = False
+  FLAGS.apply_binary = FLAGS.apply_binary or 'apply'
+  FLAGS.rule_generator_binary = FLAGS.rule_generator_binary or 'rule_generator'
+  latencies = parse_family_values(FLAGS.latencies)
+  failure_rates = parse_family_values(FLAGS.failure_rates)
+  quotas = parse_family_values(FLAGS.quotas)
+
+  results = {}
+  with tempfile.TemporaryDirectory() as work_dir:
+    for num_projects in FLAGS.deploy_num_projects:
+      logging.info('Benchmarking deployment of %s projects.', num_projects)
+      backend = simulated_backend.SimulatedBackend(
+          latencies=latencies,
+          failure_rates=failure_rates,
+          quotas=quotas,
+          jitter=FLAGS.jitter,
+          seed=FLAGS.seed)
+      results[num_projects] = benchmark(int(num_projects), backend, work_dir)
+      if FLAGS.trace_dir:
+        backend.write_trace(
+            os.path.join(FLAGS.trace_dir,
+                         'trace_{}.json'.format(num_projects)))
+  print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,68 @@
+"""Tests for deploy.create_project_benchmark."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from absl import flags
+from absl.testing import absltest
+
+from deploy import create_project_benchmark
+from deploy.utils import simulated_backend
+from deploy.utils import utils
+
+FLAGS = flags.FLAGS
+
+
+class CreateProjectBenchmarkTest(absltest.TestCase):
+
+  def setUp(self):
+    super(CreateProjectBenchmarkTest, self).setUp()
+    FLAGS.dry_run = False
+    FLAGS.apply_binary = 'apply'
+
+  def tearDown(self):
+    FLAGS.dry_run = True
+    FLAGS.apply_binary = None
+    super(CreateProjectBenchmarkTest, self).tearDown()
+
+  def test_benchmark(self):
+    backend = simulated_backend.SimulatedBackend()
+    results = create_project_benchmark.benchmark(
+        3, backend, self.create_tempdir().full_path)
+
+    self.assertEqual(results['projects'], 4)
+    self.assertEqual(results['deployed_projects'], 4)
+    self.assertEqual(results['failed_calls'], 0)
+    self.assertEqual(results['calls'], len(backend.trace))
+    self.assertEqual(results['calls_by_family']['apply'], 4)
+    self.assertLen(backend.projects, 4)
+
+  def test_benchmark_with_failures(self):
+    backend = simulated_backend.SimulatedBackend(
+        failure_rates={'apply': 1})
+    results = create_project_benchmark.benchmark(
+        3, backend, self.create_tempdir().full_path)
+
+    # The remote audit logs project fails, so no data project is deployed.
+    self.assertEqual(results['deployed_projects'], 0)
+    self.assertEqual(results['failed_calls'], 1)
+
+  def test_synthesize_config(self):
+    config = create_project_benchmark.synthesize_config(5)
+    utils.validate_config_yaml(config)
+    self.assertLen(config['projects'], 5)
+
+  def test_parse_family_values(self):
+    self.assertEqual(
+        create_project_benchmark.parse_family_values(
+            ['services=2', 'deployment-manager operations=0.5']), {
+                'services': 2,
+                'deployment-manager operations': 0.5
+            })
+    with self.assertRaises(ValueError):
+      create_project_benchmark.parse_family_values(['services'])
+
+
+if __name__ == '__main__':
+  absltest.main()
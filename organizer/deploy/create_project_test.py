@@ -9,6 +9,8 @@ from __future__ import print_function
 
 import os
 import tempfile
+import threading
+import unittest.mock
 
 from absl import flags
 from absl.testing import absltest
@@ -16,6 +18,8 @@ from absl.testing import absltest
 import ruamel.yaml
 
 from deploy import create_project
+from deploy.utils import field_generation
+from deploy.utils import runner
 from deploy.utils import utils
 
 FLAGS = flags.FLAGS
@@ -72,6 +76,336 @@ class CreateProjectTest(absltest.TestCase):
         f.flush()
       create_project.main([])
 
+  def test_create_project_concurrently(self):
+    FLAGS.max_concurrent_projects = 4
+    try:
+      _deploy('project_with_remote_audit_logs.yaml')
+    finally:
+      FLAGS.max_concurrent_projects = 1
+
+  def test_deploy_projects_isolates_failures(self):
+    projects = [
+        create_project.ProjectConfig(
+            root={},
+            project={'project_id': project_id},
+            audit_logs_project=None,
+            extra_steps=[])
+        for project_id in ['project-1', 'project-2', 'project-3']
+    ]
+
+    def fake_setup_project(config, project_yaml, output_yaml_path):
+      del project_yaml, output_yaml_path  # Unused.
+      if config.project['project_id'] == 'project-2':
+        raise ValueError('failed to deploy')
+      return config.project['project_id'] != 'project-3'
+
+    with unittest.mock.patch.object(
+        create_project, 'setup_project',
+        side_effect=fake_setup_project) as mock_setup_project:
+      failed = create_project.deploy_projects(
+          projects, 'in.yaml', 'out.yaml', max_workers=2)
+    self.assertEqual(failed, ['project-2', 'project-3'])
+    self.assertEqual(mock_setup_project.call_count, 3)
+
+  def test_get_step_prerequisites(self):
+    steps = [
+        _step('a', depends_on=[]),
+        _step('b', depends_on=['a']),
+        _step('c', depends_on=['a']),
+        _step('d', depends_on=None),
+    ]
+    self.assertEqual(
+        create_project._get_step_prerequisites(steps), {
+            'a': set(),
+            'b': {'a'},
+            'c': {'a'},
+            'd': {'a', 'b', 'c'},
+        })
+
+    with self.assertRaises(ValueError):
+      create_project._get_step_prerequisites(
+          [_step('a', depends_on=['b']),
+           _step('b', depends_on=[])])
+
+  def test_setup_project_runs_independent_steps_concurrently(self):
+    # Steps b and c can only finish if they run at the same time.
+    barrier = threading.Barrier(2, timeout=10)
+    ran = []
+
+    def wait_for_other_step(config):
+      del config  # Unused.
+      barrier.wait()
+
+    steps = [
+        _step('a', depends_on=[], func=lambda config: ran.append('a')),
+        _step('b', depends_on=['a'], func=wait_for_other_step),
+        _step('c', depends_on=['a'], func=wait_for_other_step),
+        _step('d', depends_on=None, func=lambda config: ran.append('d')),
+    ]
+    FLAGS.max_concurrent_steps = 2
+    try:
+      self.assertTrue(_setup_project_with_steps(steps, root={}))
+    finally:
+      FLAGS.max_concurrent_steps = 1
+    self.assertEqual(ran, ['a', 'd'])
+
+  def test_setup_project_resumes_from_completed_steps(self):
+    ran = []
+    steps = [
+        _step(step_id, depends_on=[],
+              func=lambda config, step_id=step_id: ran.append(step_id))
+        for step_id in ['a', 'b', 'c']
+    ]
+    root = {
+        'generated_fields': {
+            'projects': {
+                'my-project': {
+                    'failed_step': 1,
+                    'completed_steps': ['b'],
+                },
+            },
+        },
+    }
+    self.assertTrue(_setup_project_with_steps(steps, root))
+    self.assertEqual(ran, ['a', 'c'])
+    self.assertEqual(
+        list(root['generated_fields']['projects']['my-project']),
+        ['config_hash'])
+
+  def test_setup_project_records_completed_steps_on_failure(self):
+
+    def fail(config):
+      del config  # Unused.
+      raise ValueError('step failed')
+
+    steps = [
+        _step('a', depends_on=[]),
+        _step('b', depends_on=['a'], func=fail),
+        _step('c', depends_on=['a']),
+    ]
+    root = {}
+    self.assertFalse(_setup_project_with_steps(steps, root))
+    self.assertEqual(root['generated_fields']['projects']['my-project'], {
+        'failed_step': 2,
+        'completed_steps': ['a'],
+    })
+
+  def test_setup_project_incremental(self):
+    ran = []
+    steps = [
+        _step('a', depends_on=[], func=lambda config: ran.append('a')),
+        create_project.Step(
+            id='b',
+            func=lambda config: ran.append('b'),
+            description='b',
+            updatable=False,
+            depends_on=None),
+    ]
+    root = {
+        'generated_fields': {
+            'projects': {
+                'my-project': {
+                    'project_number': '1',
+                },
+            },
+        },
+    }
+    # Only updatable steps are run for deployed projects.
+    self.assertTrue(_setup_project_with_steps(steps, root))
+    self.assertEqual(ran, ['a'])
+    self.assertIn('config_hash',
+                  root['generated_fields']['projects']['my-project'])
+
+    # Not updated with --incremental while the config is unchanged.
+    FLAGS.incremental = True
+    try:
+      self.assertTrue(_setup_project_with_steps(steps, root))
+      self.assertEqual(ran, ['a'])
+
+      root['overall'] = {'billing_account': '000000-000000-000000'}
+      self.assertTrue(_setup_project_with_steps(steps, root))
+      self.assertEqual(ran, ['a', 'a'])
+    finally:
+      FLAGS.incremental = False
+
+  def test_config_hash_ignores_changes_made_by_steps(self):
+    project = {
+        'project_id': 'my-project',
+        'gce_instances': [{'name': 'vm-1'}],
+        'resources': {'gce_instances': [{'name': 'vm-2'}]},
+    }
+    config = create_project.ProjectConfig(
+        root={}, project=project, audit_logs_project=None, extra_steps=[])
+    want = create_project.get_config_hash(config)
+    config = create_project.snapshot_config(config)
+
+    create_project.create_compute_images(config)
+    self.assertLen(project['gce_instances'], 1)
+    # Steps changing the config do not change the hash.
+    project['gce_instances'].append({'name': 'vm-3'})
+    self.assertEqual(create_project.get_config_hash(config), want)
+
+  def test_plan_projects(self):
+    FLAGS.project_yaml = 'deploy/samples/project_with_remote_audit_logs.yaml'
+    root = utils.load_config(FLAGS.project_yaml)
+    projects = [
+        create_project.ProjectConfig(
+            root=root,
+            project=project,
+            audit_logs_project=root['audit_logs_project'],
+            extra_steps=[]) for project in root['projects']
+    ]
+    plans = create_project.plan_projects(projects)
+    for project in root['projects']:
+      action, step_ids, num_commands = plans[project['project_id']]
+      self.assertEqual(action, 'create')
+      self.assertLen(step_ids, len(create_project._SETUP_STEPS))
+      self.assertGreater(num_commands, 0)
+    # Planning does not change the config.
+    self.assertNotIn('generated_fields', root)
+
+  @unittest.mock.patch.object(runner, 'run_gcloud_command')
+  @unittest.mock.patch.object(utils, 'get_enabled_services')
+  def test_enable_services_apis(self, mock_get_enabled_services,
+                                mock_run_gcloud_command):
+    wanted_apis = ['api{:02d}.googleapis.com'.format(i) for i in range(25)]
+    config = create_project.ProjectConfig(
+        root={},
+        project={
+            'project_id': 'my-project',
+            'enabled_apis': wanted_apis,
+        },
+        audit_logs_project=None,
+        extra_steps=[])
+    mock_get_enabled_services.return_value = set(wanted_apis + [
+        'deploymentmanager.googleapis.com',
+        'cloudresourcemanager.googleapis.com',
+        'unlisted.googleapis.com',
+        # Enabled by default, or needed by the deployment.
+        'logging.googleapis.com',
+        'monitoring.googleapis.com',
+        'storage-api.googleapis.com',
+    ])
+
+    # Nothing to do when all wanted APIs are enabled.
+    create_project.enable_services_apis(config)
+    mock_run_gcloud_command.assert_not_called()
+
+    # Missing APIs are enabled in as few commands as possible.
+    mock_get_enabled_services.return_value = set(['unlisted.googleapis.com'])
+    create_project.enable_services_apis(config)
+    enabled = [
+        call[0][0][2:] for call in mock_run_gcloud_command.call_args_list
+    ]
+    self.assertLen(enabled, 2)
+    self.assertCountEqual(
+        enabled[0] + enabled[1], wanted_apis + [
+            'deploymentmanager.googleapis.com',
+            'cloudresourcemanager.googleapis.com',
+        ])
+
+    # Unlisted APIs are only disabled on request.
+    mock_run_gcloud_command.reset_mock()
+    mock_get_enabled_services.return_value = set(wanted_apis + [
+        'deploymentmanager.googleapis.com',
+        'cloudresourcemanager.googleapis.com',
+        'unlisted.googleapis.com',
+        # Enabled by default, or needed by the deployment.
+        'logging.googleapis.com',
+        'monitoring.googleapis.com',
+        'storage-api.googleapis.com',
+    ])
+    FLAGS.disable_unlisted_apis = True
+    try:
+      create_project.enable_services_apis(config)
+    finally:
+      FLAGS.disable_unlisted_apis = False
+    mock_run_gcloud_command.assert_called_once_with(
+        ['services', 'disable', 'unlisted.googleapis.com'],
+        project_id='my-project')
+
+  @unittest.mock.patch.object(utils, 'wait_for_project_iam_bindings')
+  @unittest.mock.patch.object(utils, 'is_deployment_unchanged')
+  @unittest.mock.patch.object(runner, 'run_gcloud_command')
+  def test_unchanged_data_project_skips_dm_access(
+      self, mock_run_gcloud_command, mock_is_deployment_unchanged,
+      mock_wait_for_project_iam_bindings):
+    config = create_project.ProjectConfig(
+        root={'overall': {}},
+        project={
+            'project_id': 'my-project',
+            'audit_logs': {},
+        },
+        audit_logs_project=None,
+        extra_steps=[])
+    mock_run_gcloud_command.return_value = '{"bindings": []}'
+
+    def get_iam_commands():
+      return [
+          call[0][0][:2] + call[0][0][-1:]
+          for call in mock_run_gcloud_command.call_args_list
+          if call[0][0][1].endswith('-iam-policy-binding')
+      ]
+
+    mock_is_deployment_unchanged.return_value = True
+    FLAGS.diff_deployments = True
+    FLAGS.enable_new_style_resources = False
+    try:
+      create_project.grant_deployment_manager_access(config)
+      create_project.deploy_project_resources(config)
+      self.assertEmpty(get_iam_commands())
+      mock_wait_for_project_iam_bindings.assert_not_called()
+      self.assertEqual(mock_is_deployment_unchanged.call_args[0][1:],
+                       ('data-project-deployment', 'my-project'))
+
+      # The DM service account is granted its roles for changed deployments.
+      mock_is_deployment_unchanged.return_value = False
+      create_project.grant_deployment_manager_access(config)
+    finally:
+      FLAGS.diff_deployments = False
+      FLAGS.enable_new_style_resources = True
+    self.assertEqual(get_iam_commands(), [
+        ['projects', 'add-iam-policy-binding', 'roles/owner'],
+        ['projects', 'add-iam-policy-binding', 'roles/storage.admin'],
+    ])
+    mock_wait_for_project_iam_bindings.assert_called_once()
+
+  @unittest.mock.patch.object(utils, 'get_enabled_services')
+  def test_disable_unlisted_apis_with_forseti(self, mock_get_enabled_services):
+    mock_get_enabled_services.return_value = set([
+        'compute.googleapis.com',
+        'pubsub.googleapis.com',
+        'sqladmin.googleapis.com',
+    ])
+    disabled = []
+    run_gcloud_command = runner.run_gcloud_command
+
+    def record_disabled(cmd, project_id):
+      if cmd[:2] == ['services', 'disable']:
+        disabled.append((project_id, cmd[2]))
+      return run_gcloud_command(cmd, project_id=project_id)
+
+    FLAGS.disable_unlisted_apis = True
+    try:
+      with unittest.mock.patch.object(
+          runner, 'run_gcloud_command', side_effect=record_disabled):
+        _deploy('project_with_remote_audit_logs.yaml')
+    finally:
+      FLAGS.disable_unlisted_apis = False
+
+    # The Forseti installer's APIs are kept, as are those of the resources of
+    # each project.
+    self.assertCountEqual(disabled, [
+        ('my-audit-logs', 'compute.googleapis.com'),
+        ('my-audit-logs', 'pubsub.googleapis.com'),
+        ('my-audit-logs', 'sqladmin.googleapis.com'),
+        ('my-project', 'compute.googleapis.com'),
+        ('my-project', 'sqladmin.googleapis.com'),
+        ('my-other-project', 'compute.googleapis.com'),
+        ('my-other-project', 'pubsub.googleapis.com'),
+        ('my-other-project', 'sqladmin.googleapis.com'),
+    ])
+
   def test_create_project_with_spanned_configs(self):
     FLAGS.project_yaml = (
         'deploy/samples/spanned_configs/root.yaml')
@@ -111,6 +445,27 @@ class CreateProjectTest(absltest.TestCase):
       create_project.get_data_bucket_name(data_bucket, 'my-project')
 
 
+def _step(step_id, depends_on, func=lambda config: None):
+  return create_project.Step(
+      id=step_id,
+      func=func,
+      description=step_id,
+      updatable=True,
+      depends_on=depends_on)
+
+
+def _setup_project_with_steps(steps, root):
+  config = create_project.ProjectConfig(
+      root=root,
+      project={'project_id': 'my-project'},
+      audit_logs_project=None,
+      extra_steps=[])
+  with unittest.mock.patch.object(create_project, '_SETUP_STEPS', steps):
+    with unittest.mock.patch.object(field_generation,
+                                    'rewrite_generated_fields_back'):
+      return create_project.setup_project(config, 'in.yaml', 'out.yaml')
+
+
 def _deploy(config_filename):
   FLAGS.project_yaml = os.path.join(
       'deploy/samples/', config_filename)
@@ -0,0 +1,56 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Script to export the generated_fields in a state database to a YAML config.
+
+Usage:
+  bazel run :export_generated_fields -- \
+    --state_db=${STATE_DB?} \
+    --project_yaml=${PROJECT_CONFIG?} \
+    --output_yaml_path=${OUTPUT_CONFIG?} \
+    --nodry_run \
+    --alsologtostderr
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from absl import app
+from absl import flags
+
+from deploy.utils import field_generation
+from deploy.utils import utils
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('project_yaml', None,
+                    'Location of the project config YAML.')
+flags.DEFINE_string('output_yaml_path', None,
+                    ('Path to save the project config YAML with the exported '
+                     'generated_fields. Defaults to --project_yaml.'))
+
+
+def main(argv):
+  del argv  # Unused.
+  project_yaml = utils.normalize_path(FLAGS.project_yaml)
+  output_yaml_path = utils.normalize_path(FLAGS.output_yaml_path or
+                                          FLAGS.project_yaml)
+  field_generation.export_generated_fields(project_yaml, output_yaml_path)
+
+
+if __name__ == '__main__':
+  flags.mark_flag_as_required('state_db')
+  flags.mark_flag_as_required('project_yaml')
+  app.run(main)
@@ -5,6 +5,9 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import functools
+import hashlib
+import json
 
 from absl import logging
 from deploy.utils import field_generation
@@ -68,12 +71,50 @@ def _create_bigquery_bindings(owners, writers, readers):
   ]
 
 
+def _memoized(method):
+  """Caches the result of a method without arguments on the object.
+
+  The result is shared by all callers, who must not modify it.
+  """
+
+  @functools.wraps(method)
+  def wrapper(self):
+    name = method.__name__
+    if name not in self._views:
+      self._views[name] = method(self)
+    return self._views[name]
+
+  return wrapper
+
+
 Bucket = collections.namedtuple('Bucket', ['id', 'location'])
 GCEInstance = collections.namedtuple('GCEInstance', ['id', 'location'])
 
 
 class ProjectConfig(object):
-  """Configuration for a single GCP project."""
+  """Configuration for a single GCP project.
+
+  Rule generators query the same views of a project (e.g. its bindings) many
+  times, so they are computed once and shared. Callers must not modify them.
+  """
+
+  __slots__ = (
+      '_project_config',
+      '_uses_local_audit_logs',
+      '_partial_overall',
+      '_forseti_gcp_reader',
+      '_owners',
+      '_auditors',
+      '_writers',
+      '_readers',
+      '_audit_logs_owners',
+      '_views',
+      'project_id',
+      'enabled_apis',
+      'bigquery_datasets',
+      'audit_logs_bigquery_dataset',
+      'audit_logs_project_id',
+  )
 
   def __init__(self, project, audit_logs_project, generated_fields):
     """Initialize.
@@ -86,6 +127,8 @@ class ProjectConfig(object):
         generated_fields (dict): The generated fields of all projects.
     """
     self._project_config = project
+    # Derived views, computed on first use.
+    self._views = {}
     self._uses_local_audit_logs = audit_logs_project is None
     self._partial_overall = {
         field_generation.GENERATED_FIELDS_NAME: generated_fields
@@ -123,6 +166,31 @@ class ProjectConfig(object):
       self._audit_logs_owners = self._owners
       self.audit_logs_bigquery_dataset['name'] = _LOCAL_AUDIT_LOGS_DATASET
 
+  @_memoized
+  def _get_generated_fields(self):
+    """Returns the project's generated fields."""
+    return field_generation.get_generated_fields_copy(
+        self._project_config['project_id'], self._partial_overall)
+
+  @_memoized
+  def get_config_hash(self):
+    """Returns a hash of everything the project's rules are generated from.
+
+    This is the project's config, its audit logs project, its generated fields
+    and the Forseti service account.
+    """
+    inputs = [
+        self._project_config,
+        self.audit_logs_project_id,
+        self._audit_logs_owners,
+        self._uses_local_audit_logs,
+        self._get_generated_fields(),
+        self._forseti_gcp_reader,
+    ]
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+  @_memoized
   def get_project_bindings(self):
     """Get expected IAM bindings at the project level.
 
@@ -136,9 +204,7 @@ class ProjectConfig(object):
     # groups (if any).
     editors = [
         _group_name(g) for g in self._project_config.get('editors_groups', [])]
-    project_num = field_generation.get_generated_fields_copy(
-        self._project_config['project_id'],
-        self._partial_overall)['project_number']
+    project_num = self._get_generated_fields()['project_number']
     for service_account in _EDITOR_SERVICE_ACCOUNTS:
       editors.append(_service_account_name(service_account.format(
           project_num=project_num)))
@@ -149,7 +215,8 @@ class ProjectConfig(object):
                                                []):
       for role in additional['roles']:
         bindings[role].extend(additional['members'])
-    return bindings
+    # A plain dict, so looking up a missing role does not add it.
+    return dict(bindings)
 
   def get_data_bucket_name(self, data_bucket):
     """Get the name of data buckets."""
@@ -158,6 +225,7 @@ class ProjectConfig(object):
     else:
       return data_bucket['name']
 
+  @_memoized
   def get_buckets(self):
     """Get the GCS buckets in the project.
 
@@ -172,6 +240,7 @@ class ProjectConfig(object):
     ]
     return buckets
 
+  @_memoized
   def get_audit_log_bucket(self):
     """Get the audit log GCS bucket.
 
@@ -186,6 +255,7 @@ class ProjectConfig(object):
     bid = bucket_dict.get('name', '{}-logs'.format(self.project_id))
     return Bucket(id=bid, location=location)
 
+  @_memoized
   def get_bucket_bindings(self):
     """Returns a list of bucket names and their expected bindings."""
     bindings = []
@@ -231,6 +301,7 @@ class ProjectConfig(object):
 
     return bindings
 
+  @_memoized
   def get_project_bigquery_bindings(self):
     """Returns a list of BigQuery datasets names and their expected bindings."""
     ids_and_bindings = []
@@ -257,15 +328,14 @@ class ProjectConfig(object):
                self._owners, self._writers, self._readers)))
     return ids_and_bindings
 
+  @_memoized
   def get_audit_logs_bigquery_bindings(self):
     """Returns a list of audit logs project bindings for BigQuery rules."""
 
     owners = self._audit_logs_owners
     writers = [
         _service_account_name(
-            field_generation.get_generated_fields_copy(
-                self._project_config['project_id'],
-                self._partial_overall)['log_sink_service_account'])
+            self._get_generated_fields()['log_sink_service_account'])
     ]
     readers = self._auditors
 
@@ -276,13 +346,12 @@ class ProjectConfig(object):
     return 'bigquery.googleapis.com/projects/{}/datasets/{}'.format(
         self.audit_logs_project_id, self.audit_logs_bigquery_dataset['name'])
 
+  @_memoized
   def get_gce_instances(self):
     """Returns a list of GCE instances."""
-    generated_fields_copy = field_generation.get_generated_fields_copy(
-        self._project_config['project_id'], self._partial_overall)
     instance_name_to_id = {
         info['name']: info['id']
-        for info in generated_fields_copy.get('gce_instance_info', [])
+        for info in self._get_generated_fields().get('gce_instance_info', [])
     }
 
     gce_instances = []
@@ -295,6 +295,27 @@ class ProjectConfigTest(absltest.TestCase):
         'bigquery.googleapis.com/projects/audit-logs/datasets/some_data_logs',
         project.get_audit_log_sink_destination())
 
+  def test_views_are_memoized(self):
+    yaml_dict = yaml.load(TEST_PROJECT_YAML)
+    project = ProjectConfig(
+        project=yaml_dict['projects'][0],
+        audit_logs_project=None,
+        generated_fields=yaml_dict['generated_fields'])
+    self.assertIs(project.get_project_bindings(),
+                  project.get_project_bindings())
+    self.assertIs(project.get_bucket_bindings(), project.get_bucket_bindings())
+    self.assertIs(project.get_buckets(), project.get_buckets())
+    self.assertIs(project.get_gce_instances(), project.get_gce_instances())
+
+    # Looking up a role the project has no bindings for does not add it.
+    self.assertNotIn('roles/viewer', project.get_project_bindings())
+    with self.assertRaises(KeyError):
+      _ = project.get_project_bindings()['roles/viewer']
+
+    # ProjectConfigs have no per-instance dict.
+    with self.assertRaises(AttributeError):
+      project.unknown_attribute = True
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -0,0 +1,100 @@
+"""Cache of the project-specific rules of each scanner.
+
+Most of a rules file is made of rules for a single project, which only change
+when that project's config or generated fields do. RuleFragmentCache keeps these
+fragments between runs, keyed by the scanner, a hash of the project's inputs
+and of the global config, so regenerating rules after a change only rebuilds the
+fragments of changed projects plus the global rules.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+from absl import logging
+
+# Version of the cache file format. Bump it when rules change shape, so
+# fragments generated by an older version are not reused.
+_CACHE_VERSION = 1
+
+
+class RuleFragmentCache(object):
+  """Project-specific rules reused across rule generation runs."""
+
+  def __init__(self, fragments=None):
+    """Initialize.
+
+    Args:
+      fragments (dict): Cached rules, keyed by scanner rules file name, project
+        config hash and global config hash.
+    """
+    self.fragments = fragments or {}
+    # Fragments used in this run. Only these are saved, so fragments of
+    # removed or changed projects do not accumulate.
+    self.used = {}
+    self.hits = 0
+    self.misses = 0
+
+  @classmethod
+  def load(cls, path):
+    """Loads the cache saved at path, or an empty cache if there is none."""
+    if not os.path.exists(path):
+      return cls()
+    try:
+      with open(path, 'rb') as f:
+        version, fragments = pickle.load(f)
+    except (EOFError, ValueError, pickle.UnpicklingError) as e:
+      logging.warning('Ignoring unreadable rule fragment cache %s: %s', path, e)
+      return cls()
+    if version != _CACHE_VERSION:
+      return cls()
+    return cls(fragments)
+
+  def save(self, path):
+    """Saves the fragments used in this run to path."""
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp',
+        delete=False) as f:
+      pickle.dump((_CACHE_VERSION, self.used), f, pickle.HIGHEST_PROTOCOL)
+    os.rename(f.name, path)
+
+  def merge(self, other):
+    """Adds the fragments used by another cache, e.g. in another process."""
+    self.used.update(other.used)
+    self.hits += other.hits
+    self.misses += other.misses
+
+  def get_project_rules(self, scanner, project, global_config,
+                        get_project_rules):
+    """Gets a scanner's rules for a project, generating them if not cached.
+
+    Args:
+      scanner (str): Name of the scanner's rules file.
+      project (ProjectConfig): Configuration for a single project.
+      global_config (dict): A dictionary of global configuration values.
+      get_project_rules (Callable[[ProjectConfig, dict], List[dict]]): The
+        scanner's function generating the rules for a project.
+
+    Returns:
+      List[dict]: The project's rules, which must not be modified.
+    """
+    key = (scanner, project.get_config_hash(), _hash(global_config))
+    rules = self.fragments.get(key)
+    if rules is None:
+      self.misses += 1
+      rules = get_project_rules(project, global_config)
+    else:
+      self.hits += 1
+    self.used[key] = rules
+    return rules
+
+
+def _hash(config):
+  return hashlib.sha256(
+      json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
@@ -0,0 +1,85 @@
+"""Tests for deploy.rule_generator.rule_fragments."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+from absl.testing import absltest
+
+from deploy.rule_generator import rule_fragments
+from deploy.rule_generator.scanners import scanner_test_utils
+
+
+class RuleFragmentCacheTest(absltest.TestCase):
+
+  def setUp(self):
+    super(RuleFragmentCacheTest, self).setUp()
+    self.path = os.path.join(self.create_tempdir().full_path, 'fragments')
+    self.generated = []
+
+  def _get_project_rules(self, project, global_config):
+    del global_config  # Unused.
+    self.generated.append(project.project_id)
+    return [{'name': 'Rule for {}'.format(project.project_id)}]
+
+  def _get_rules(self, cache, projects, global_config):
+    return [
+        cache.get_project_rules('test_rules.yaml', project, global_config,
+                                self._get_project_rules)
+        for project in projects
+    ]
+
+  def test_unchanged_projects_are_reused(self):
+    global_config = scanner_test_utils.create_test_global_config()
+    projects = scanner_test_utils.create_test_projects(3)
+    cache = rule_fragments.RuleFragmentCache.load(self.path)
+    want_rules = self._get_rules(cache, projects, global_config)
+    self.assertEqual((cache.hits, cache.misses), (0, 3))
+    cache.save(self.path)
+
+    self.generated = []
+    cache = rule_fragments.RuleFragmentCache.load(self.path)
+    projects[1] = scanner_test_utils.create_test_project(
+        'project-1', 1000001,
+        extra_fields={'enabled_apis': ['bigquery-json.googleapis.com']})
+    self.assertEqual(self._get_rules(cache, projects, global_config),
+                     want_rules)
+    self.assertEqual(self.generated, ['project-1'])
+    self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+  def test_global_config_change_invalidates_fragments(self):
+    global_config = scanner_test_utils.create_test_global_config()
+    projects = scanner_test_utils.create_test_projects(2)
+    cache = rule_fragments.RuleFragmentCache()
+    self._get_rules(cache, projects, global_config)
+    cache.save(self.path)
+
+    cache = rule_fragments.RuleFragmentCache.load(self.path)
+    global_config['domain'] = 'other.com'
+    self._get_rules(cache, projects, global_config)
+    self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+  def test_only_used_fragments_are_saved(self):
+    global_config = scanner_test_utils.create_test_global_config()
+    projects = scanner_test_utils.create_test_projects(2)
+    cache = rule_fragments.RuleFragmentCache()
+    self._get_rules(cache, projects, global_config)
+    cache.save(self.path)
+
+    # project-1 is removed.
+    cache = rule_fragments.RuleFragmentCache.load(self.path)
+    self._get_rules(cache, projects[:1], global_config)
+    cache.save(self.path)
+    self.assertLen(rule_fragments.RuleFragmentCache.load(self.path).fragments,
+                   1)
+
+  def test_unreadable_cache_is_ignored(self):
+    with open(self.path, 'wb') as f:
+      f.write(b'not a cache')
+    self.assertEmpty(rule_fragments.RuleFragmentCache.load(self.path).fragments)
+
+
+if __name__ == '__main__':
+  absltest.main()
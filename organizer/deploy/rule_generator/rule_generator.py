@@ -8,8 +8,12 @@ import os
 import posixpath
 import tempfile
 
+from concurrent import futures
+
+from absl import flags
 from absl import logging
 
+from deploy.rule_generator import rule_fragments
 from deploy.rule_generator.project_config import ProjectConfig
 from deploy.rule_generator.scanners.audit_logging_scanner_rules import AuditLoggingScannerRules
 from deploy.rule_generator.scanners.bigquery_scanner_rules import BigQueryScannerRules
@@ -22,9 +26,25 @@ from deploy.rule_generator.scanners.location_scanner_rules import LocationScanne
 from deploy.rule_generator.scanners.log_sink_scanner_rules import LogSinkScannerRules
 from deploy.rule_generator.scanners.resource_scanner_rules import ResourceScannerRules
 from deploy.utils import field_generation
+from deploy.utils import gcs_uploader
 from deploy.utils import runner
 from deploy.utils import utils
 
+FLAGS = flags.FLAGS
+
+flags.DEFINE_bool('parallel_rule_generation', False,
+                  ('Generate the rules of each scanner in a separate process '
+                   'instead of one scanner after another.'))
+flags.DEFINE_string('rule_fragment_cache', None,
+                    ('Path of a file caching the rules generated for each '
+                     'project. Rules of projects whose config and generated '
+                     'fields did not change since the last run are reused '
+                     'from it instead of generated again.'))
+flags.DEFINE_bool('direct_gcs_upload', False,
+                  ('Upload rules files to GCS in-process through the Cloud '
+                   'Storage client library (if installed) instead of writing '
+                   'them to a temporary directory and copying them with '
+                   'gsutil.'))
 
 # All Scanner Rule Generators to use.
 SCANNER_RULE_GENERATORS = [
@@ -66,12 +86,19 @@ def run(deployment_config, output_path=None):
 
   if output_path.startswith('gs://'):
     # output path is a GCS bucket
+    if FLAGS.direct_gcs_upload and not FLAGS.dry_run:
+      if gcs_uploader.is_available():
+        _upload_rules(deployment_config, output_path)
+        return
+      logging.warning('The Cloud Storage client library is not installed, '
+                      'copying rules files with gsutil.')
     with tempfile.TemporaryDirectory() as tmp_dir:
       _write_rules(deployment_config, tmp_dir)
-      logging.info('Copying rules files to %s', output_path)
+      logging.info('Copying changed rules files to %s', output_path)
+      # Compare checksums so only rules files whose content changed are
+      # uploaded.
       runner.run_command([
-          'gsutil', 'cp',
-          os.path.join(tmp_dir, '*.yaml'),
+          'gsutil', '-m', 'rsync', '-c', tmp_dir,
           posixpath.join(output_path, 'rules'),
       ])
   else:
@@ -79,15 +106,121 @@ def run(deployment_config, output_path=None):
     _write_rules(deployment_config, output_path)
 
 
+def _upload_rules(deployment_config, output_path):
+  """Upload changed rules files to the given GCS path without local files."""
+  rules_path = posixpath.join(output_path, 'rules')
+  logging.info('Uploading changed rules files to %s', rules_path)
+  files = ((config_file_name, text.encode('utf-8'))
+           for config_file_name, text in _generate_rules(deployment_config))
+  uploaded = gcs_uploader.GcsUploader().upload(
+      files, rules_path, content_type='text/yaml')
+  logging.info('Uploaded %d changed rules files.', len(uploaded))
+
+
 def _write_rules(deployment_config, directory):
   """Write a rules yaml file for each generator to the given directory."""
+  for config_file_name, text in _generate_rules(deployment_config):
+    utils.write_yaml_text(text, os.path.join(directory, config_file_name))
+
+
+def _generate_rules(deployment_config):
+  """Generates the rules of each generator as YAML text.
+
+  Args:
+    deployment_config(dict): The loaded yaml deployment config.
+
+  Yields:
+    (string, string): The file name and YAML text of each rules file, as soon
+      as it is generated.
+  """
   project_configs, global_config = get_all_project_configs(deployment_config)
-  for generator in SCANNER_RULE_GENERATORS:
-    config_file_name = generator.config_file_name()
-    logging.info('Generating rules for %s', config_file_name)
-    rules = generator.generate_rules(project_configs, global_config)
-    path = os.path.join(directory, config_file_name)
-    utils.write_yaml_file(rules, path)
+  fragment_cache = None
+  if FLAGS.rule_fragment_cache:
+    fragment_cache = rule_fragments.RuleFragmentCache.load(
+        FLAGS.rule_fragment_cache)
+
+  if FLAGS.parallel_rule_generation:
+    for config_file_name, text in _generate_rules_in_parallel(
+        project_configs, global_config, fragment_cache):
+      yield config_file_name, text
+  else:
+    for generator in SCANNER_RULE_GENERATORS:
+      config_file_name = generator.config_file_name()
+      logging.info('Generating rules for %s', config_file_name)
+      rules = generator.generate_rules(project_configs, global_config,
+                                       fragment_cache)
+      yield config_file_name, utils.dump_yaml(rules)
+
+  if fragment_cache is not None:
+    logging.info('Rule fragment cache: %d hits, %d misses', fragment_cache.hits,
+                 fragment_cache.misses)
+    if not FLAGS.dry_run:
+      fragment_cache.save(FLAGS.rule_fragment_cache)
+
+
+# The project configs, global config and cached rule fragments rule generator
+# processes share.
+_worker_configs = None
+
+
+def _init_worker(project_configs, global_config, fragments):
+  global _worker_configs
+  _worker_configs = (project_configs, global_config, fragments)
+
+
+def _generate_rules_text(generator_index):
+  """Generates a scanner's rules in a worker process, as YAML text.
+
+  Rules are serialized in the worker so the parent only writes the text, which
+  is the same as the serial path writes.
+
+  Returns:
+    (string, RuleFragmentCache): The YAML text, and the worker's fragment cache
+      if fragments are cached.
+  """
+  project_configs, global_config, fragments = _worker_configs
+  fragment_cache = None
+  if fragments is not None:
+    fragment_cache = rule_fragments.RuleFragmentCache(fragments)
+  generator = SCANNER_RULE_GENERATORS[generator_index]
+  rules = generator.generate_rules(
+      list(project_configs), global_config, fragment_cache)
+  if fragment_cache is not None:
+    # Only send back the fragments used.
+    fragment_cache.fragments = {}
+  return utils.dump_yaml(rules), fragment_cache
+
+
+def _generate_rules_in_parallel(project_configs, global_config,
+                                fragment_cache):
+  """Generates the rules of each generator in a separate process.
+
+  The project configs are sent to each process once, when it starts, rather
+  than with every generator.
+
+  Yields:
+    (string, string): The file name and YAML text of each rules file, as soon
+      as its process generated it.
+  """
+  fragments = None
+  if fragment_cache is not None:
+    fragments = fragment_cache.fragments
+  executor = futures.ProcessPoolExecutor(
+      max_workers=min(len(SCANNER_RULE_GENERATORS), os.cpu_count() or 1),
+      initializer=_init_worker,
+      initargs=(tuple(project_configs), global_config, fragments))
+  with executor:
+    config_file_names = {}
+    for i, generator in enumerate(SCANNER_RULE_GENERATORS):
+      config_file_name = generator.config_file_name()
+      logging.info('Generating rules for %s', config_file_name)
+      config_file_names[executor.submit(_generate_rules_text,
+                                        i)] = config_file_name
+    for future in futures.as_completed(config_file_names):
+      text, worker_cache = future.result()
+      if fragment_cache is not None:
+        fragment_cache.merge(worker_cache)
+      yield config_file_names[future], text
 
 
 def get_all_project_configs(config_dict):
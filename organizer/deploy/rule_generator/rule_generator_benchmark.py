@@ -0,0 +1,305 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Benchmark of rule generation for organizations with many projects.
+
+Synthesizes deployment configs with the given numbers of projects, each with
+buckets, datasets, VMs and additional permissions, and measures the time taken
+to build the project configs, by each scanner rule generator, to write the rules
+files and by a full rule_generator.run, as well as the peak memory of the run.
+Everything runs offline, writing rules files to a local directory.
+
+Results are compared to a baseline saved with --update_baseline, and the
+benchmark fails if any measurement regressed by more than --max_regression.
+
+Usage:
+  bazel run :rule_generator_benchmark -- \
+      --num_projects=10,100,1000,10000 \
+      --baseline_path="${BASELINE_PATH}"
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from absl import app
+from absl import flags
+from absl import logging
+
+from deploy.rule_generator import rule_generator
+from deploy.utils import utils
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list('num_projects', ['10', '100', '1000', '10000'],
+                  'Numbers of projects to benchmark rule generation with.')
+flags.DEFINE_string('output_dir', None,
+                    ('Local directory to write rules files to. Defaults to a '
+                     'temporary directory, removed after the run.'))
+flags.DEFINE_string('baseline_path', None,
+                    'JSON file holding the results to compare against.')
+flags.DEFINE_bool('update_baseline', False,
+                  'Save the results to --baseline_path instead of comparing.')
+flags.DEFINE_float('max_regression', 0.2,
+                   ('Maximum allowed increase of a measurement over the '
+                    'baseline, as a fraction of the baseline.'))
+
+# Increases below these are noise, whatever the fraction of the baseline.
+_MIN_REGRESSION_SECS = 0.05
+_MIN_REGRESSION_BYTES = 1 << 20
+
+# Number of each kind of resource in a synthesized project.
+_BUCKETS_PER_PROJECT = 3
+_DATASETS_PER_PROJECT = 3
+_INSTANCES_PER_PROJECT = 2
+
+
+def _synthesize_project(index):
+  """Synthesizes the config and generated fields of a data project."""
+  project_id = 'data-project-{:05d}'.format(index)
+
+  def group(name):
+    return '{}-{}@domain.com'.format(project_id, name)
+
+  # Projects share a few team groups, like real organizations.
+  team_group = 'group:team-{}@domain.com'.format(index % 20)
+  project = {
+      'project_id': project_id,
+      'owners_group': group('owners'),
+      'auditors_group': group('auditors'),
+      'data_readwrite_groups': [group('readwrite')],
+      'data_readonly_groups': [group('readonly'), group('external')],
+      'additional_project_permissions': [{
+          'roles': ['roles/bigquery.dataViewer', 'roles/ml.developer'],
+          'members': [team_group, 'user:analyst-{}@domain.com'.format(index)],
+      }],
+      'audit_logs': {
+          'logs_bigquery_dataset': {
+              'name': '{}_logs'.format(project_id.replace('-', '_')),
+              'location': 'US',
+          },
+      },
+      'data_buckets': [{
+          'name_suffix': '-data-{}'.format(i),
+          'location': 'US-CENTRAL1',
+          'storage_class': 'REGIONAL',
+      } for i in range(_BUCKETS_PER_PROJECT)],
+      'bigquery_datasets': [{
+          'name': 'dataset_{}'.format(i),
+          'location': 'US' if i % 2 else 'EU',
+      } for i in range(_DATASETS_PER_PROJECT)],
+      'gce_instances': [{
+          'name': 'instance-{}'.format(i),
+          'zone': 'us-central1-f',
+          'machine_type': 'n1-standard-1',
+          'existing_boot_image':
+              'projects/debian-cloud/global/images/family/debian-9',
+      } for i in range(_INSTANCES_PER_PROJECT)],
+      'enabled_apis': ['bigquery-json.googleapis.com', 'compute.googleapis.com'],
+  }
+  project['data_buckets'][0]['additional_bucket_permissions'] = {
+      'owners': ['serviceAccount:etl@{}.iam.gserviceaccount.com'.format(
+          project_id)],
+      'readonly': [team_group],
+  }
+  project['bigquery_datasets'][0]['additional_dataset_permissions'] = {
+      'readwrite': ['serviceAccount:etl@{}.iam.gserviceaccount.com'.format(
+          project_id)],
+  }
+  project_number = 100000000000 + index
+  generated_fields = {
+      'project_number': project_number,
+      'log_sink_service_account':
+          'p{}-123@gcp-sa-logging.iam.gserviceaccount.com'.format(
+              project_number),
+      'gce_instance_info': [{
+          'name': 'instance-{}'.format(i),
+          'id': str(project_number * 10 + i),
+      } for i in range(_INSTANCES_PER_PROJECT)],
+  }
+  return project, generated_fields
+
+
+def synthesize_config(num_projects):
+  """Synthesizes a deployment config with remote audit logs.
+
+  Args:
+    num_projects (int): Number of data projects in the config.
+
+  Returns:
+    dict: The deployment config, with generated fields for all projects.
+  """
+  audit_logs_project = {
+      'project_id': 'audit-logs',
+      'owners_group': 'audit-logs-owners@domain.com',
+      'auditors_group': 'audit-logs-auditors@domain.com',
+      'audit_logs': {
+          'logs_bigquery_dataset': {
+              'name': 'audit_logs',
+              'location': 'US',
+          },
+      },
+  }
+  generated_fields = {
+      'forseti': {
+          'service_account': 'forseti@forseti-project.iam.gserviceaccount.com',
+          'server_bucket': 'gs://forseti-server-bucket/',
+      },
+      'projects': {
+          'audit-logs': {
+              'project_number': 99999,
+              'log_sink_service_account':
+                  'p99999-123@gcp-sa-logging.iam.gserviceaccount.com',
+          },
+      },
+  }
+  projects = []
+  for i in range(num_projects):
+    project, fields = _synthesize_project(i)
+    projects.append(project)
+    generated_fields['projects'][project['project_id']] = fields
+  return {
+      'overall': {
+          'organization_id': '246801357924',
+          'billing_account': '012345-6789AB-CDEF01',
+          'domain': 'domain.com',
+          'allowed_apis': [
+              'bigquery-json.googleapis.com',
+              'compute.googleapis.com',
+              'storage-api.googleapis.com',
+          ],
+      },
+      'audit_logs_project': audit_logs_project,
+      'projects': projects,
+      'generated_fields': generated_fields,
+  }
+
+
+def _timed(func, *args):
+  start = time.perf_counter()
+  result = func(*args)
+  return result, time.perf_counter() - start
+
+
+def benchmark(num_projects, output_dir):
+  """Measures rule generation for a synthesized config.
+
+  Args:
+    num_projects (int): Number of data projects to synthesize.
+    output_dir (str): Local directory to write rules files to.
+
+  Returns:
+    dict: Seconds taken by each step (keys ending in '_secs') and the peak
+      memory of a full run in bytes ('peak_memory_bytes').
+  """
+  results = {}
+  (project_configs, global_config), results['project_configs_secs'] = _timed(
+      rule_generator.get_all_project_configs, synthesize_config(num_projects))
+
+  write_secs = 0
+  for generator in rule_generator.SCANNER_RULE_GENERATORS:
+    config_file_name = generator.config_file_name()
+    rules, secs = _timed(generator.generate_rules, project_configs,
+                         global_config)
+    results['{}_secs'.format(os.path.splitext(config_file_name)[0])] = secs
+    _, secs = _timed(utils.write_yaml_file, rules,
+                     os.path.join(output_dir, config_file_name))
+    write_secs += secs
+  results['write_secs'] = write_secs
+
+  _, results['run_secs'] = _timed(rule_generator.run,
+                                  synthesize_config(num_projects), output_dir)
+
+  # Tracing allocations slows down the run, so measure memory separately.
+  config = synthesize_config(num_projects)
+  tracemalloc.start()
+  try:
+    rule_generator.run(config, output_dir)
+    _, results['peak_memory_bytes'] = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  return results
+
+
+def find_regressions(results, baseline, max_regression):
+  """Finds measurements which regressed compared to a baseline.
+
+  Args:
+    results (dict): Measurements by number of projects, as returned by
+      benchmark.
+    baseline (dict): Baseline measurements, in the same format.
+    max_regression (float): Maximum allowed increase over the baseline, as a
+      fraction of the baseline.
+
+  Returns:
+    List[str]: A description of each regression.
+  """
+  regressions = []
+  for num_projects, measurements in sorted(results.items()):
+    for name, value in sorted(measurements.items()):
+      base = baseline.get(num_projects, {}).get(name)
+      if base is None:
+        continue
+      min_increase = (
+          _MIN_REGRESSION_BYTES if name.endswith('_bytes') else
+          _MIN_REGRESSION_SECS)
+      if value > base * (1 + max_regression) and value - base > min_increase:
+        regressions.append('{} projects: {} regressed from {:.4g} to {:.4g}'
+                           .format(num_projects, name, base, value))
+  return regressions
+
+
+def main(argv):
+  del argv  # Unused.
+  # Rules files are only written locally, so the benchmark is never a dry run.
+  FLAGS.dry_run = False
+  if FLAGS.output_dir and FLAGS.output_dir.startswith('gs://'):
+    raise app.UsageError('--output_dir must be a local directory.')
+  output_dir = FLAGS.output_dir or tempfile.mkdtemp()
+
+  results = {}
+  try:
+    for num_projects in FLAGS.num_projects:
+      logging.info('Benchmarking rule generation for %s projects.',
+                   num_projects)
+      results[num_projects] = benchmark(int(num_projects), output_dir)
+  finally:
+    if not FLAGS.output_dir:
+      shutil.rmtree(output_dir)
+  print(json.dumps(results, indent=2, sort_keys=True))
+
+  if not FLAGS.baseline_path:
+    return 0
+  if FLAGS.update_baseline:
+    with open(FLAGS.baseline_path, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+    logging.info('Saved baseline to %s', FLAGS.baseline_path)
+    return 0
+  with open(FLAGS.baseline_path) as f:
+    baseline = json.load(f)
+  regressions = find_regressions(results, baseline, FLAGS.max_regression)
+  for regression in regressions:
+    logging.error(regression)
+  return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,74 @@
+"""Tests for deploy.rule_generator.rule_generator_benchmark."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+from absl import flags
+from absl.testing import absltest
+
+from deploy.rule_generator import rule_generator
+from deploy.rule_generator import rule_generator_benchmark
+
+FLAGS = flags.FLAGS
+
+
+class RuleGeneratorBenchmarkTest(absltest.TestCase):
+
+  def tearDown(self):
+    FLAGS.dry_run = True
+    super(RuleGeneratorBenchmarkTest, self).tearDown()
+
+  def test_benchmark(self):
+    FLAGS.dry_run = False
+    output_dir = self.create_tempdir().full_path
+    results = rule_generator_benchmark.benchmark(3, output_dir)
+
+    self.assertLen(
+        os.listdir(output_dir), len(rule_generator.SCANNER_RULE_GENERATORS))
+    for generator in rule_generator.SCANNER_RULE_GENERATORS:
+      self.assertIn(
+          '{}_secs'.format(os.path.splitext(generator.config_file_name())[0]),
+          results)
+    for name in ['project_configs_secs', 'write_secs', 'run_secs']:
+      self.assertIn(name, results)
+    self.assertGreater(results['peak_memory_bytes'], 0)
+
+  def test_synthesize_config(self):
+    config = rule_generator_benchmark.synthesize_config(5)
+    project_configs, _ = rule_generator.get_all_project_configs(config)
+    # The audit logs project and the data projects.
+    self.assertLen(project_configs, 6)
+    self.assertLen(project_configs[1].get_gce_instances(), 2)
+
+  def test_find_regressions(self):
+    baseline = {
+        '100': {
+            'iam_rules_secs': 1.0,
+            'write_secs': 0.01,
+            'peak_memory_bytes': 100 << 20,
+        },
+    }
+    results = {
+        '100': {
+            'iam_rules_secs': 1.5,
+            # Too small an increase to be a regression.
+            'write_secs': 0.02,
+            'peak_memory_bytes': 110 << 20,
+            # Not in the baseline.
+            'run_secs': 2.0,
+        },
+        '1000': {
+            'iam_rules_secs': 10.0,
+        },
+    }
+    regressions = rule_generator_benchmark.find_regressions(
+        results, baseline, 0.2)
+    self.assertLen(regressions, 1)
+    self.assertIn('iam_rules_secs', regressions[0])
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,162 @@
+"""Tests for deploy.rule_generator.rule_generator."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import unittest.mock
+
+from absl import flags
+from absl.testing import absltest
+
+from deploy.rule_generator import rule_generator
+from deploy.utils import fake_storage
+from deploy.utils import gcs_uploader
+from deploy.utils import runner
+
+FLAGS = flags.FLAGS
+
+
+def _project(project_id):
+  return {
+      'project_id': project_id,
+      'owners_group': '{}-owners@domain.com'.format(project_id),
+      'auditors_group': '{}-auditors@domain.com'.format(project_id),
+      'data_readwrite_groups': ['{}-readwrite@domain.com'.format(project_id)],
+      'data_readonly_groups': ['{}-readonly@domain.com'.format(project_id)],
+      'data_buckets': [{
+          'name_suffix': '-bucket',
+          'location': 'US-CENTRAL1',
+          'storage_class': 'REGIONAL',
+      }],
+      'bigquery_datasets': [{
+          'name': 'dataset',
+          'location': 'US',
+      }],
+      'audit_logs': {
+          'logs_gcs_bucket': {
+              'location': 'US',
+              'storage_class': 'MULTI_REGIONAL',
+              'ttl_days': 365,
+          },
+          'logs_bigquery_dataset': {
+              'location': 'US',
+          },
+      },
+  }
+
+
+def _deployment_config(num_projects):
+  project_ids = ['project-{}'.format(i) for i in range(num_projects)]
+  return {
+      'overall': {
+          'domain': 'domain.com',
+          'organization_id': '246801357924',
+          'billing_account': '012345-6789AB-CDEF01',
+          'allowed_apis': ['storage.googleapis.com'],
+      },
+      'projects': [_project(project_id) for project_id in project_ids],
+      'generated_fields': {
+          'forseti': {
+              'service_account':
+                  'forseti@sample-forseti.iam.gserviceaccount.com',
+          },
+          'projects': {
+              project_id: {
+                  'project_number': 1000 + i,
+                  'log_sink_service_account':
+                      'audit-logs-bq@logging-{}.iam.gserviceaccount.com'.format(
+                          1000 + i),
+              } for i, project_id in enumerate(project_ids)
+          },
+      },
+  }
+
+
+def _read_dir(directory):
+  contents = {}
+  for name in os.listdir(directory):
+    with open(os.path.join(directory, name), 'rb') as f:
+      contents[name] = f.read()
+  return contents
+
+
+class RuleGeneratorTest(absltest.TestCase):
+
+  def tearDown(self):
+    FLAGS.parallel_rule_generation = False
+    FLAGS.rule_fragment_cache = None
+    FLAGS.direct_gcs_upload = False
+    FLAGS.dry_run = True
+    super(RuleGeneratorTest, self).tearDown()
+
+  def test_parallel_rules_match_serial_rules(self):
+    FLAGS.dry_run = False
+    serial_dir = self.create_tempdir().full_path
+    rule_generator.run(_deployment_config(5), output_path=serial_dir)
+
+    FLAGS.parallel_rule_generation = True
+    parallel_dir = self.create_tempdir().full_path
+    rule_generator.run(_deployment_config(5), output_path=parallel_dir)
+
+    serial_rules = _read_dir(serial_dir)
+    self.assertLen(serial_rules, len(rule_generator.SCANNER_RULE_GENERATORS))
+    self.assertEqual(_read_dir(parallel_dir), serial_rules)
+
+  def test_cached_rules_match_generated_rules(self):
+    FLAGS.dry_run = False
+    want_dir = self.create_tempdir().full_path
+    config = _deployment_config(3)
+    config['projects'][1]['enabled_apis'] = ['bigquery-json.googleapis.com']
+    rule_generator.run(config, output_path=want_dir)
+
+    FLAGS.rule_fragment_cache = os.path.join(
+        self.create_tempdir().full_path, 'fragments')
+    rule_generator.run(_deployment_config(3),
+                       output_path=self.create_tempdir().full_path)
+
+    # Only project-1 changed, and is regenerated.
+    for parallel in [False, True]:
+      FLAGS.parallel_rule_generation = parallel
+      config = _deployment_config(3)
+      config['projects'][1]['enabled_apis'] = ['bigquery-json.googleapis.com']
+      got_dir = self.create_tempdir().full_path
+      rule_generator.run(config, output_path=got_dir)
+      self.assertEqual(_read_dir(got_dir), _read_dir(want_dir))
+
+  @unittest.mock.patch.object(runner, 'run_command')
+  def test_only_changed_rules_are_uploaded(self, mock_run_command):
+    FLAGS.dry_run = False
+    rule_generator.run(_deployment_config(1), output_path='gs://my-bucket')
+    cmd = mock_run_command.call_args[0][0]
+    self.assertEqual(cmd[:4], ['gsutil', '-m', 'rsync', '-c'])
+    self.assertEqual(cmd[-1], 'gs://my-bucket/rules')
+
+  def test_direct_gcs_upload(self):
+    FLAGS.dry_run = False
+    FLAGS.direct_gcs_upload = True
+    want_dir = self.create_tempdir().full_path
+    rule_generator.run(_deployment_config(2), output_path=want_dir)
+
+    client = fake_storage.FakeClient()
+    self.enter_context(
+        unittest.mock.patch.object(gcs_uploader, 'is_available',
+                                   return_value=True))
+    self.enter_context(
+        unittest.mock.patch.object(gcs_uploader, '_build_client',
+                                   return_value=client))
+    rule_generator.run(_deployment_config(2), output_path='gs://my-bucket')
+    self.assertLen(client.uploads, len(rule_generator.SCANNER_RULE_GENERATORS))
+    self.assertEqual(
+        {name[len('rules/'):]: data
+         for (_, name), data in client.objects.items()},
+        _read_dir(want_dir))
+
+    # Nothing is uploaded again if no rules changed.
+    client.uploads = []
+    rule_generator.run(_deployment_config(2), output_path='gs://my-bucket')
+    self.assertEmpty(client.uploads)
+
+if __name__ == '__main__':
+  absltest.main()
@@ -22,13 +22,29 @@ class BaseScannerRules(object):
     """Returns a string of the file name for this scanner's rule definitions."""
     pass
 
-  def generate_rules(self, project_configs, global_config):
-    """Generates rules dictionary for the given project and global configs."""
+  def generate_rules(self, project_configs, global_config, fragment_cache=None):
+    """Generates rules dictionary for the given project and global configs.
+
+    Args:
+      project_configs (List[ProjectConfig]): All configurations for projects.
+      global_config (dict): A dictionary of global configuration values.
+      fragment_cache (RuleFragmentCache): If set, project-specific rules are
+        reused from previous runs for projects that did not change.
+
+    Returns:
+      dict: The rules, under 'rules'.
+    """
     # Get generic rules that apply to all projects.
     rules = self._get_global_rules(global_config, project_configs)
     # Append project-specific rules.
     for project in project_configs:
-      rules.extend(self._get_project_rules(project, global_config))
+      if fragment_cache is None:
+        rules.extend(self._get_project_rules(project, global_config))
+      else:
+        rules.extend(
+            fragment_cache.get_project_rules(self.config_file_name(), project,
+                                             global_config,
+                                             self._get_project_rules))
     return {'rules': rules}
 
   def _get_global_rules(self, global_config, project_configs):
@@ -11,8 +11,6 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import re
-
 from deploy.rule_generator.scanners import base_scanner_rules
 
 # Empty whitelists aren't supported, so use this entry for whitelists that will
@@ -33,38 +31,22 @@ class IamScannerRules(base_scanner_rules.BaseScannerRules):
   def config_file_name(self):
     return 'iam_rules.yaml'
 
-  def generate_rules(self, project_configs, global_config):
-    """Generates rule dictionaries from the given configs.
-
-    Overrides BaseScannerRules.generate_rules.
+  def _get_global_rules(self, global_config, project_configs):
+    """Overrides base_scanner_rules.BaseScannerRules._get_global_rules.
 
-    Args:
-      project_configs (List[ProjectConfig]): project configs to build rules
-        from.
-      global_config (dict): global config to build rules from.
-
-    Returns:
-      List[dict]: Rule dictionaries. Each item in the list is one rule. There
-        will be global rules applicable to all projects if there is a domain set
-        as well as one rule for each project in the project configs.
+    There are global rules applicable to all projects if there is a domain set.
     """
-    project_rules = []
+    domain = global_config.get('domain')
+    if not domain:
+      return []  # No global rules if domain is not set.
 
     project_bindings = []
     bucket_bindings = []
-
     for project in project_configs:
-      # Append project-specific rules.
-      project_rules.extend(self._get_project_iam_rules(project))
-
       project_bindings.append(project.get_project_bindings())
       bucket_bindings.extend(
           bindings for _, bindings in project.get_bucket_bindings())
 
-    domain = global_config.get('domain')
-    if not domain:
-      return {'rules': project_rules}  # No global rules if domain is not set.
-
     global_rules = [
         {
             'name':
@@ -105,10 +87,12 @@ class IamScannerRules(base_scanner_rules.BaseScannerRules):
     global_rules.append(
         _get_global_whitelist_rule('bucket', _ALLOWED_BUCKET_MEMBER_FMTS,
                                    bucket_bindings, domain))
+    return global_rules
 
-    return {'rules': global_rules + project_rules}
+  def _get_project_rules(self, project, global_config):
+    """Overrides base_scanner_rules.BaseScannerRules._get_project_rules."""
+    del global_config  # Unused.
 
-  def _get_project_iam_rules(self, project):
     # Generate a narrower whitelist for each project and bucket. These rules
     # could also be duplicated as an additional 'required' rule to enforce an
     # exact match.
@@ -149,12 +133,9 @@ def _get_global_whitelist_rule(resource_type, standard_members, bindings_list,
       for member in standard_members
   ]
 
-  # convert wildcarded members into a single regex
-  escaped_members = [re.escape(member) for member in formatted_members]
-  regex = re.compile('|'.join(escaped_members).replace('\\*', '.+'))
-
   # members not captured by the initial standard members
-  unmatched_members = _get_unmatched_members_from_bindings(bindings_list, regex)
+  unmatched_members = _get_unmatched_members_from_bindings(
+      bindings_list, _MemberMatcher(formatted_members))
 
   rule = {
       'name': 'Global whitelist of allowed members for {} roles'.format(
@@ -174,22 +155,70 @@ def _get_global_whitelist_rule(resource_type, standard_members, bindings_list,
   return rule
 
 
-def _get_unmatched_members_from_bindings(bindings_list, regex):
-  """Get all binding members that do not match the regex.
+def _get_unmatched_members_from_bindings(bindings_list, matcher):
+  """Get all binding members that do not match the matcher.
 
   Args:
     bindings_list(List[Dict[str, List[str]]]): List of binding dicts
       (role to members).
-    regex (Regex): regex to match members to.
+    matcher (_MemberMatcher): matcher to match members to.
 
   Returns:
-     Set[str]: members that did not match the given regex.
+     Set[str]: members that did not match the given matcher.
   """
-  unmatched_members = set()
+  # The same members (e.g. owners groups) are bound to many roles and
+  # resources, so only match each distinct member once.
+  members = set()
   for bindings in bindings_list:
-    for members in bindings.values():
-      unmatched_members.update(m for m in members if not regex.match(m))
-  return unmatched_members
+    for role_members in bindings.values():
+      members.update(role_members)
+  return {m for m in members if not matcher.matches(m)}
+
+
+class _MemberMatcher(object):
+  """Matches members against member patterns with wildcards.
+
+  A '*' in a pattern matches one or more characters, and a member matches a
+  pattern if it starts with a match of it (e.g. 'group:*@domain.com' matches
+  'group:a@domain.com'). Patterns are split into their literal parts once, and
+  indexed by the member type (the part before ':') they are for.
+  """
+
+  def __init__(self, patterns):
+    # Map from member type to the literal parts of the patterns for it.
+    self._patterns_by_type = {}
+    # Parts of patterns whose member type is itself a wildcard.
+    self._any_type_patterns = []
+    for pattern in patterns:
+      parts = pattern.split('*')
+      member_type, sep, _ = parts[0].partition(':')
+      if sep:
+        self._patterns_by_type.setdefault(member_type, []).append(parts)
+      else:
+        self._any_type_patterns.append(parts)
+
+  def matches(self, member):
+    """Returns whether the member matches any pattern."""
+    member_type = member.partition(':')[0]
+    candidates = self._patterns_by_type.get(member_type, [])
+    return any(
+        _matches_parts(member, parts)
+        for parts in candidates + self._any_type_patterns)
+
+
+def _matches_parts(member, parts):
+  """Returns whether a member starts with a match of a pattern's parts."""
+  if not member.startswith(parts[0]):
+    return False
+  pos = len(parts[0])
+  for part in parts[1:]:
+    # The wildcard before the part matches at least one character. Taking the
+    # first occurrence of the part leaves the most room for the rest.
+    index = member.find(part, pos + 1)
+    if index == -1:
+      return False
+    pos = index + len(part)
+  return True
 
 
 def _get_project_rule(name, mode, resource_type, resource_ids, binding_dict):
@@ -4,6 +4,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import re
+
 from absl.testing import absltest
 
 import yaml
@@ -250,6 +252,37 @@ class IamScannerRulesTest(absltest.TestCase):
     want_rules['rules'] = want_rules['rules'][4:]  # trim global rules
     self.assertEqual(got_rules, want_rules)
 
+  def test_member_matcher(self):
+    patterns = [
+        'group:*@domain.com',
+        'serviceAccount:*.gserviceaccount.com',
+        'user:*@domain.com',
+        'domain:domain.com',
+        '*:*-owners@*',
+    ]
+    members = [
+        'group:a@domain.com',
+        'group:@domain.com',
+        'group:a@other.com',
+        'group:a@domain.com.other.com',
+        'user:a@domain.com',
+        'user:a@other.com',
+        'serviceAccount:a@b.iam.gserviceaccount.com',
+        'serviceAccount:.gserviceaccount.com',
+        'domain:domain.com',
+        'domain:domain.community',
+        'specialGroup:x-owners@y',
+        'specialGroup:x-owners@',
+        'allAuthenticatedUsers',
+    ]
+    # Members match patterns the way the regex translating the patterns would.
+    regex = re.compile('|'.join(re.escape(p) for p in patterns).replace(
+        '\\*', '.+'))
+    matcher = isr._MemberMatcher(patterns)
+    for member in members:
+      self.assertEqual(
+          matcher.matches(member), bool(regex.match(member)), msg=member)
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -19,111 +19,17 @@ class LocationScannerRules(base_scanner_rules.BaseScannerRules):
   def config_file_name(self):
     return 'location_rules.yaml'
 
-  def generate_rules(self, project_configs, global_config):
-    """Gets project specific location rules.
+  def _get_global_rules(self, global_config, project_configs):
+    """Overrides base_scanner_rules.BaseScannerRules._get_global_rules.
 
-    A location whitelist is created for each location set for a resource.
-    The locations are joined to form a single global whitelist rule as well.
-
-    Args:
-      project_configs (List[ProjectConfig]): project config to build rules from.
-      global_config (dict): global config to build rules from.
-
-    Returns:
-      List[dict] - The rules dictionaries.
+    The locations of all projects' resources are joined to form a single
+    global whitelist rule.
     """
-    project_rules = []
-
     all_locs = set()
+    for project in project_configs:
+      all_locs.update(_get_resource_locations(project))
 
-    for project_config in project_configs:
-      loc_to_resource_map = collections.defaultdict(
-          lambda: collections.defaultdict(list))
-
-      for bucket in project_config.get_buckets():
-        loc = bucket.location.upper()
-        loc_to_resource_map[loc]['bucket'].append(bucket.id)
-
-      for dataset in project_config.bigquery_datasets:
-        loc = dataset['location'].upper()
-        dataset_id = '{}:{}'.format(project_config.project_id, dataset['name'])
-        loc_to_resource_map[loc]['dataset'].append(dataset_id)
-
-      for gce_instance in project_config.get_gce_instances():
-        loc = gce_instance.location.upper()
-        loc_to_resource_map[loc]['instance'].append(gce_instance.id)
-
-      locs = sorted(loc_to_resource_map.keys())
-      all_locs.update(locs)
-
-      for loc in locs:
-        resource_map = loc_to_resource_map[loc]
-        applies_to = [{
-            'type': res_type,
-            'resource_ids': res_ids,
-        } for res_type, res_ids in resource_map.items()]
-
-        project_rules.append({
-            'name':
-                'Project {} resource whitelist for location {}.'.format(
-                    project_config.project_id, loc),
-            'mode':
-                'whitelist',
-            'resource': [{
-                'type': 'project',
-                'resource_ids': [project_config.project_id],
-            }],
-            'applies_to':
-                applies_to,
-            'locations': [loc],
-        })
-
-      audit_log_bucket = project_config.get_audit_log_bucket()
-      if audit_log_bucket:
-        project_rules.append({
-            'name':
-                'Project {} audit logs bucket location whitelist.'.format(
-                    project_config.project_id),
-            'mode':
-                'whitelist',
-            'resource': [{
-                'type': 'project',
-                'resource_ids': [project_config.audit_logs_project_id],
-            }],
-            'applies_to': [{
-                'type': 'bucket',
-                'resource_ids': [audit_log_bucket.id],
-            }],
-            'locations': [audit_log_bucket.location],
-        })
-
-      if project_config.audit_logs_bigquery_dataset:
-        project_rules.append({
-            'name':
-                'Project {} audit logs dataset location whitelist.'.format(
-                    project_config.project_id),
-            'mode':
-                'whitelist',
-            'resource': [{
-                'type': 'project',
-                'resource_ids': [project_config.audit_logs_project_id],
-            }],
-            'applies_to': [{
-                'type':
-                    'dataset',
-                'resource_ids': [
-                    '{}:{}'.format(
-                        project_config.audit_logs_project_id,
-                        project_config.audit_logs_bigquery_dataset['name'],
-                    )
-                ],
-            }],
-            'locations': [
-                project_config.audit_logs_bigquery_dataset['location']
-            ],
-        })
-
-    global_rule = {
+    return [{
         'name': 'Global location whitelist.',
         'mode': 'whitelist',
         'resource': self._get_resources(global_config, project_configs),
@@ -132,5 +38,109 @@ class LocationScannerRules(base_scanner_rules.BaseScannerRules):
             'resource_ids': ['*'],
         }],
         'locations': sorted(list(all_locs)),
-    }
-    return {'rules': [global_rule] + project_rules}
+    }]
+
+  def _get_project_rules(self, project, global_config):
+    """Overrides base_scanner_rules.BaseScannerRules._get_project_rules.
+
+    A location whitelist is created for each location set for a resource.
+    """
+    del global_config  # Unused.
+
+    rules = []
+    loc_to_resource_map = _get_resource_locations(project)
+
+    for loc in sorted(loc_to_resource_map.keys()):
+      resource_map = loc_to_resource_map[loc]
+      applies_to = [{
+          'type': res_type,
+          'resource_ids': res_ids,
+      } for res_type, res_ids in resource_map.items()]
+
+      rules.append({
+          'name':
+              'Project {} resource whitelist for location {}.'.format(
+                  project.project_id, loc),
+          'mode':
+              'whitelist',
+          'resource': [{
+              'type': 'project',
+              'resource_ids': [project.project_id],
+          }],
+          'applies_to':
+              applies_to,
+          'locations': [loc],
+      })
+
+    audit_log_bucket = project.get_audit_log_bucket()
+    if audit_log_bucket:
+      rules.append({
+          'name':
+              'Project {} audit logs bucket location whitelist.'.format(
+                  project.project_id),
+          'mode':
+              'whitelist',
+          'resource': [{
+              'type': 'project',
+              'resource_ids': [project.audit_logs_project_id],
+          }],
+          'applies_to': [{
+              'type': 'bucket',
+              'resource_ids': [audit_log_bucket.id],
+          }],
+          'locations': [audit_log_bucket.location],
+      })
+
+    if project.audit_logs_bigquery_dataset:
+      rules.append({
+          'name':
+              'Project {} audit logs dataset location whitelist.'.format(
+                  project.project_id),
+          'mode':
+              'whitelist',
+          'resource': [{
+              'type': 'project',
+              'resource_ids': [project.audit_logs_project_id],
+          }],
+          'applies_to': [{
+              'type':
+                  'dataset',
+              'resource_ids': [
+                  '{}:{}'.format(
+                      project.audit_logs_project_id,
+                      project.audit_logs_bigquery_dataset['name'],
+                  )
+              ],
+          }],
+          'locations': [project.audit_logs_bigquery_dataset['location']],
+      })
+
+    return rules
+
+
+def _get_resource_locations(project):
+  """Gets the IDs of a project's resources in each location, by type.
+
+  Args:
+    project (ProjectConfig): Configuration for a single project.
+
+  Returns:
+    Dict[str, Dict[str, List[str]]]: A map from upper-case location to a map
+      from resource type to the IDs of the resources in that location.
+  """
+  loc_to_resource_map = collections.defaultdict(
+      lambda: collections.defaultdict(list))
+
+  for bucket in project.get_buckets():
+    loc = bucket.location.upper()
+    loc_to_resource_map[loc]['bucket'].append(bucket.id)
+
+  for dataset in project.bigquery_datasets:
+    loc = dataset['location'].upper()
+    dataset_id = '{}:{}'.format(project.project_id, dataset['name'])
+    loc_to_resource_map[loc]['dataset'].append(dataset_id)
+
+  for gce_instance in project.get_gce_instances():
+    loc = gce_instance.location.upper()
+    loc_to_resource_map[loc]['instance'].append(gce_instance.id)
+  return loc_to_resource_map
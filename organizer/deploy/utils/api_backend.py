@@ -0,0 +1,325 @@
+"""Backend running gcloud commands in-process through the Google API clients.
+
+Spawning gcloud costs an interpreter and authentication start up per command.
+ApiBackend runs the gcloud commands most used by the deployment scripts through
+authenticated API clients that are reused across commands, and falls back to
+another backend (usually spawning gcloud) for all other commands.
+
+The Google API client libraries are optional. Use is_available() to check if
+they are installed.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import json
+import subprocess
+import threading
+import time
+
+from deploy.utils import retry_policy
+
+try:
+  # pylint: disable=g-import-not-at-top
+  import google.auth
+  from googleapiclient import discovery
+  from googleapiclient import errors
+except ImportError:
+  google = None
+  discovery = None
+  errors = None
+
+# Errors raised by the API clients, converted to CalledProcessError.
+_API_ERRORS = (errors.HttpError,) if errors else ()
+
+_SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+
+# Flags taking a value which are understood by the command handlers.
+_VALUE_FLAGS = frozenset(['--format', '--member', '--project', '--role'])
+
+# Polling intervals for long running operations.
+_OPERATION_INITIAL_POLL_SECS = 1
+_OPERATION_MAX_POLL_SECS = 10
+
+# Attempts and backoff of IAM policy read-modify-writes whose etag conflicts
+# with a concurrent update.
+_MAX_POLICY_ATTEMPTS = 5
+_POLICY_RETRY_INITIAL_SECS = 1
+_POLICY_RETRY_MAX_SECS = 10
+
+# HTTP status of requests conflicting with a concurrent update.
+_CONFLICT_STATUS = 409
+
+
+def is_available():
+  """Returns whether the Google API client libraries are installed."""
+  return discovery is not None
+
+
+def _build_client(api, version, credentials):
+  """Builds an API client from the discovery document of the given API."""
+  return discovery.build(
+      api, version, credentials=credentials, cache_discovery=False)
+
+
+class ApiBackend(object):
+  """Runs supported gcloud commands through Google API clients."""
+
+  def __init__(self, fallback, client_factory=None, credentials=None):
+    """Initialize.
+
+    Args:
+      fallback: The backend to run unsupported commands with.
+      client_factory (Callable): Builds a client given an API name, version and
+        credentials. Defaults to building clients from discovery documents.
+      credentials: Credentials for the clients. Defaults to the application
+        default credentials.
+    """
+    self._fallback = fallback
+    self._client_factory = client_factory or _build_client
+    self._credentials = credentials
+    self._credentials_lock = threading.Lock()
+    # API clients are not thread safe, so keep a pool of clients per thread.
+    self._local = threading.local()
+
+  def check_call(self, cmd):
+    """Runs a command without capturing its output."""
+    return self._fallback.check_call(cmd)
+
+  def check_output(self, cmd):
+    """Runs a command and returns its output as bytes.
+
+    Args:
+      cmd (List[str]): The command to run.
+
+    Returns:
+      bytes: The output of the command, formatted as gcloud would.
+
+    Raises:
+      CalledProcessError: if the API returns an error.
+    """
+    parsed = _parse_gcloud_command(cmd)
+    handler = None
+    if parsed:
+      positionals, flag_values = parsed
+      for prefix, func in _HANDLERS:
+        if tuple(positionals[:len(prefix)]) == prefix:
+          handler = func
+          break
+    if handler is None:
+      return self._fallback.check_output(cmd)
+
+    try:
+      output = handler(self, positionals, flag_values)
+    except _API_ERRORS as e:
+      raise subprocess.CalledProcessError(1, cmd, output=str(e).encode())
+    if output is None:
+      return self._fallback.check_output(cmd)
+    return output.encode()
+
+  def client(self, api, version):
+    """Gets the client for the given API for the current thread."""
+    clients = getattr(self._local, 'clients', None)
+    if clients is None:
+      clients = self._local.clients = {}
+    key = (api, version)
+    if key not in clients:
+      clients[key] = self._client_factory(api, version,
+                                          self._get_credentials())
+    return clients[key]
+
+  def _get_credentials(self):
+    """Gets the credentials, loading the default ones on first use."""
+    with self._credentials_lock:
+      if self._credentials is None and google is not None:
+        self._credentials, _ = google.auth.default(scopes=_SCOPES)
+      return self._credentials
+
+  def wait_for_operation(self, operations, operation):
+    """Polls a long running operation until it is done."""
+    delay = _OPERATION_INITIAL_POLL_SECS
+    while not operation.get('done'):
+      time.sleep(delay)
+      delay = min(delay * 2, _OPERATION_MAX_POLL_SECS)
+      operation = operations.get(name=operation['name']).execute()
+    if 'error' in operation:
+      raise subprocess.CalledProcessError(
+          1, operation['name'], output=json.dumps(operation['error']).encode())
+    return operation
+
+
+def _parse_gcloud_command(cmd):
+  """Splits a gcloud command into positional arguments and flag values.
+
+  Args:
+    cmd (List[str]): The gcloud command.
+
+  Returns:
+    (List[str], dict): The positional arguments and the flag values, or None if
+      the command is not a gcloud command or uses flags not known to take a
+      value.
+  """
+  if not cmd or cmd[0] != 'gcloud':
+    return None
+  positionals = []
+  flag_values = {}
+  args = iter(cmd[1:])
+  for arg in args:
+    if not arg.startswith('--'):
+      positionals.append(arg)
+      continue
+    name, sep, value = arg.partition('=')
+    if name not in _VALUE_FLAGS:
+      return None
+    if not sep:
+      value = next(args, None)
+      if value is None:
+        return None
+    flag_values[name] = value
+  return positionals, flag_values
+
+
+def _describe_project(backend, positionals, flag_values):
+  """Handles `projects describe PROJECT --format value(projectNumber)`."""
+  if len(positionals) != 3 or flag_values.get(
+      '--format') != 'value(projectNumber)':
+    return None
+  project = backend.client('cloudresourcemanager', 'v1').projects().get(
+      projectId=positionals[2]).execute()
+  return project['projectNumber']
+
+
+def _get_iam_policy(backend, positionals, flag_values):
+  """Handles `projects get-iam-policy PROJECT --format json`."""
+  if len(positionals) != 3 or flag_values.get('--format') != 'json':
+    return None
+  policy = backend.client('cloudresourcemanager', 'v1').projects(
+  ).getIamPolicy(resource=positionals[2], body={}).execute()
+  return json.dumps(policy)
+
+
+def _is_conflict(error):
+  """Returns whether an API error is due to a concurrent update."""
+  resp = getattr(error, 'resp', None)
+  return getattr(resp, 'status', None) == _CONFLICT_STATUS
+
+
+def _set_binding_member(policy, role, member, add):
+  """Adds or removes a member from a role in a policy."""
+  bindings = policy.setdefault('bindings', [])
+  binding = next((b for b in bindings if b['role'] == role), None)
+  if add:
+    if binding is None:
+      binding = {'role': role, 'members': []}
+      bindings.append(binding)
+    if member not in binding['members']:
+      binding['members'].append(member)
+  elif binding is not None and member in binding['members']:
+    binding['members'].remove(member)
+    if not binding['members']:
+      bindings.remove(binding)
+
+
+def _modify_iam_policy_binding(add):
+  """Gets a handler which adds or removes a member from a project role."""
+
+  def handler(backend, positionals, flag_values):
+    """Handles `projects add|remove-iam-policy-binding PROJECT`."""
+    if (len(positionals) != 3 or '--member' not in flag_values or
+        '--role' not in flag_values or '--format' in flag_values):
+      return None
+    project_id = positionals[2]
+    projects = backend.client('cloudresourcemanager', 'v1').projects()
+    for attempt in itertools.count(1):
+      policy = projects.getIamPolicy(resource=project_id, body={}).execute()
+      _set_binding_member(policy, flag_values['--role'],
+                          flag_values['--member'], add)
+      # The policy's etag makes the update fail if it was concurrently
+      # modified, in which case the whole read-modify-write is retried.
+      try:
+        policy = projects.setIamPolicy(
+            resource=project_id, body={'policy': policy}).execute()
+      except _API_ERRORS as e:
+        if not _is_conflict(e) or attempt >= _MAX_POLICY_ATTEMPTS:
+          raise
+        time.sleep(
+            retry_policy.get_backoff_secs(attempt, _POLICY_RETRY_INITIAL_SECS,
+                                          _POLICY_RETRY_MAX_SECS))
+        continue
+      return json.dumps(policy)
+
+  return handler
+
+
+def _enable_services(backend, positionals, flag_values):
+  """Handles `services enable SERVICE...` and waits for the operation."""
+  project_id = flag_values.get('--project')
+  if len(positionals) < 3 or not project_id or '--format' in flag_values:
+    return None
+  client = backend.client('serviceusage', 'v1')
+  operation = client.services().batchEnable(
+      parent='projects/{}'.format(project_id),
+      body={'serviceIds': positionals[2:]}).execute()
+  backend.wait_for_operation(client.operations(), operation)
+  return ''
+
+
+def _list_services(backend, positionals, flag_values):
+  """Handles `services list --format value(NAME)`."""
+  project_id = flag_values.get('--project')
+  if (len(positionals) != 2 or not project_id or
+      flag_values.get('--format') != 'value(NAME)'):
+    return None
+  services = backend.client('serviceusage', 'v1').services()
+  request = services.list(
+      parent='projects/{}'.format(project_id), filter='state:ENABLED')
+  names = []
+  while request is not None:
+    response = request.execute()
+    names.extend(s['config']['name'] for s in response.get('services', []))
+    request = services.list_next(request, response)
+  return '\n'.join(names)
+
+
+def _list_deployments(backend, positionals, flag_values):
+  """Handles `deployment-manager deployments list --format json`."""
+  project_id = flag_values.get('--project')
+  if (len(positionals) != 3 or not project_id or
+      flag_values.get('--format') != 'json'):
+    return None
+  deployments = backend.client('deploymentmanager', 'v2').deployments()
+  request = deployments.list(project=project_id)
+  results = []
+  while request is not None:
+    response = request.execute()
+    results.extend(response.get('deployments', []))
+    request = deployments.list_next(request, response)
+  return json.dumps(results)
+
+
+def _describe_deployment(backend, positionals, flag_values):
+  """Handles `deployment-manager deployments describe DEPLOYMENT`."""
+  project_id = flag_values.get('--project')
+  if len(positionals) != 4 or not project_id or '--format' in flag_values:
+    return None
+  deployment = backend.client('deploymentmanager', 'v2').deployments().get(
+      project=project_id, deployment=positionals[3]).execute()
+  return json.dumps(deployment)
+
+
+# Handlers of supported commands, keyed by their leading positional arguments.
+# A handler returns the command output, or None if it does not support the
+# given arguments.
+_HANDLERS = [
+    (('projects', 'describe'), _describe_project),
+    (('projects', 'get-iam-policy'), _get_iam_policy),
+    (('projects', 'add-iam-policy-binding'), _modify_iam_policy_binding(True)),
+    (('projects', 'remove-iam-policy-binding'),
+     _modify_iam_policy_binding(False)),
+    (('services', 'enable'), _enable_services),
+    (('services', 'list'), _list_services),
+    (('deployment-manager', 'deployments', 'list'), _list_deployments),
+    (('deployment-manager', 'deployments', 'describe'), _describe_deployment),
+]
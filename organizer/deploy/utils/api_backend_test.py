@@ -0,0 +1,167 @@
+"""Tests for deploy.utils.api_backend."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import subprocess
+import time
+import unittest.mock
+
+from absl.testing import absltest
+
+from deploy.utils import api_backend
+
+
+class _FakeHttpError(Exception):
+  """Error with an HTTP status, like googleapiclient.errors.HttpError."""
+
+  def __init__(self, status):
+    super(_FakeHttpError, self).__init__('HTTP {}'.format(status))
+    self.resp = unittest.mock.Mock(status=status)
+
+
+class ApiBackendTest(absltest.TestCase):
+
+  def setUp(self):
+    super(ApiBackendTest, self).setUp()
+    self.fallback = unittest.mock.Mock()
+    self.fallback.check_output.return_value = b'fallback'
+    self.clients = {}
+    self.backend = api_backend.ApiBackend(
+        self.fallback,
+        client_factory=self._get_client,
+        credentials='fake-credentials')
+
+  def _get_client(self, api, version, credentials):
+    self.assertEqual(credentials, 'fake-credentials')
+    return self.clients.setdefault((api, version), unittest.mock.MagicMock())
+
+  def test_describe_project(self):
+    crm = self._get_client('cloudresourcemanager', 'v1', 'fake-credentials')
+    crm.projects().get().execute.return_value = {'projectNumber': '1234'}
+
+    output = self.backend.check_output([
+        'gcloud', 'projects', 'describe', 'my-project', '--format',
+        'value(projectNumber)'
+    ])
+
+    self.assertEqual(output, b'1234')
+    crm.projects().get.assert_called_with(projectId='my-project')
+    self.fallback.check_output.assert_not_called()
+
+  def test_list_deployments(self):
+    dm = self._get_client('deploymentmanager', 'v2', 'fake-credentials')
+    dm.deployments().list().execute.return_value = {
+        'deployments': [{'name': 'data-project-deployment'}]
+    }
+    dm.deployments().list_next.return_value = None
+
+    output = self.backend.check_output([
+        'gcloud', 'deployment-manager', 'deployments', 'list', '--format',
+        'json', '--project', 'my-project'
+    ])
+
+    self.assertEqual(
+        json.loads(output.decode()), [{'name': 'data-project-deployment'}])
+
+  def test_add_iam_policy_binding(self):
+    crm = self._get_client('cloudresourcemanager', 'v1', 'fake-credentials')
+    crm.projects().getIamPolicy().execute.return_value = {
+        'etag': 'abc',
+        'bindings': [{'role': 'roles/owner', 'members': ['group:a@b.com']}],
+    }
+    crm.projects().setIamPolicy().execute.return_value = {}
+
+    self.backend.check_output([
+        'gcloud', 'projects', 'add-iam-policy-binding', 'my-project',
+        '--member', 'serviceAccount:sa@x.com', '--role', 'roles/viewer'
+    ])
+
+    crm.projects().setIamPolicy.assert_called_with(
+        resource='my-project',
+        body={
+            'policy': {
+                'etag': 'abc',
+                'bindings': [
+                    {'role': 'roles/owner', 'members': ['group:a@b.com']},
+                    {'role': 'roles/viewer',
+                     'members': ['serviceAccount:sa@x.com']},
+                ],
+            }
+        })
+
+  def test_modify_iam_policy_binding_retries_conflicts(self):
+    crm = self._get_client('cloudresourcemanager', 'v1', 'fake-credentials')
+    policies = [{'etag': 'abc'}, {'etag': 'def'}]
+    crm.projects().getIamPolicy().execute.side_effect = (
+        lambda: policies.pop(0))
+    crm.projects().setIamPolicy().execute.side_effect = [
+        _FakeHttpError(409), {}
+    ]
+    self.enter_context(unittest.mock.patch.object(time, 'sleep'))
+    self.enter_context(
+        unittest.mock.patch.object(api_backend, '_API_ERRORS',
+                                   (_FakeHttpError,)))
+
+    self.backend.check_output([
+        'gcloud', 'projects', 'add-iam-policy-binding', 'my-project',
+        '--member', 'serviceAccount:sa@x.com', '--role', 'roles/viewer'
+    ])
+
+    # The policy is read again, so the update has the new etag.
+    self.assertEqual(
+        crm.projects().setIamPolicy.call_args[1]['body']['policy']['etag'],
+        'def')
+
+  def test_modify_iam_policy_binding_does_not_retry_other_errors(self):
+    crm = self._get_client('cloudresourcemanager', 'v1', 'fake-credentials')
+    crm.projects().getIamPolicy().execute.return_value = {'etag': 'abc'}
+    crm.projects().setIamPolicy().execute.side_effect = _FakeHttpError(403)
+    self.enter_context(
+        unittest.mock.patch.object(api_backend, '_API_ERRORS',
+                                   (_FakeHttpError,)))
+
+    with self.assertRaises(subprocess.CalledProcessError):
+      self.backend.check_output([
+          'gcloud', 'projects', 'add-iam-policy-binding', 'my-project',
+          '--member', 'serviceAccount:sa@x.com', '--role', 'roles/viewer'
+      ])
+    self.assertEqual(crm.projects().setIamPolicy().execute.call_count, 1)
+
+  def test_enable_services_waits_for_operation(self):
+    serviceusage = self._get_client('serviceusage', 'v1', 'fake-credentials')
+    serviceusage.services().batchEnable().execute.return_value = {
+        'name': 'operations/1',
+        'done': True,
+    }
+
+    output = self.backend.check_output([
+        'gcloud', 'services', 'enable', 'compute.googleapis.com',
+        'iam.googleapis.com', '--project', 'my-project'
+    ])
+
+    self.assertEqual(output, b'')
+    serviceusage.services().batchEnable.assert_called_with(
+        parent='projects/my-project',
+        body={'serviceIds': ['compute.googleapis.com', 'iam.googleapis.com']})
+
+  def test_unsupported_commands_fall_back(self):
+    cmds = [
+        ['gsutil', 'ls', '-p', 'my-project'],
+        ['gcloud', 'projects', 'create', 'my-project'],
+        # Known command with an unknown flag.
+        ['gcloud', 'deployment-manager', 'deployments', 'describe', 'dep',
+         '--project', 'my-project', '--verbosity', 'debug'],
+        # Known command with an unsupported format.
+        ['gcloud', 'projects', 'describe', 'my-project', '--format', 'json'],
+    ]
+    for cmd in cmds:
+      self.assertEqual(self.backend.check_output(cmd), b'fallback')
+      self.fallback.check_output.assert_called_with(cmd)
+    self.assertEmpty(self.clients)
+
+
+if __name__ == '__main__':
+  absltest.main()
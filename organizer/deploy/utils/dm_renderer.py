@@ -0,0 +1,224 @@
+"""dm_renderer expands Deployment Manager configs locally.
+
+Deployment Manager expands Python templates server-side, so template errors
+are otherwise only found once a deployment is submitted. Renderer runs the
+templates' generate_config(context) functions locally with a context like the
+one Deployment Manager passes, recursively expanding resources whose type is
+another template (e.g. subnetwork.py used by network.py).
+
+Compiled templates and expansions are cached, keyed by the template source and
+the context the template is run with, so expanding many configs sharing the
+same templates is fast.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import copy
+import hashlib
+import json
+import os
+import threading
+
+import ruamel.yaml
+
+# Maximum depth of templates expanding to other templates.
+_MAX_EXPANSION_DEPTH = 10
+
+
+class RenderError(Exception):
+  """The exception when a config cannot be expanded."""
+  pass
+
+
+class Context(object):
+  """The context a template's generate_config function is called with.
+
+  Attributes:
+    env (dict): The deployment, name, project, project_number and type of the
+      resource being expanded.
+    properties (dict): The properties of the resource, with the defaults of
+      the template's schema applied.
+    imports (dict): The contents of the config's imports, keyed by name.
+  """
+
+  def __init__(self, env, properties, imports):
+    self.env = env
+    self.properties = properties
+    self.imports = imports
+
+
+class _Template(object):
+  """A compiled template and the defaults of its schema's properties."""
+
+  def __init__(self, path, source):
+    self.path = path
+    self.source = source
+    self.digest = hashlib.sha256(source.encode()).hexdigest()
+    namespace = {'__name__': os.path.splitext(os.path.basename(path))[0]}
+    try:
+      exec(compile(source, path, 'exec'), namespace)  # pylint: disable=exec-used
+    except Exception as e:  # pylint: disable=broad-except
+      raise RenderError('Failed to load template {}: {}'.format(path, e))
+    if 'generate_config' not in namespace:
+      raise RenderError('Template {} has no generate_config function'.format(
+          path))
+    self.generate_config = namespace['generate_config']
+
+    self.defaults = {}
+    schema_path = path + '.schema'
+    if os.path.exists(schema_path):
+      with open(schema_path) as f:
+        schema = ruamel.yaml.YAML(typ='safe').load(f) or {}
+      for name, prop in (schema.get('properties') or {}).items():
+        if isinstance(prop, dict) and 'default' in prop:
+          self.defaults[name] = prop['default']
+
+
+# The imports of a config: paths and contents keyed by name, and a digest of
+# the contents.
+_Imports = collections.namedtuple('_Imports', ['paths', 'contents', 'digest'])
+
+
+class Renderer(object):
+  """Expands Deployment Manager configs with Python templates locally."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # Compiled templates, keyed by path and modification time.
+    self._templates = {}
+    # Expansions, keyed by template digest and a digest of the context.
+    self._expansions = {}
+    self.hits = 0
+    self.misses = 0
+
+  def render(self, config, project_id, deployment, project_number=None):
+    """Expands a Deployment Manager config.
+
+    Args:
+      config (dict): The Deployment Manager config, with 'imports' holding the
+        paths of the templates it uses and 'resources'.
+      project_id (str): The project the config is deployed in.
+      deployment (str): The name of the deployment.
+      project_number (str): The number of the project, if known.
+
+    Returns:
+      dict: The expanded config, with 'resources' holding only resources of
+        base types (and 'outputs' of the config, if any).
+
+    Raises:
+      RenderError: if a template fails to load or expand.
+    """
+    imports = {}
+    import_contents = {}
+    for imp in config.get('imports', []):
+      path = imp['path']
+      name = imp.get('name', os.path.basename(path))
+      imports[name] = path
+      with open(path) as f:
+        import_contents[name] = f.read()
+    imports_digest = hashlib.sha256(
+        json.dumps(import_contents, sort_keys=True).encode()).hexdigest()
+    env = {
+        'deployment': deployment,
+        'project': project_id,
+        'project_number': project_number or '',
+    }
+    expanded = {
+        'resources':
+            self._expand_resources(
+                config.get('resources', []), _Imports(imports, import_contents,
+                                                      imports_digest), env,
+                None, 0)
+    }
+    if 'outputs' in config:
+      expanded['outputs'] = copy.deepcopy(config['outputs'])
+    return expanded
+
+  def _expand_resources(self, resources, imports, env, parent_dir, depth):
+    """Recursively expands resources whose type is a template."""
+    expanded = []
+    for resource in resources:
+      resource_type = resource.get('type', '')
+      path = self._find_template(resource_type, imports.paths, parent_dir)
+      if path is None:
+        expanded.append(copy.deepcopy(resource))
+        continue
+      if depth >= _MAX_EXPANSION_DEPTH:
+        raise RenderError('Templates nested too deeply at {}'.format(
+            resource.get('name')))
+      template = self._get_template(path)
+      resource_env = dict(env, name=resource['name'], type=resource_type)
+      result = self._generate(template, resource_env,
+                              resource.get('properties', {}), imports)
+      expanded.extend(
+          self._expand_resources(
+              result.get('resources', []), imports, env, os.path.dirname(path),
+              depth + 1))
+    return expanded
+
+  def _find_template(self, resource_type, imports, parent_dir):
+    """Gets the path of the template a resource type refers to, if any."""
+    if resource_type in imports:
+      return imports[resource_type]
+    if not resource_type.endswith('.py'):
+      return None
+    if os.path.isabs(resource_type):
+      return resource_type
+    if parent_dir:
+      # Templates may use templates imported by their schema, which are found
+      # next to them.
+      path = os.path.join(parent_dir, resource_type)
+      if os.path.exists(path):
+        return path
+    raise RenderError('Template {} is not imported'.format(resource_type))
+
+  def _get_template(self, path):
+    """Gets a compiled template, loading it if it changed."""
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    with self._lock:
+      template = self._templates.get(key)
+    if template is None:
+      with open(path) as f:
+        template = _Template(path, f.read())
+      with self._lock:
+        self._templates[key] = template
+    return template
+
+  def _generate(self, template, env, properties, imports):
+    """Runs a template's generate_config, through the expansion cache."""
+    properties = dict(copy.deepcopy(template.defaults),
+                      **copy.deepcopy(properties))
+    key = (template.digest, imports.digest,
+           hashlib.sha256(
+               json.dumps([env, properties], sort_keys=True,
+                          default=str).encode()).hexdigest())
+    with self._lock:
+      cached = self._expansions.get(key)
+      if cached is not None:
+        self.hits += 1
+        return copy.deepcopy(cached)
+      self.misses += 1
+
+    try:
+      result = template.generate_config(
+          Context(env, properties, dict(imports.contents)))
+    except Exception as e:  # pylint: disable=broad-except
+      raise RenderError('Template {} failed to expand {}: {!r}'.format(
+          template.path, env['name'], e))
+    if not isinstance(result, dict) or 'resources' not in result:
+      raise RenderError('Template {} returned no resources for {}'.format(
+          template.path, env['name']))
+    with self._lock:
+      self._expansions[key] = copy.deepcopy(result)
+    return result
+
+
+_renderer = Renderer()
+
+
+def render(config, project_id, deployment, project_number=None):
+  """Expands a Deployment Manager config with the shared Renderer."""
+  return _renderer.render(config, project_id, deployment, project_number)
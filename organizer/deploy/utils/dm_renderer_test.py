@@ -0,0 +1,134 @@
+"""Tests for deploy.utils.dm_renderer."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+from absl.testing import absltest
+
+from deploy.utils import dm_renderer
+
+_NETWORK_TEMPLATE = 'deploy/config/templates/network/network.py'
+_REMOTE_AUDIT_LOGS_TEMPLATE = 'deploy/templates/remote_audit_logs.py'
+
+
+def _network_config(subnetworks):
+  return {
+      'imports': [{
+          'path': _NETWORK_TEMPLATE
+      }],
+      'resources': [{
+          'type': 'network.py',
+          'name': 'my-network',
+          'properties': {
+              'subnetworks': subnetworks,
+          },
+      }],
+  }
+
+
+class DmRendererTest(absltest.TestCase):
+
+  def test_render_nested_templates(self):
+    renderer = dm_renderer.Renderer()
+    subnetworks = [{
+        'name': 'my-subnetwork',
+        'region': 'us-central1',
+        'ipCidrRange': '10.0.0.0/24',
+    }]
+    expanded = renderer.render(
+        _network_config(subnetworks), 'my-project', 'my-deployment')
+    self.assertEqual(expanded['resources'], [
+        {
+            'type': 'compute.v1.network',
+            'name': 'my-network',
+            'properties': {
+                'name': 'my-network',
+                'autoCreateSubnetworks': False,
+            },
+        },
+        {
+            'type': 'compute.v1.subnetwork',
+            'name': 'my-subnetwork',
+            'properties': {
+                'network': '$(ref.my-network.selfLink)',
+                'ipCidrRange': '10.0.0.0/24',
+                'region': 'us-central1',
+                # Applied from the default in subnetwork.py.schema.
+                'privateIpGoogleAccess': True,
+            },
+        },
+    ])
+    # The config's properties are not modified by the template.
+    self.assertNotIn('network', subnetworks[0])
+
+  def test_render_absolute_template_path(self):
+    renderer = dm_renderer.Renderer()
+    path = os.path.abspath(_REMOTE_AUDIT_LOGS_TEMPLATE)
+    config = {
+        'imports': [{
+            'path': path
+        }],
+        'resources': [{
+            'type': path,
+            'name': 'audit-logs-my-project-gcs',
+            'properties': {
+                'owners_group': 'owners@domain.com',
+                'auditors_group': 'auditors@domain.com',
+                'logs_gcs_bucket': {
+                    'name': 'my-project-logs',
+                    'location': 'US',
+                    'storage_class': 'MULTI_REGIONAL',
+                    'ttl_days': 365,
+                },
+            },
+        }],
+    }
+    expanded = renderer.render(config, 'my-audit-project',
+                               'audit-logs-my-project-gcs')
+    self.assertEqual([r['type'] for r in expanded['resources']],
+                     ['storage.v1.bucket'])
+
+  def test_expansions_are_cached(self):
+    renderer = dm_renderer.Renderer()
+    subnetworks = [{
+        'name': 'my-subnetwork',
+        'region': 'us-central1',
+        'ipCidrRange': '10.0.0.0/24',
+    }]
+    first = renderer.render(
+        _network_config(subnetworks), 'my-project', 'my-deployment')
+    self.assertEqual((renderer.hits, renderer.misses), (0, 2))
+
+    second = renderer.render(
+        _network_config(subnetworks), 'my-project', 'my-deployment')
+    self.assertEqual(first, second)
+    self.assertEqual((renderer.hits, renderer.misses), (2, 2))
+
+    # Expanding the same network in another project is not a cache hit.
+    renderer.render(
+        _network_config(subnetworks), 'other-project', 'my-deployment')
+    self.assertEqual((renderer.hits, renderer.misses), (2, 4))
+
+  def test_template_not_imported(self):
+    config = {
+        'resources': [{
+            'type': 'missing.py',
+            'name': 'my-resource',
+        }],
+    }
+    with self.assertRaises(dm_renderer.RenderError):
+      dm_renderer.Renderer().render(config, 'my-project', 'my-deployment')
+
+  def test_template_error(self):
+    # Subnetworks require a region.
+    subnetworks = [{'name': 'my-subnetwork', 'ipCidrRange': '10.0.0.0/24'}]
+    with self.assertRaises(dm_renderer.RenderError):
+      dm_renderer.Renderer().render(
+          _network_config(subnetworks), 'my-project', 'my-deployment')
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,71 @@
+"""In-memory fake of the Cloud Storage client library, for tests.
+
+FakeClient implements the parts of google.cloud.storage.Client used by the
+deployment tools, so code uploading to GCS can be tested without credentials
+or network access.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+
+from deploy.utils import gcs_uploader
+
+
+class _FakeBlob(object):
+  """A GCS object, which exists once it has contents."""
+
+  def __init__(self, client, bucket_name, name):
+    self._client = client
+    self.bucket_name = bucket_name
+    self.name = name
+
+  @property
+  def md5_hash(self):
+    data = self._client.objects.get((self.bucket_name, self.name))
+    return None if data is None else gcs_uploader.md5_hash(data)
+
+  def upload_from_string(self, data, content_type=None, checksum=None):
+    del content_type, checksum  # Unused.
+    if isinstance(data, str):
+      data = data.encode('utf-8')
+    with self._client.lock:
+      self._client.objects[(self.bucket_name, self.name)] = data
+      self._client.uploads.append('gs://{}/{}'.format(self.bucket_name,
+                                                      self.name))
+
+
+class _FakeBucket(object):
+
+  def __init__(self, client, name):
+    self._client = client
+    self.name = name
+
+  def blob(self, name):
+    return _FakeBlob(self._client, self.name, name)
+
+
+class FakeClient(object):
+  """Fake storage client holding objects in memory.
+
+  Attributes:
+    objects (dict): The contents of each object, keyed by bucket and name.
+    uploads (List[str]): The gs:// paths of the objects uploaded, in order.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.objects = {}
+    self.uploads = []
+
+  def bucket(self, name):
+    return _FakeBucket(self, name)
+
+  def list_blobs(self, bucket_name, prefix=None):
+    with self.lock:
+      names = sorted(
+          name for bucket, name in self.objects
+          if bucket == bucket_name and name.startswith(prefix or ''))
+    return [_FakeBlob(self, bucket_name, name) for name in names]
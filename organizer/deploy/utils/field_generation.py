@@ -4,8 +4,24 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import json
+import os
+import threading
+
+from absl import flags
+from absl import logging
+
+from deploy.utils import state_store
 from deploy.utils import utils
 
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('state_db', None,
+                    ('Path of a SQLite database to keep generated_fields in, '
+                     'created if it does not exist. It is seeded from the '
+                     'project YAML, and the project YAML at --output_yaml_path '
+                     'is exported from it when a project is done.'))
+
 # The tag name of generated_fields in the new format.
 # Using different variable with the old one so that we can easily change a
 # different tag name while just changing the value of this variable.
@@ -15,6 +31,17 @@ _GENERATED_FIELDS_OLD_NAME = 'generated_fields'
 _PROJECTS_TAG = 'projects'
 _FORSETI_TAG = 'forseti'
 
+# Suffix of the journal of generated_fields changes not yet written to the
+# output YAML.
+_JOURNAL_SUFFIX = '.journal'
+
+# Guards generated_fields of a config shared by projects deployed concurrently.
+# Hold it while modifying generated_fields or writing them out.
+GENERATED_FIELDS_LOCK = threading.RLock()
+
+# Store opened for --state_db.
+_state_store = None
+
 
 def is_generated_fields_exist(project_id, input_config):
   """Check if generated_fields contains a project.
@@ -178,5 +205,163 @@ def update_generated_fields(input_yaml_path, new_config):
 
 def rewrite_generated_fields_back(project_yaml, output_yaml_path, new_config):
   """Write config file to output_yaml_path with new generated_fields."""
-  cfg_content = update_generated_fields(project_yaml, new_config)
-  utils.write_yaml_file(cfg_content, output_yaml_path)
+  with GENERATED_FIELDS_LOCK:
+    cfg_content = update_generated_fields(project_yaml, new_config)
+    utils.write_yaml_file(cfg_content, output_yaml_path, atomic=True)
+
+
+def _get_journal_path(output_yaml_path):
+  return output_yaml_path + _JOURNAL_SUFFIX
+
+
+def get_state_store():
+  """Gets the store of generated_fields opened for --state_db, if set."""
+  global _state_store
+  if not FLAGS.state_db:
+    return None
+  with GENERATED_FIELDS_LOCK:
+    if _state_store is None or _state_store.path != FLAGS.state_db:
+      _state_store = state_store.StateStore(FLAGS.state_db)
+    return _state_store
+
+
+def record_generated_fields(project_id, output_yaml_path, input_config):
+  """Saves a project's generated_fields without rewriting the output YAML.
+
+  The fields are stored in the --state_db store if set, otherwise appended to
+  the journal of the output YAML. Either is much cheaper than rewriting the
+  whole output YAML, and lets recover_generated_fields restore the fields if
+  the script dies before they are written to the output YAML.
+
+  Args:
+    project_id (str): id of the project whose generated_fields changed.
+    output_yaml_path (str): Path of the output YAML.
+    input_config (CommentedMap): The content of the whole yaml.
+  """
+  if FLAGS.dry_run:
+    return
+  store = get_state_store()
+  with GENERATED_FIELDS_LOCK:
+    entry = {
+        _PROJECTS_TAG: {
+            project_id: get_generated_fields_copy(project_id, input_config)
+        }
+    }
+    forseti_fields = get_forseti_service_generated_fields(input_config)
+    if forseti_fields:
+      entry[_FORSETI_TAG] = forseti_fields
+    if store:
+      store.put_all(entry)
+      return
+    with open(_get_journal_path(output_yaml_path), 'a') as journal:
+      journal.write(json.dumps(entry, default=str) + '\n')
+      journal.flush()
+      os.fsync(journal.fileno())
+
+
+def compact_generated_fields(project_yaml,
+                             output_yaml_path,
+                             new_config,
+                             project_id=None):
+  """Atomically writes generated_fields to the output YAML.
+
+  Without --state_db, the journal is emptied. With it, the output YAML is
+  exported from the store, so it includes projects deployed by other
+  processes sharing the store.
+
+  Args:
+    project_yaml (str): Path of the project config YAML.
+    output_yaml_path (str): Path of the output YAML.
+    new_config (CommentedMap): The content of the whole yaml.
+    project_id (str): id of the project whose generated_fields changed since
+      they were last recorded, if any.
+  """
+  with GENERATED_FIELDS_LOCK:
+    if get_state_store() and not FLAGS.dry_run:
+      if project_id:
+        record_generated_fields(project_id, output_yaml_path, new_config)
+      export_generated_fields(project_yaml, output_yaml_path)
+      return
+    rewrite_generated_fields_back(project_yaml, output_yaml_path, new_config)
+    journal_path = _get_journal_path(output_yaml_path)
+    if not FLAGS.dry_run and os.path.exists(journal_path):
+      os.remove(journal_path)
+
+
+def export_generated_fields(project_yaml, output_yaml_path):
+  """Writes the generated_fields in the --state_db store to the output YAML.
+
+  Fields of projects not in the store are kept from the project YAML.
+
+  Args:
+    project_yaml (str): Path of the project config YAML.
+    output_yaml_path (str): Path of the output YAML.
+  """
+  all_fields = utils.read_yaml_file(project_yaml).get(GENERATED_FIELDS_NAME,
+                                                      {})
+  stored_fields = get_state_store().get_all()
+  all_fields.setdefault(_PROJECTS_TAG, {}).update(stored_fields[_PROJECTS_TAG])
+  if _FORSETI_TAG in stored_fields:
+    all_fields[_FORSETI_TAG] = stored_fields[_FORSETI_TAG]
+  rewrite_generated_fields_back(project_yaml, output_yaml_path,
+                                {GENERATED_FIELDS_NAME: all_fields})
+
+
+def _apply_generated_fields(all_fields, input_config):
+  """Replaces generated_fields of the config with the given ones."""
+  for project_id, fields in all_fields.get(_PROJECTS_TAG, {}).items():
+    generated_fields = get_generated_fields_ref(project_id, input_config)
+    generated_fields.clear()
+    generated_fields.update(fields)
+  if _FORSETI_TAG in all_fields:
+    set_forseti_service_generated_fields(all_fields[_FORSETI_TAG],
+                                         input_config)
+
+
+def recover_generated_fields(project_yaml, output_yaml_path, input_config):
+  """Applies generated_fields not yet written to the YAML config.
+
+  With --state_db, the fields in the store are applied, or the store is
+  seeded from the config if it is empty. Otherwise, fields left in the journal
+  by an interrupted run are applied and written to the output YAML.
+
+  Args:
+    project_yaml (str): Path of the project config YAML.
+    output_yaml_path (str): Path of the output YAML.
+    input_config (CommentedMap): The content of the whole yaml, updated in
+      place.
+
+  Returns:
+    bool: True if generated_fields were recovered.
+  """
+  store = get_state_store()
+  if store:
+    with GENERATED_FIELDS_LOCK:
+      if not store.is_empty():
+        _apply_generated_fields(store.get_all(), input_config)
+        return True
+      if not FLAGS.dry_run:
+        logging.info('Seeding %s with the generated_fields of the config.',
+                     store.path)
+        store.put_all(input_config.get(GENERATED_FIELDS_NAME, {}))
+      return False
+
+  journal_path = _get_journal_path(output_yaml_path)
+  if not os.path.exists(journal_path):
+    return False
+  num_entries = 0
+  with GENERATED_FIELDS_LOCK:
+    with open(journal_path) as journal:
+      for line in journal:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          # The last entry may be partial if the script died writing it.
+          logging.warning('Ignoring corrupt generated_fields journal entry.')
+          continue
+        num_entries += 1
+        _apply_generated_fields(entry, input_config)
+    logging.info('Recovered %d generated_fields changes from %s.', num_entries,
+                 journal_path)
+    compact_generated_fields(project_yaml, output_yaml_path, input_config)
+  return True
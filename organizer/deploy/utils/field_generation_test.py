@@ -4,12 +4,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import tempfile
+from absl import flags
 from absl.testing import absltest
 import ruamel.yaml
 from deploy.utils import field_generation
 from deploy.utils import utils
 
+FLAGS = flags.FLAGS
+
 TEST_YAML_CONTENT = """
 overall:
   organization_id: '433637338589'
@@ -220,6 +224,116 @@ class FieldGeneratingTest(absltest.TestCase):
       new_root = field_generation.update_generated_fields(f.name, overall_root)
       self.assertEqual(overall_root, new_root)
 
+  def test_recover_generated_fields(self):
+    tmp_dir = self.create_tempdir().full_path
+    input_path = os.path.join(tmp_dir, 'in.yaml')
+    output_path = os.path.join(tmp_dir, 'out.yaml')
+    journal_path = output_path + field_generation._JOURNAL_SUFFIX
+    with open(input_path, 'w') as f:
+      f.write(TEST_YAML_CONTENT)
+
+    FLAGS.dry_run = False
+    try:
+      overall_root = utils.read_yaml_file(input_path)
+      field_generation.get_generated_fields_ref(
+          'data-project-02', overall_root)['project_number'] = '444444444444'
+      field_generation.record_generated_fields('data-project-02', output_path,
+                                               overall_root)
+      # The script died while journaling another change.
+      with open(journal_path, 'a') as f:
+        f.write('{"projects": {"data-pro')
+
+      new_root = utils.read_yaml_file(input_path)
+      self.assertTrue(
+          field_generation.recover_generated_fields(input_path, output_path,
+                                                    new_root))
+    finally:
+      FLAGS.dry_run = True
+
+    self.assertFalse(os.path.exists(journal_path))
+    self.assertEqual(
+        field_generation.get_generated_fields_copy('data-project-02', new_root),
+        {'project_number': '444444444444'})
+    output_root = utils.read_yaml_file(output_path)
+    self.assertEqual(
+        field_generation.get_generated_fields_copy('data-project-02',
+                                                   output_root),
+        {'project_number': '444444444444'})
+    self.assertFalse(
+        field_generation.recover_generated_fields(input_path, output_path,
+                                                  new_root))
+
+  def test_state_db(self):
+    tmp_dir = self.create_tempdir().full_path
+    input_path = os.path.join(tmp_dir, 'in.yaml')
+    output_path = os.path.join(tmp_dir, 'out.yaml')
+    with open(input_path, 'w') as f:
+      f.write(TEST_YAML_CONTENT)
+
+    FLAGS.dry_run = False
+    FLAGS.state_db = os.path.join(tmp_dir, 'state.db')
+    try:
+      # The empty store is seeded from the config.
+      overall_root = utils.read_yaml_file(input_path)
+      self.assertFalse(
+          field_generation.recover_generated_fields(input_path, output_path,
+                                                    overall_root))
+      field_generation.get_generated_fields_ref(
+          'data-project-02', overall_root)['project_number'] = '444444444444'
+      field_generation.record_generated_fields('data-project-02', output_path,
+                                               overall_root)
+      self.assertFalse(os.path.exists(output_path))
+
+      new_root = utils.read_yaml_file(input_path)
+      self.assertTrue(
+          field_generation.recover_generated_fields(input_path, output_path,
+                                                    new_root))
+      self.assertEqual(new_root['generated_fields'],
+                       overall_root['generated_fields'])
+
+      field_generation.compact_generated_fields(input_path, output_path,
+                                                new_root)
+      output_root = utils.read_yaml_file(output_path)
+      self.assertEqual(output_root['generated_fields'],
+                       overall_root['generated_fields'])
+    finally:
+      FLAGS.dry_run = True
+      FLAGS.state_db = None
+
+  def test_export_generated_fields(self):
+    tmp_dir = self.create_tempdir().full_path
+    input_path = os.path.join(tmp_dir, 'in.yaml')
+    output_path = os.path.join(tmp_dir, 'out.yaml')
+    with open(input_path, 'w') as f:
+      f.write(TEST_YAML_CONTENT)
+    forseti_fields = {
+        'service_account': 'forseti@forseti-project.iam.gserviceaccount.com',
+        'server_bucket': 'gs://forseti-server-new/',
+    }
+
+    FLAGS.dry_run = False
+    FLAGS.state_db = os.path.join(tmp_dir, 'state.db')
+    try:
+      store = field_generation.get_state_store()
+      store.put_project('data-project-02', {'project_number': '444444444444'})
+      store.put_forseti(forseti_fields)
+      field_generation.export_generated_fields(input_path, output_path)
+    finally:
+      FLAGS.dry_run = True
+      FLAGS.state_db = None
+
+    input_fields = utils.read_yaml_file(input_path)['generated_fields']
+    output_root = utils.read_yaml_file(output_path)
+    # Projects only in the YAML are kept, projects in the store are added, and
+    # the Forseti fields of the store override those of the YAML.
+    self.assertEqual(
+        output_root['generated_fields']['projects'],
+        dict(input_fields['projects'],
+             **{'data-project-02': {'project_number': '444444444444'}}))
+    self.assertEqual(output_root['generated_fields']['forseti'], forseti_fields)
+    self.assertEqual(output_root['projects'],
+                     utils.read_yaml_file(input_path)['projects'])
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -14,6 +14,7 @@ import tempfile
 from absl import flags
 
 from deploy.utils import runner
+from deploy.utils import utils
 
 FLAGS = flags.FLAGS
 
@@ -171,6 +172,10 @@ def get_forseti_roles(project_id):
 
 def grant_access(project_id, forseti_service_account):
   """Grant the necessary permissions to the Forseti service account."""
+  if FLAGS.batch_iam_policy_updates:
+    _grant_access_batched(project_id, forseti_service_account)
+    return
+
   for role in _STANDARD_ROLES:
     _add_binding(project_id, forseti_service_account, 'roles/{}'.format(role))
 
@@ -180,6 +185,17 @@ def grant_access(project_id, forseti_service_account):
                  'projects/{}/roles/{}'.format(project_id, custom_role.name))
 
 
+def _grant_access_batched(project_id, forseti_service_account):
+  """Grant all the roles with a single update of the project's IAM policy."""
+  for custom_role in _CUSTOM_ROLES:
+    _create_custom_role(custom_role, project_id)
+
+  member = 'serviceAccount:{}'.format(forseti_service_account)
+  utils.update_project_iam_bindings(
+      project_id,
+      add_bindings={role: [member] for role in get_forseti_roles(project_id)})
+
+
 def _add_binding(project_id, forseti_service_account, role):
   """Add an IAM Policy for the Forseti service account for the given role."""
   cmd = [
@@ -12,6 +12,7 @@ from absl.testing import absltest
 
 
 from deploy.utils import forseti
+from deploy.utils import runner
 
 FLAGS = flags.FLAGS
 
@@ -48,7 +49,7 @@ class ForsetiAccessTest(absltest.TestCase):
             'ALPHA',
             '--permissions',
             'bigquery.datasets.get,bigquery.tables.get,bigquery.tables.list',
-        ]))
+        ], stderr=unittest.mock.ANY))
 
     want_calls.append(
         build_add_binding_call('projects/project1/roles/forsetiBigqueryViewer')
@@ -75,13 +76,48 @@ class ForsetiAccessTest(absltest.TestCase):
              'cloudsql.instances.get,cloudsql.instances.list,'
              'cloudsql.sslCerts.get,cloudsql.sslCerts.list,cloudsql.users.list'
             ),
-        ]))
+        ], stderr=unittest.mock.ANY))
 
     want_calls.append(
         build_add_binding_call('projects/project1/roles/forsetiCloudsqlViewer'))
 
     mock_check_output.assert_has_calls(want_calls)
 
+  @unittest.mock.patch.object(subprocess, 'check_output')
+  def test_grant_access_batched(self, mock_check_output):
+    FLAGS.dry_run = False
+    FLAGS.batch_iam_policy_updates = True
+    runner.reset_cache()
+    policies = []
+
+    def check_output(cmd, **kwargs):
+      del kwargs  # Unused.
+      if cmd[1:3] == ['projects', 'get-iam-policy']:
+        return b'{"etag": "abc", "bindings": []}'
+      if cmd[1:3] == ['projects', 'set-iam-policy']:
+        with open(cmd[4]) as f:
+          policies.append(f.read())
+      return b''
+
+    mock_check_output.side_effect = check_output
+    try:
+      forseti.grant_access(
+          'project1', 'forseti-sa@@forseti-project.iam.gserviceaccount.com')
+    finally:
+      FLAGS.batch_iam_policy_updates = False
+
+    commands = [call[0][0][1:4] for call in mock_check_output.call_args_list]
+    self.assertEqual(commands, [
+        ['iam', 'roles', 'create'],
+        ['iam', 'roles', 'create'],
+        ['projects', 'get-iam-policy', 'project1'],
+        ['projects', 'set-iam-policy', 'project1'],
+    ])
+    self.assertLen(policies, 1)
+    for role in forseti.get_forseti_roles('project1'):
+      self.assertIn(role, policies[0])
+    self.assertIn('abc', policies[0])
+
 
 def build_add_binding_call(role):
   return unittest.mock.call([
@@ -93,7 +129,7 @@ def build_add_binding_call(role):
       'serviceAccount:forseti-sa@@forseti-project.iam.gserviceaccount.com',
       '--role',
       role,
-  ])
+  ], stderr=unittest.mock.ANY)
 
 if __name__ == '__main__':
   absltest.main()
@@ -0,0 +1,123 @@
+"""Uploads files to GCS in-process through the Cloud Storage client library.
+
+Copying files with gsutil costs an interpreter start up and authentication per
+command, and needs the files on disk. GcsUploader uploads contents held in
+memory from a pool of threads sharing authenticated clients, and skips objects
+whose MD5 checksum shows they are unchanged.
+
+The Cloud Storage client library is optional. Use is_available() to check if it
+is installed.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import base64
+import hashlib
+import posixpath
+import threading
+
+from concurrent import futures
+
+from absl import logging
+
+try:
+  # pylint: disable=g-import-not-at-top
+  from google.cloud import storage
+except ImportError:
+  storage = None
+
+# Maximum number of files uploaded at the same time.
+_MAX_CONCURRENT_UPLOADS = 8
+
+
+def is_available():
+  """Returns whether the Cloud Storage client library is installed."""
+  return storage is not None
+
+
+def _build_client():
+  return storage.Client()
+
+
+def md5_hash(data):
+  """Gets the MD5 checksum of data, encoded the way GCS reports it."""
+  return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+
+def split_gcs_path(gcs_path):
+  """Splits a gs://bucket/path into the bucket and the object path."""
+  if not gcs_path.startswith('gs://'):
+    raise ValueError('Not a GCS path: {}'.format(gcs_path))
+  bucket, _, path = gcs_path[len('gs://'):].partition('/')
+  return bucket, path.strip('/')
+
+
+class GcsUploader(object):
+  """Uploads files held in memory to a GCS directory."""
+
+  def __init__(self, client_factory=None,
+               max_workers=_MAX_CONCURRENT_UPLOADS):
+    """Initialize.
+
+    Args:
+      client_factory (Callable): Builds a storage client. Defaults to a client
+        using the application default credentials.
+      max_workers (int): Maximum number of files uploaded at the same time.
+    """
+    self._client_factory = client_factory or _build_client
+    self._max_workers = max_workers
+    # Clients are not thread safe, so keep a client per thread.
+    self._local = threading.local()
+
+  def _get_client(self):
+    client = getattr(self._local, 'client', None)
+    if client is None:
+      client = self._client_factory()
+      self._local.client = client
+    return client
+
+  def upload(self, files, gcs_dir, content_type=None):
+    """Uploads files whose contents differ from the objects in a directory.
+
+    Args:
+      files (Iterable[(string, bytes)]): The name and contents of each file.
+        Files are uploaded as soon as they are produced.
+      gcs_dir (string): The gs://bucket/path directory to upload to.
+      content_type (string): The content type of the files, if known.
+
+    Returns:
+      List[string]: The names of the files uploaded, in the given order.
+
+    Raises:
+      Exception: the first error raised by the client, once all uploads are
+        done.
+    """
+    bucket_name, prefix = split_gcs_path(gcs_dir)
+    # One listing gets the checksums of all existing objects.
+    existing = {
+        blob.name: blob.md5_hash for blob in self._get_client().list_blobs(
+            bucket_name, prefix=prefix + '/' if prefix else None)
+    }
+
+    uploads = []
+    with futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+      for name, data in files:
+        object_name = posixpath.join(prefix, name) if prefix else name
+        if existing.get(object_name) == md5_hash(data):
+          logging.info('Skipping unchanged gs://%s/%s', bucket_name,
+                       object_name)
+          continue
+        uploads.append((name,
+                        executor.submit(self._upload, bucket_name, object_name,
+                                        data, content_type)))
+    for _, future in uploads:
+      future.result()
+    return [name for name, _ in uploads]
+
+  def _upload(self, bucket_name, object_name, data, content_type):
+    logging.info('Uploading gs://%s/%s', bucket_name, object_name)
+    blob = self._get_client().bucket(bucket_name).blob(object_name)
+    # GCS verifies the checksum and rejects corrupted uploads.
+    blob.upload_from_string(data, content_type=content_type, checksum='md5')
@@ -0,0 +1,53 @@
+"""Tests for deploy.utils.gcs_uploader."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from absl.testing import absltest
+
+from deploy.utils import fake_storage
+from deploy.utils import gcs_uploader
+
+
+class GcsUploaderTest(absltest.TestCase):
+
+  def setUp(self):
+    super(GcsUploaderTest, self).setUp()
+    self.client = fake_storage.FakeClient()
+    self.uploader = gcs_uploader.GcsUploader(client_factory=lambda: self.client)
+
+  def test_upload(self):
+    uploaded = self.uploader.upload([('a.yaml', b'a'), ('b.yaml', b'b')],
+                                    'gs://my-bucket/rules')
+    self.assertEqual(uploaded, ['a.yaml', 'b.yaml'])
+    self.assertEqual(self.client.objects, {
+        ('my-bucket', 'rules/a.yaml'): b'a',
+        ('my-bucket', 'rules/b.yaml'): b'b',
+    })
+
+  def test_unchanged_files_are_skipped(self):
+    self.uploader.upload([('a.yaml', b'a'), ('b.yaml', b'b')],
+                         'gs://my-bucket/rules/')
+    self.client.uploads = []
+
+    uploaded = self.uploader.upload([('a.yaml', b'a'), ('b.yaml', b'c')],
+                                    'gs://my-bucket/rules/')
+    self.assertEqual(uploaded, ['b.yaml'])
+    self.assertEqual(self.client.uploads, ['gs://my-bucket/rules/b.yaml'])
+    self.assertEqual(self.client.objects[('my-bucket', 'rules/b.yaml')], b'c')
+
+  def test_upload_to_bucket_root(self):
+    self.uploader.upload([('a.yaml', b'a')], 'gs://my-bucket')
+    self.assertEqual(self.client.uploads, ['gs://my-bucket/a.yaml'])
+
+  def test_split_gcs_path(self):
+    self.assertEqual(
+        gcs_uploader.split_gcs_path('gs://my-bucket/path/to/dir/'),
+        ('my-bucket', 'path/to/dir'))
+    with self.assertRaises(ValueError):
+      gcs_uploader.split_gcs_path('/local/dir')
+
+
+if __name__ == '__main__':
+  absltest.main()
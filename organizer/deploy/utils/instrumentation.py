@@ -0,0 +1,325 @@
+"""Instrumentation of the time taken by deployment steps and commands.
+
+Spans record the wall time of a unit of work (e.g. a project, a setup step or
+a gcloud command), the project and thread it ran in and whether it failed.
+Recording a span only appends it to a list, so instrumentation is on by
+default. Aggregates, like the latency histogram of each gcloud command, are
+computed when a report is written:
+
+  with instrumentation.span('step', 'enable_apis', project_id):
+    enable_services_apis(config)
+  ...
+  instrumentation.write_report('report.json')  # Or report.csv.
+  instrumentation.write_trace('trace.json')
+
+Traces are in the Chrome trace event format, and can be viewed in
+chrome://tracing or https://ui.perfetto.dev.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import contextlib
+import csv
+import json
+import threading
+import time
+
+from absl import flags
+from absl import logging
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_bool('instrumentation', True,
+                  'Record the time taken by each step and command.')
+flags.DEFINE_string('instrumentation_report_path', None,
+                    ('File to write the time taken by each step and command '
+                     'to, as CSV if it ends in .csv, else as JSON.'))
+flags.DEFINE_string('instrumentation_trace_path', None,
+                    ('File to write the trace of all steps and commands to, '
+                     'in the Chrome trace event format.'))
+
+# Upper bounds in seconds of the buckets of latency histograms.
+_HISTOGRAM_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300,
+                      float('inf'))
+
+# Number of slowest entries to log in summaries.
+_SUMMARY_SIZE = 5
+
+_CSV_FIELDS = [
+    'kind', 'name', 'project', 'calls', 'errors', 'retries', 'total_secs',
+    'max_secs', 'output_bytes'
+] + ['le_{:g}'.format(bound) for bound in _HISTOGRAM_BUCKETS]
+
+
+class Span(object):
+  """A unit of work and the time it took.
+
+  Attributes:
+    category (str): The kind of work, e.g. 'step' or 'command'.
+    name (str): The name of the work, e.g. a step ID or a gcloud command
+      without its arguments.
+    project (str): The project the work was done for, if any.
+    thread (int): The ID of the thread the work ran in.
+    start (float): The time the work started, in seconds since the epoch.
+    duration (float): The seconds the work took.
+    error (str): The name of the exception the work raised, else None.
+    output_bytes (int): The size of the output of the work, if any.
+  """
+
+  __slots__ = ('category', 'name', 'project', 'thread', 'start', 'duration',
+               'error', 'output_bytes')
+
+  def __init__(self, category, name, project, thread, start):
+    self.category = category
+    self.name = name
+    self.project = project
+    self.thread = thread
+    self.start = start
+    self.duration = 0
+    self.error = None
+    self.output_bytes = 0
+
+
+class _Aggregate(object):
+  """Aggregated measurements of the spans of the same kind and name."""
+
+  def __init__(self):
+    self.calls = 0
+    self.errors = 0
+    self.total_secs = 0
+    self.max_secs = 0
+    self.output_bytes = 0
+    self.histogram = [0] * len(_HISTOGRAM_BUCKETS)
+
+  def add(self, span):
+    self.calls += 1
+    self.errors += span.error is not None
+    self.total_secs += span.duration
+    self.max_secs = max(self.max_secs, span.duration)
+    self.output_bytes += span.output_bytes
+    for i, bound in enumerate(_HISTOGRAM_BUCKETS):
+      if span.duration <= bound:
+        self.histogram[i] += 1
+        break
+
+  def to_dict(self):
+    return {
+        'calls': self.calls,
+        'errors': self.errors,
+        'total_secs': self.total_secs,
+        'max_secs': self.max_secs,
+        'output_bytes': self.output_bytes,
+        'histogram': collections.OrderedDict(
+            ('le_{:g}'.format(bound), count)
+            for bound, count in zip(_HISTOGRAM_BUCKETS, self.histogram)),
+    }
+
+
+class Recorder(object):
+  """Records spans and retries."""
+
+  def __init__(self, clock=time.time):
+    """Initialize.
+
+    Args:
+      clock (Callable): Returns the current time in seconds.
+    """
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._spans = []
+    self._retries = collections.Counter()
+    self._thread_names = {}
+
+  @contextlib.contextmanager
+  def span(self, category, name, project=None):
+    """Records the time taken by the body of the with statement.
+
+    Args:
+      category (str): The kind of work, e.g. 'step' or 'command'.
+      name (str): The name of the work.
+      project (str): The project the work is done for, if any.
+
+    Yields:
+      Span: The span, whose output_bytes can be set by the body.
+    """
+    thread = threading.current_thread()
+    span = Span(category, name, project, thread.ident, self._clock())
+    try:
+      yield span
+    except BaseException as e:
+      span.error = type(e).__name__
+      raise
+    finally:
+      span.duration = self._clock() - span.start
+      with self._lock:
+        self._spans.append(span)
+        self._thread_names[thread.ident] = thread.name
+
+  def record_retry(self, name):
+    """Counts a retry of the work of the given name."""
+    with self._lock:
+      self._retries[name] += 1
+
+  def reset(self):
+    with self._lock:
+      self._spans = []
+      self._retries.clear()
+      self._thread_names.clear()
+
+  def get_spans(self):
+    """Returns the spans recorded so far, in the order they finished."""
+    with self._lock:
+      return list(self._spans)
+
+  def get_report(self):
+    """Aggregates the spans recorded so far.
+
+    Returns:
+      dict: 'steps' maps each project to the measurements of each of its
+        steps, 'commands' maps the name of each command to its measurements
+        (including a latency histogram) and 'retries' maps the name of each
+        retried work to its number of retries.
+    """
+    with self._lock:
+      spans = list(self._spans)
+      retries = dict(self._retries)
+    steps = collections.defaultdict(
+        lambda: collections.defaultdict(_Aggregate))
+    commands = collections.defaultdict(_Aggregate)
+    for span in spans:
+      if span.category == 'step':
+        steps[span.project][span.name].add(span)
+      elif span.category == 'command':
+        commands[span.name].add(span)
+    return {
+        'steps': {
+            project: {
+                step: aggregate.to_dict()
+                for step, aggregate in project_steps.items()
+            } for project, project_steps in steps.items()
+        },
+        'commands': {
+            name: aggregate.to_dict() for name, aggregate in commands.items()
+        },
+        'retries': retries,
+    }
+
+  def write_report(self, path):
+    """Writes the report, as CSV if the path ends in .csv, else as JSON."""
+    report = self.get_report()
+    with open(path, 'w') as f:
+      if not path.endswith('.csv'):
+        json.dump(report, f, indent=2, sort_keys=True)
+        return
+      writer = csv.DictWriter(f, _CSV_FIELDS, restval='')
+      writer.writeheader()
+      for project, project_steps in sorted(report['steps'].items()):
+        for step, measurements in sorted(project_steps.items()):
+          writer.writerow(_csv_row('step', step, project, measurements))
+      for name, measurements in sorted(report['commands'].items()):
+        writer.writerow(_csv_row('command', name, '', measurements))
+      for name, retries in sorted(report['retries'].items()):
+        writer.writerow({'kind': 'retry', 'name': name, 'retries': retries})
+
+  def write_trace(self, path):
+    """Writes the spans in the Chrome trace event format."""
+    with self._lock:
+      spans = list(self._spans)
+      thread_names = dict(self._thread_names)
+    events = [{
+        'name': 'thread_name',
+        'ph': 'M',
+        'pid': 0,
+        'tid': thread,
+        'args': {'name': name},
+    } for thread, name in sorted(thread_names.items())]
+    for span in spans:
+      args = {}
+      if span.project:
+        args['project'] = span.project
+      if span.error:
+        args['error'] = span.error
+      if span.output_bytes:
+        args['output_bytes'] = span.output_bytes
+      events.append({
+          'name': span.name,
+          'cat': span.category,
+          'ph': 'X',
+          'ts': int(span.start * 1e6),
+          'dur': int(span.duration * 1e6),
+          'pid': 0,
+          'tid': span.thread,
+          'args': args,
+      })
+    with open(path, 'w') as f:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+  def log_summary(self):
+    """Logs the slowest steps and the commands which took the most time."""
+    report = self.get_report()
+    steps = sorted(((m['max_secs'], project, step)
+                    for project, project_steps in report['steps'].items()
+                    for step, m in project_steps.items()),
+                   reverse=True)
+    for secs, project, step in steps[:_SUMMARY_SIZE]:
+      logging.info('Slow step: %s %s took %.1f seconds', project, step, secs)
+    commands = sorted(report['commands'].items(),
+                      key=lambda item: item[1]['total_secs'], reverse=True)
+    for name, m in commands[:_SUMMARY_SIZE]:
+      logging.info('Slow command: %s took %.1f seconds in %d calls (max %.1f)',
+                   name, m['total_secs'], m['calls'], m['max_secs'])
+
+
+def _csv_row(kind, name, project, measurements):
+  row = {'kind': kind, 'name': name, 'project': project}
+  row.update((key, value)
+             for key, value in measurements.items()
+             if key != 'histogram')
+  row.update(measurements['histogram'])
+  return row
+
+
+_recorder = Recorder()
+
+
+@contextlib.contextmanager
+def span(category, name, project=None):
+  """Records a span with the shared Recorder, if instrumentation is on."""
+  if not FLAGS.instrumentation:
+    yield Span(category, name, project, None, 0)
+    return
+  with _recorder.span(category, name, project) as s:
+    yield s
+
+
+def record_retry(name):
+  """Counts a retry with the shared Recorder, if instrumentation is on."""
+  if FLAGS.instrumentation:
+    _recorder.record_retry(name)
+
+
+def get_report():
+  return _recorder.get_report()
+
+
+def reset():
+  """Drops all recorded spans and retries."""
+  _recorder.reset()
+
+
+def write_outputs():
+  """Logs a summary and writes the report and trace given by the flags."""
+  if not FLAGS.instrumentation:
+    return
+  _recorder.log_summary()
+  if FLAGS.instrumentation_report_path:
+    _recorder.write_report(FLAGS.instrumentation_report_path)
+    logging.info('Wrote instrumentation report to %s',
+                 FLAGS.instrumentation_report_path)
+  if FLAGS.instrumentation_trace_path:
+    _recorder.write_trace(FLAGS.instrumentation_trace_path)
+    logging.info('Wrote instrumentation trace to %s',
+                 FLAGS.instrumentation_trace_path)
@@ -0,0 +1,98 @@
+"""Tests for deploy.utils.instrumentation."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import csv
+import json
+
+from absl.testing import absltest
+
+from deploy.utils import instrumentation
+
+
+class _FakeClock(object):
+
+  def __init__(self):
+    self.now = 100.0
+
+  def time(self):
+    return self.now
+
+
+class InstrumentationTest(absltest.TestCase):
+
+  def setUp(self):
+    super(InstrumentationTest, self).setUp()
+    self.clock = _FakeClock()
+    self.recorder = instrumentation.Recorder(clock=self.clock.time)
+
+  def record(self, category, name, project, secs, output_bytes=0):
+    with self.recorder.span(category, name, project) as span:
+      self.clock.now += secs
+      span.output_bytes = output_bytes
+
+  def test_report(self):
+    self.record('step', 'enable_apis', 'p1', 3)
+    self.record('command', 'gcloud services enable', 'p1', 2, output_bytes=10)
+    self.record('command', 'gcloud services enable', 'p2', 0.2)
+    with self.assertRaises(ValueError):
+      with self.recorder.span('command', 'gcloud services enable', 'p2'):
+        raise ValueError()
+    self.recorder.record_retry('gcloud services enable')
+
+    report = self.recorder.get_report()
+    self.assertEqual(report['steps']['p1']['enable_apis']['total_secs'], 3)
+    command = report['commands']['gcloud services enable']
+    self.assertEqual(command['calls'], 3)
+    self.assertEqual(command['errors'], 1)
+    self.assertEqual(command['max_secs'], 2)
+    self.assertEqual(command['output_bytes'], 10)
+    self.assertEqual(command['histogram']['le_0.1'], 1)
+    self.assertEqual(command['histogram']['le_0.25'], 1)
+    self.assertEqual(command['histogram']['le_2.5'], 1)
+    self.assertEqual(report['retries'], {'gcloud services enable': 1})
+
+  def test_write_report(self):
+    self.record('step', 'enable_apis', 'p1', 3)
+    self.record('command', 'gcloud services enable', 'p1', 2)
+    self.recorder.record_retry('gcloud services enable')
+
+    json_path = self.create_tempfile(file_path='report.json').full_path
+    self.recorder.write_report(json_path)
+    with open(json_path) as f:
+      self.assertEqual(json.load(f), self.recorder.get_report())
+
+    csv_path = self.create_tempfile(file_path='report.csv').full_path
+    self.recorder.write_report(csv_path)
+    with open(csv_path) as f:
+      rows = list(csv.DictReader(f))
+    self.assertEqual([(row['kind'], row['name']) for row in rows],
+                     [('step', 'enable_apis'),
+                      ('command', 'gcloud services enable'),
+                      ('retry', 'gcloud services enable')])
+    self.assertEqual(rows[1]['le_2.5'], '1')
+
+  def test_write_trace(self):
+    self.record('step', 'enable_apis', 'p1', 3)
+
+    path = self.create_tempfile().full_path
+    self.recorder.write_trace(path)
+    with open(path) as f:
+      events = json.load(f)['traceEvents']
+    self.assertEqual(events[0]['ph'], 'M')
+    self.assertEqual(events[1], {
+        'name': 'enable_apis',
+        'cat': 'step',
+        'ph': 'X',
+        'ts': 100000000,
+        'dur': 3000000,
+        'pid': 0,
+        'tid': events[0]['tid'],
+        'args': {'project': 'p1'},
+    })
+
+
+if __name__ == '__main__':
+  absltest.main()
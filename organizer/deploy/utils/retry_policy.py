@@ -0,0 +1,171 @@
+"""Retry policy and rate limiting of commands calling Google Cloud APIs.
+
+Failed commands are classified from their error output:
+  - quota errors (e.g. RESOURCE_EXHAUSTED or HTTP 429) are rejected before any
+    change is made, so are always safe to retry;
+  - transient errors (e.g. UNAVAILABLE or HTTP 503) may happen after a change
+    was made, so are only safe to retry for commands which do not create
+    resources;
+  - conflict errors (ABORTED, e.g. an IAM policy whose etag is stale) are due to
+    a concurrent update, so are safe to retry for commands which read the
+    resource before updating it;
+  - all other errors are permanent.
+
+Retries wait with jittered exponential backoff, so concurrent deployments do
+not retry in lockstep. RateLimiter keeps a token bucket per API family, so
+concurrent deployments stay under the APIs' quotas rather than relying on
+retries.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import random
+import re
+import threading
+import time
+
+QUOTA_ERROR = 'quota'
+TRANSIENT_ERROR = 'transient'
+CONFLICT_ERROR = 'conflict'
+
+_QUOTA_ERROR_PATTERN = re.compile(
+    r'RESOURCE_EXHAUSTED|[Qq]uota exceeded|rateLimitExceeded|'
+    r'userRateLimitExceeded|Too Many Requests|\b429\b')
+_TRANSIENT_ERROR_PATTERN = re.compile(
+    r'UNAVAILABLE|DEADLINE_EXCEEDED|INTERNAL|backendError|internalError|'
+    r'\b50[0234]\b|Connection reset|Connection aborted|timed out')
+_CONFLICT_ERROR_PATTERN = re.compile(
+    r'ABORTED|concurrent policy changes')
+
+
+def classify_error(error):
+  """Classifies a failed command from its error output.
+
+  Args:
+    error (CalledProcessError): The error the command failed with.
+
+  Returns:
+    str: QUOTA_ERROR, TRANSIENT_ERROR, CONFLICT_ERROR or None if the error is
+      permanent.
+  """
+  text = b'\n'.join(
+      part for part in (getattr(error, 'stderr', None), error.output)
+      if isinstance(part, bytes)).decode('utf-8', 'replace')
+  if _QUOTA_ERROR_PATTERN.search(text):
+    return QUOTA_ERROR
+  if _CONFLICT_ERROR_PATTERN.search(text):
+    return CONFLICT_ERROR
+  if _TRANSIENT_ERROR_PATTERN.search(text):
+    return TRANSIENT_ERROR
+  return None
+
+
+def get_backoff_secs(attempt, initial_secs, max_secs, rand=random):
+  """Gets the time to wait before retrying, with full jitter.
+
+  Args:
+    attempt (int): The number of the attempt which failed, starting at 1.
+    initial_secs (float): The maximum wait after the first attempt.
+    max_secs (float): The maximum wait after any attempt.
+    rand (random.Random): The source of the jitter.
+
+  Returns:
+    float: A random wait of up to initial_secs * 2^(attempt - 1) seconds,
+      capped at max_secs.
+  """
+  return rand.uniform(0, min(max_secs, initial_secs * 2**(attempt - 1)))
+
+
+class TokenBucket(object):
+  """Limits the rate of calls, allowing short bursts."""
+
+  def __init__(self, rate, capacity=None, clock=time.time, sleep=time.sleep):
+    """Initialize.
+
+    Args:
+      rate (float): The number of calls allowed per second.
+      capacity (float): The number of calls allowed in a burst. Defaults to a
+        second of calls, and at least 1.
+      clock (Callable): Returns the current time in seconds.
+      sleep (Callable): Waits for the given number of seconds.
+    """
+    self.rate = rate
+    self.capacity = capacity or max(rate, 1)
+    self._clock = clock
+    self._sleep = sleep
+    self._lock = threading.Lock()
+    self._tokens = self.capacity
+    self._updated = clock()
+
+  def acquire(self):
+    """Takes a token, waiting for one if none is left.
+
+    Callers waiting at the same time are served in order: each reserves a
+    token, possibly making the count negative, and waits until it is refilled.
+
+    Returns:
+      float: The number of seconds waited.
+    """
+    with self._lock:
+      now = self._clock()
+      self._tokens = min(self.capacity,
+                         self._tokens + (now - self._updated) * self.rate)
+      self._updated = now
+      self._tokens -= 1
+      wait_secs = -self._tokens / self.rate if self._tokens < 0 else 0
+    if wait_secs:
+      self._sleep(wait_secs)
+    return wait_secs
+
+
+class RateLimiter(object):
+  """Keeps a token bucket per API family."""
+
+  def __init__(self, rates, clock=time.time, sleep=time.sleep):
+    """Initialize.
+
+    Args:
+      rates (dict): The number of calls allowed per second, by family. A family
+        is a gcloud service (e.g. 'services'), optionally followed by a command
+        group (e.g. 'deployment-manager operations'), or the name of a binary.
+      clock (Callable): Returns the current time in seconds.
+      sleep (Callable): Waits for the given number of seconds.
+    """
+    self._buckets = {
+        family: TokenBucket(rate, clock=clock, sleep=sleep)
+        for family, rate in rates.items()
+    }
+
+  def acquire(self, families):
+    """Takes a token for the most specific of the given families, if limited.
+
+    Args:
+      families (List[str]): The families of a command, most specific first.
+
+    Returns:
+      float: The number of seconds waited.
+    """
+    for family in families:
+      bucket = self._buckets.get(family)
+      if bucket is not None:
+        return bucket.acquire()
+    return 0
+
+
+def parse_rates(pairs):
+  """Parses FAMILY=RATE pairs into a map of family to calls per second.
+
+  Raises:
+    ValueError: if a pair is malformed or a rate is not positive.
+  """
+  rates = {}
+  for pair in pairs:
+    family, sep, rate = pair.rpartition('=')
+    if not sep or not family.strip():
+      raise ValueError('Expected FAMILY=RATE, got {}'.format(pair))
+    rates[family.strip()] = float(rate)
+    if rates[family.strip()] <= 0:
+      raise ValueError('Rate of {} must be positive'.format(family))
+  return rates
@@ -0,0 +1,105 @@
+"""Tests for deploy.utils.retry_policy."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import random
+import subprocess
+
+from absl.testing import absltest
+
+from deploy.utils import retry_policy
+
+
+class _FakeClock(object):
+  """Clock advanced by sleeping."""
+
+  def __init__(self):
+    self.now = 1000.0
+    self.sleeps = []
+
+  def sleep(self, secs):
+    self.sleeps.append(secs)
+    self.now += secs
+
+  def time(self):
+    return self.now
+
+
+def _error(stderr=None, output=b''):
+  return subprocess.CalledProcessError(
+      1, ['gcloud'], output=output, stderr=stderr)
+
+
+class RetryPolicyTest(absltest.TestCase):
+
+  def test_classify_error(self):
+    self.assertEqual(
+        retry_policy.classify_error(
+            _error(b'ERROR: (gcloud.services.enable) RESOURCE_EXHAUSTED: '
+                   b'Quota exceeded for quota metric')),
+        retry_policy.QUOTA_ERROR)
+    self.assertEqual(
+        retry_policy.classify_error(_error(output=b'HTTPError 429: Too Many')),
+        retry_policy.QUOTA_ERROR)
+    self.assertEqual(
+        retry_policy.classify_error(_error(b'ERROR: UNAVAILABLE: try again')),
+        retry_policy.TRANSIENT_ERROR)
+    self.assertEqual(
+        retry_policy.classify_error(_error(b'HTTPError 503: Backend Error')),
+        retry_policy.TRANSIENT_ERROR)
+    self.assertEqual(
+        retry_policy.classify_error(
+            _error(b'ERROR: (gcloud.projects.set-iam-policy) ABORTED: There '
+                   b'were concurrent policy changes.')),
+        retry_policy.CONFLICT_ERROR)
+    self.assertIsNone(
+        retry_policy.classify_error(_error(b'ERROR: PERMISSION_DENIED')))
+    self.assertIsNone(retry_policy.classify_error(_error()))
+
+  def test_get_backoff_secs(self):
+    rand = random.Random(0)
+    for attempt, bound in [(1, 2), (2, 4), (3, 8), (10, 60)]:
+      for _ in range(20):
+        secs = retry_policy.get_backoff_secs(attempt, 2, 60, rand)
+        self.assertBetween(secs, 0, bound)
+
+  def test_token_bucket(self):
+    clock = _FakeClock()
+    bucket = retry_policy.TokenBucket(
+        2, clock=clock.time, sleep=clock.sleep)
+    # A burst of a second of calls is allowed, then calls are spaced out.
+    self.assertEqual([bucket.acquire() for _ in range(4)], [0, 0, 0.5, 0.5])
+    self.assertEqual(clock.sleeps, [0.5, 0.5])
+    clock.sleep(10)
+    self.assertEqual(bucket.acquire(), 0)
+
+  def test_rate_limiter_uses_most_specific_family(self):
+    clock = _FakeClock()
+    limiter = retry_policy.RateLimiter(
+        {'services': 1, 'services operations': 100},
+        clock=clock.time,
+        sleep=clock.sleep)
+    for _ in range(3):
+      limiter.acquire(['services operations', 'services'])
+    self.assertEmpty(clock.sleeps)
+    limiter.acquire(['services enable', 'services'])
+    limiter.acquire(['services enable', 'services'])
+    self.assertEqual(clock.sleeps, [1])
+    self.assertEqual(limiter.acquire(['iam']), 0)
+
+  def test_parse_rates(self):
+    self.assertEqual(
+        retry_policy.parse_rates(
+            ['services=5', 'deployment-manager operations=0.5']), {
+                'services': 5,
+                'deployment-manager operations': 0.5
+            })
+    for pairs in [['services'], ['=5'], ['services=0'], ['services=x']]:
+      with self.assertRaises(ValueError):
+        retry_policy.parse_rates(pairs)
+
+
+if __name__ == '__main__':
+  absltest.main()
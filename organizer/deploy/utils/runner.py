@@ -2,22 +2,406 @@
 
 It is useful for providing a global way to run any mutating function for dry
 runs.
+
+Commands are run through a pluggable backend. By default each command is run in
+a new subprocess, while --gcloud_backend=api runs supported gcloud commands
+in-process through the Google API clients.
+
+Commands failing with quota or transient errors are retried with jittered
+exponential backoff, and calls to each API family can be rate limited with
+--api_rate_limits (see retry_policy.py).
 """
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import codecs
+import os
 import subprocess
+import sys
+import threading
+import time
 
 from absl import flags
 from absl import logging
 
+from deploy.utils import api_backend
+from deploy.utils import instrumentation
+from deploy.utils import retry_policy
+
 FLAGS = flags.FLAGS
 
 flags.DEFINE_bool('dry_run', True,
                   ('By default, no gcloud commands will be executed. '
                    'Use --nodry_run to execute commands.'))
+flags.DEFINE_bool('cache_gcloud_queries', True,
+                  ('Reuse the output of read-only gcloud commands (e.g. list '
+                   'and describe) until a command modifying the same project '
+                   'is run.'))
+flags.DEFINE_enum('gcloud_backend', 'subprocess', ['subprocess', 'api'],
+                  ('How to run gcloud commands. "subprocess" spawns gcloud for '
+                   'every command. "api" runs supported commands in-process '
+                   'through the Google API client libraries (if installed) '
+                   'and spawns gcloud for the rest.'))
+flags.DEFINE_integer('max_command_attempts', 5,
+                     ('Maximum number of times a command is run when it fails '
+                      'with a quota or transient error.'))
+flags.DEFINE_float('command_retry_initial_secs', 2,
+                   ('Maximum seconds to wait before the first retry of a '
+                    'command. The maximum doubles with every retry.'))
+flags.DEFINE_float('command_retry_max_secs', 60,
+                   'Maximum seconds to wait before any retry of a command.')
+flags.DEFINE_list('api_rate_limits', [],
+                  ('Maximum calls per second to each API family, shared by '
+                   'all projects deployed at the same time, as FAMILY=RATE '
+                   'pairs, e.g. "services=2,deployment-manager=1". A family is '
+                   'a gcloud service, optionally followed by a command group '
+                   '(e.g. "deployment-manager operations"), or the name of a '
+                   'binary. The most specific family applies.'))
+
+
+class SubprocessBackend(object):
+  """Runs each command in a new subprocess."""
+
+  def check_call(self, cmd):
+    return _run_with_stderr_copy(subprocess.check_call, cmd)
+
+  def check_output(self, cmd):
+    return _run_with_stderr_copy(subprocess.check_output, cmd)
+
+
+def _run_with_stderr_copy(func, cmd):
+  """Runs a command, copying its stderr to sys.stderr as it is written.
+
+  Progress and prompts of long commands are shown while they run, and the
+  stderr is kept to classify the error (see retry_policy.py) if they fail.
+
+  Args:
+    func (Callable): subprocess.check_call or subprocess.check_output.
+    cmd (List[str]): The command to run.
+
+  Returns:
+    The result of func.
+
+  Raises:
+    CalledProcessError: if the command failed, with its stderr.
+  """
+  read_fd, write_fd = os.pipe()
+  chunks = []
+  copier = threading.Thread(target=_copy_stderr, args=(read_fd, chunks))
+  copier.daemon = True
+  copier.start()
+  try:
+    try:
+      return func(cmd, stderr=write_fd)
+    finally:
+      # The copy ends once both the command and this process closed the pipe.
+      os.close(write_fd)
+      copier.join()
+  except subprocess.CalledProcessError as e:
+    if e.stderr is None:
+      e.stderr = b''.join(chunks)
+    raise
+
+
+def _copy_stderr(fd, chunks):
+  """Copies a pipe to sys.stderr until it is closed, keeping what was read."""
+  decoder = codecs.getincrementaldecoder('utf-8')('replace')
+  try:
+    while True:
+      chunk = os.read(fd, 4096)
+      if not chunk:
+        break
+      chunks.append(chunk)
+      sys.stderr.write(decoder.decode(chunk))
+      sys.stderr.flush()
+  finally:
+    os.close(fd)
+
+
+_SUBPROCESS_BACKEND = SubprocessBackend()
+
+# Verbs of gcloud commands which do not modify any resource.
+_READ_ONLY_VERBS = frozenset(['describe', 'get-iam-policy', 'list'])
+# Release tracks which may prefix gcloud command groups.
+_RELEASE_TRACKS = frozenset(['alpha', 'beta'])
+# Services whose changes can affect the output of commands of any service.
+_ANY_SERVICE_MUTATORS = frozenset(['deployment-manager'])
+# Command groups whose resources change by themselves, so are never cached.
+_UNCACHED_GROUPS = frozenset(['operations'])
+# Verbs ending the command part of gcloud commands, before their arguments.
+_COMMAND_VERBS = frozenset([
+    'add-iam-policy-binding', 'add-metadata', 'create', 'delete', 'describe',
+    'disable', 'enable', 'get-iam-policy', 'link', 'list',
+    'remove-iam-policy-binding', 'set', 'set-iam-policy', 'update'
+])
+
+
+def split_gcloud_command(cmd):
+  """Splits a gcloud command into the parts used to classify it.
+
+  Args:
+    cmd (List[str]): The gcloud command, without the leading 'gcloud'.
+
+  Returns:
+    (str, List[str], dict): The service (e.g. 'services' or 'compute'), the
+      positional arguments following the service and a map of the flags given
+      with a value in the form `--flag value` or `--flag=value`.
+  """
+  positionals = []
+  flag_values = {}
+  i = 0
+  while i < len(cmd):
+    arg = cmd[i]
+    if not arg.startswith('--'):
+      positionals.append(arg)
+    elif '=' in arg:
+      name, value = arg.split('=', 1)
+      flag_values[name] = value
+    elif i + 1 < len(cmd) and not cmd[i + 1].startswith('--'):
+      flag_values[arg] = cmd[i + 1]
+      i += 1
+    i += 1
+  if positionals and positionals[0] in _RELEASE_TRACKS:
+    positionals = positionals[1:]
+  if not positionals:
+    return None, [], flag_values
+  return positionals[0], positionals[1:], flag_values
+
+
+def get_command_name(cmd):
+  """Gets the name of a command, without its arguments.
+
+  Args:
+    cmd (List[str]): The command.
+
+  Returns:
+    str: e.g. 'gcloud services enable' for gcloud commands, 'gsutil cp' for
+      gsutil commands and the name of the binary for other commands.
+  """
+  binary = os.path.basename(cmd[0])
+  if binary == 'gsutil':
+    return ' '.join([binary] + [arg for arg in cmd[1:]
+                                if not arg.startswith('-')][:1])
+  if binary != 'gcloud':
+    return binary
+  service, positionals, _ = split_gcloud_command(cmd[1:])
+  name = [binary, service or '']
+  for arg in positionals[:3]:
+    name.append(arg)
+    if arg in _COMMAND_VERBS:
+      break
+  return ' '.join(name)
+
+
+def get_command_families(cmd):
+  """Gets the families of a command, most specific first.
+
+  Args:
+    cmd (List[str]): The command.
+
+  Returns:
+    List[str]: e.g. ['deployment-manager operations', 'deployment-manager']
+      for gcloud commands, and the name of the binary for other commands.
+  """
+  binary = os.path.basename(cmd[0])
+  if binary != 'gcloud':
+    return [binary]
+  service, positionals, _ = split_gcloud_command(cmd[1:])
+  if not positionals:
+    return [service]
+  return ['{} {}'.format(service, positionals[0]), service]
+
+
+def _get_command_project(service, positionals, flag_values, project_id):
+  """Gets the ID of the project a gcloud command reads or modifies."""
+  if project_id:
+    return project_id
+  if '--project' in flag_values:
+    return flag_values['--project']
+  # Commands like `projects describe PROJECT` or
+  # `billing projects link PROJECT`.
+  args = [service] + positionals
+  if 'projects' not in args:
+    return None
+  args = args[args.index('projects') + 1:]
+  if len(args) >= 2:
+    return args[1]
+  return None
+
+
+class _QueryCache(object):
+  """Cache of the outputs of read-only gcloud commands, keyed by project."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._outputs = {}
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    """Gets the cached output for the given key, or None."""
+    with self._lock:
+      output = self._outputs.get(key)
+      if output is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+      return output
+
+  def put(self, key, output):
+    with self._lock:
+      self._outputs[key] = output
+
+  def invalidate(self, project, service=None):
+    """Drops cached outputs of the project's commands of the given service.
+
+    Args:
+      project (str): The project to drop outputs for, or None for all
+        projects.
+      service (str): The service to drop outputs for, or None for all services.
+    """
+    with self._lock:
+      for key in list(self._outputs):
+        key_project, key_service, _ = key
+        if project not in (None, key_project):
+          continue
+        if service not in (None, key_service):
+          continue
+        del self._outputs[key]
+
+  def reset(self):
+    with self._lock:
+      self._outputs.clear()
+      self.hits = 0
+      self.misses = 0
+
+
+_query_cache = _QueryCache()
+
+
+def invalidate_cache(project_id=None):
+  """Drops cached gcloud outputs of the project, or of all projects if None.
+
+  Use this after modifying resources without runner, e.g. through another
+  binary.
+
+  Args:
+    project_id (str): The project to drop the cached outputs of.
+  """
+  _query_cache.invalidate(project_id)
+
+
+def reset_cache():
+  """Drops all cached gcloud outputs and resets the hit and miss counts."""
+  _query_cache.reset()
+
+
+def log_cache_stats():
+  """Logs the number of cache hits and misses of read-only gcloud commands."""
+  logging.info('gcloud query cache: %d hits, %d misses', _query_cache.hits,
+               _query_cache.misses)
+
+
+_command_count = 0
+_command_count_lock = threading.Lock()
+
+
+def get_command_count():
+  """Returns the number of commands run (or faked in dry runs) so far."""
+  return _command_count
+
+
+# Rate limiter built from --api_rate_limits, and the flag value it was built
+# from.
+_rate_limiter = None
+_rate_limiter_flag = None
+_rate_limiter_lock = threading.Lock()
+
+
+def _get_rate_limiter():
+  """Gets the rate limiter for the current --api_rate_limits."""
+  global _rate_limiter, _rate_limiter_flag
+  with _rate_limiter_lock:
+    if _rate_limiter is None or _rate_limiter_flag != FLAGS.api_rate_limits:
+      _rate_limiter = retry_policy.RateLimiter(
+          retry_policy.parse_rates(FLAGS.api_rate_limits))
+      _rate_limiter_flag = list(FLAGS.api_rate_limits)
+    return _rate_limiter
+
+
+# Cloud SDK tools whose failed commands are retried. Other binaries, like the
+# apply binary, make many API calls per run and are not retried as a whole.
+_RETRIED_BINARIES = frozenset(['gcloud', 'gsutil', 'bq'])
+
+
+def _get_retry(cmd, error, attempt):
+  """Gets whether and when a failed command should be retried.
+
+  Args:
+    cmd (List[str]): The command which failed.
+    error (CalledProcessError): The error it failed with.
+    attempt (int): The number of the attempt which failed, starting at 1.
+
+  Returns:
+    (str, float): The kind of error and the seconds to wait before retrying,
+      or None if the command should not be retried.
+  """
+  binary = os.path.basename(cmd[0])
+  if (binary not in _RETRIED_BINARIES or
+      attempt >= FLAGS.max_command_attempts):
+    return None
+  kind = retry_policy.classify_error(error)
+  if kind is None:
+    return None
+  if kind != retry_policy.QUOTA_ERROR and binary == 'gcloud':
+    _, positionals, _ = split_gcloud_command(cmd[1:])
+    # The resource may have been created before a transient error.
+    if kind == retry_policy.TRANSIENT_ERROR and 'create' in positionals[:3]:
+      return None
+    # The policy to set holds the stale etag, so only re-reading the policy
+    # can resolve the conflict.
+    if kind == retry_policy.CONFLICT_ERROR and 'set-iam-policy' in positionals:
+      return None
+  return kind, retry_policy.get_backoff_secs(
+      attempt, FLAGS.command_retry_initial_secs, FLAGS.command_retry_max_secs)
+
+
+# Backend set through set_backend, overriding --gcloud_backend.
+_backend = None
+# Lazily created backend for --gcloud_backend=api.
+_api_backend = None
+_api_backend_lock = threading.Lock()
+
+
+def set_backend(backend):
+  """Sets the backend to run commands with.
+
+  Args:
+    backend: An object with check_call and check_output methods taking the
+      command to run, or None to choose the backend through --gcloud_backend.
+  """
+  global _backend
+  _backend = backend
+
+
+def get_backend():
+  """Gets the backend to run commands with."""
+  global _api_backend
+  if _backend is not None:
+    return _backend
+  if FLAGS.gcloud_backend != 'api':
+    return _SUBPROCESS_BACKEND
+  with _api_backend_lock:
+    if _api_backend is None:
+      if api_backend.is_available():
+        _api_backend = api_backend.ApiBackend(fallback=_SUBPROCESS_BACKEND)
+      else:
+        logging.warning('Google API client libraries are not installed, '
+                        'falling back to running gcloud in subprocesses.')
+        _api_backend = _SUBPROCESS_BACKEND
+    return _api_backend
 
 
 def run(f, *args, **kwargs):
@@ -29,13 +413,49 @@ def run(f, *args, **kwargs):
   return f(*args, **kwargs)
 
 
-def run_command(cmd, get_output=False):
-  """Runs the given command."""
+def run_command(cmd, get_output=False, project_id=None):
+  """Runs the given command.
+
+  Args:
+    cmd (List[str]): The command to run.
+    get_output (bool): Whether to return the output of the command.
+    project_id (str): The project the command is run for, if any, recorded by
+      the instrumentation.
+
+  Returns:
+    str: The output of the command, if get_output is True.
+  """
+  global _command_count
   logging.info('Executing command: %s', ' '.join(cmd))
+  with _command_count_lock:
+    _command_count += 1
+  backend = get_backend()
+  func = backend.check_output if get_output else backend.check_call
+  name = get_command_name(cmd)
+  attempt = 1
+  while True:
+    if not FLAGS.dry_run:
+      _get_rate_limiter().acquire(get_command_families(cmd))
+    try:
+      with instrumentation.span('command', name, project_id) as span:
+        output = run(func, cmd)
+        if get_output:
+          span.output_bytes = len(output)
+      break
+    except subprocess.CalledProcessError as e:
+      retry = _get_retry(cmd, e, attempt)
+      if retry is None:
+        raise
+      kind, delay = retry
+      logging.warning(
+          'Command failed with a %s error (attempt %d/%d), retrying in %.1f '
+          'seconds: %s', kind, attempt, FLAGS.max_command_attempts, delay,
+          ' '.join(cmd))
+      instrumentation.record_retry(name)
+      time.sleep(delay)
+      attempt += 1
   if get_output:
-    return run(subprocess.check_output, cmd).decode()
-  else:
-    run(subprocess.check_call, cmd)
+    return output.decode()
 
 
 def run_gcloud_command(cmd, project_id):
@@ -56,7 +476,33 @@ def run_gcloud_command(cmd, project_id):
   gcloud_cmd = ['gcloud'] + cmd
   if project_id:
     gcloud_cmd.extend(['--project', project_id])
-  return run_command(gcloud_cmd, get_output=True).strip()
+
+  service, positionals, flag_values = split_gcloud_command(cmd)
+  project = _get_command_project(service, positionals, flag_values,
+                                 project_id)
+  read_only = bool(_READ_ONLY_VERBS.intersection(positionals[:3]))
+  if not read_only:
+    # Any cached output this command could change is now stale.
+    if project is None or service in _ANY_SERVICE_MUTATORS:
+      _query_cache.invalidate(project)
+    else:
+      _query_cache.invalidate(project, service)
+    return run_command(gcloud_cmd, get_output=True,
+                       project_id=project).strip()
+
+  if (not FLAGS.cache_gcloud_queries or
+      _UNCACHED_GROUPS.intersection(positionals[:1])):
+    return run_command(gcloud_cmd, get_output=True,
+                       project_id=project).strip()
+  key = (project, service, tuple(gcloud_cmd))
+  output = _query_cache.get(key)
+  if output is None:
+    output = run_command(gcloud_cmd, get_output=True,
+                         project_id=project).strip()
+    _query_cache.put(key, output)
+  else:
+    logging.info('Using cached output of command: %s', ' '.join(gcloud_cmd))
+  return output
 
 
 def fake_run(f, *args, **kwargs):
@@ -69,7 +515,8 @@ def fake_run(f, *args, **kwargs):
   call += ')'
   logging.info(call)
 
-  if f != subprocess.check_output:
+  # Outputs are faked regardless of the backend producing them.
+  if f.__name__ != 'check_output':
     return call
 
   cmd = args[0]
@@ -81,8 +528,18 @@ def fake_run(f, *args, **kwargs):
       'gcloud', 'deployment-manager', 'deployments', 'list', '--format', 'json'
   ]:
     return '{}'
+  elif (cmd[:3] == ['gcloud', 'deployment-manager', 'deployments'] and
+        '--async' in cmd):
+    return '{"name": "__DRY_RUN_OPERATION__"}'
+  elif (cmd[:4] == ['gcloud', 'deployment-manager', 'deployments', 'describe']
+        and '--format' in cmd):
+    return '{}'
+  elif cmd[:4] == ['gcloud', 'deployment-manager', 'resources', 'list']:
+    return '[]'
+  elif cmd[:4] == ['gcloud', 'deployment-manager', 'operations', 'describe']:
+    return '{"name": "__DRY_RUN_OPERATION__", "status": "DONE"}'
   elif cmd[:3] == ['gcloud', 'projects', 'get-iam-policy']:
-    return '{ bindings: []}'
+    return '{"bindings": []}'
   elif cmd[:2] == ['gsutil', 'ls']:
     return 'gs://forseti-server-dry-run'
   else:
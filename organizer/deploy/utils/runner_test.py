@@ -0,0 +1,317 @@
+"""Tests for deploy.utils.runner."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest.mock
+
+from absl import flags
+from absl.testing import absltest
+
+from deploy.utils import instrumentation
+from deploy.utils import retry_policy
+from deploy.utils import runner
+
+FLAGS = flags.FLAGS
+
+
+class _FakeBackend(object):
+  """Backend recording the commands it is asked to run."""
+
+  def __init__(self):
+    self.cmds = []
+
+  def check_call(self, cmd):
+    self.cmds.append(cmd)
+    return 0
+
+  def check_output(self, cmd):
+    self.cmds.append(cmd)
+    return b'output\n'
+
+
+class _FailingBackend(_FakeBackend):
+  """Backend failing the first commands with the given error output."""
+
+  def __init__(self, stderr, failures=1):
+    super(_FailingBackend, self).__init__()
+    self.stderr = stderr
+    self.failures = failures
+
+  def check_call(self, cmd):
+    self.check_output(cmd)
+    return 0
+
+  def check_output(self, cmd):
+    self.cmds.append(cmd)
+    if len(self.cmds) <= self.failures:
+      raise subprocess.CalledProcessError(
+          1, cmd, output=b'', stderr=self.stderr)
+    return b'output\n'
+
+
+class RunnerTest(absltest.TestCase):
+
+  def setUp(self):
+    super(RunnerTest, self).setUp()
+    self.backend = _FakeBackend()
+    runner.set_backend(self.backend)
+    runner.reset_cache()
+
+  def tearDown(self):
+    runner.set_backend(None)
+    FLAGS.dry_run = True
+    FLAGS.api_rate_limits = []
+    super(RunnerTest, self).tearDown()
+
+  def test_run_gcloud_command_uses_backend(self):
+    FLAGS.dry_run = False
+    output = runner.run_gcloud_command(['projects', 'list'],
+                                       project_id='my-project')
+    self.assertEqual(output, 'output')
+    self.assertEqual(self.backend.cmds,
+                     [['gcloud', 'projects', 'list', '--project', 'my-project']])
+
+  def test_dry_run_fakes_backend_output(self):
+    FLAGS.dry_run = True
+    output = runner.run_gcloud_command(
+        ['compute', 'instances', 'list', '--format', 'value(name,id)'],
+        project_id='my-project')
+    self.assertEqual(output, '__DRY_RUN_NAME__ __DRY_RUN_ID__')
+    self.assertEmpty(self.backend.cmds)
+
+  def test_read_only_commands_are_cached(self):
+    FLAGS.dry_run = False
+    runner.reset_cache()
+    list_cmd = ['deployment-manager', 'deployments', 'list', '--format', 'json']
+    runner.run_gcloud_command(list_cmd, project_id='my-project')
+    runner.run_gcloud_command(list_cmd, project_id='my-project')
+    runner.run_gcloud_command(list_cmd, project_id='other-project')
+    self.assertLen(self.backend.cmds, 2)
+
+    # Modifying the project's deployments invalidates the cached list.
+    runner.run_gcloud_command(
+        ['deployment-manager', 'deployments', 'create', 'dep'],
+        project_id='my-project')
+    runner.run_gcloud_command(list_cmd, project_id='my-project')
+    runner.run_gcloud_command(list_cmd, project_id='other-project')
+    self.assertLen(self.backend.cmds, 4)
+
+  def test_cache_is_invalidated_by_service(self):
+    FLAGS.dry_run = False
+    runner.reset_cache()
+    describe_cmd = [
+        'projects', 'describe', 'my-project', '--format', 'value(projectNumber)'
+    ]
+    services_cmd = ['services', 'list', '--format', 'value(NAME)']
+    runner.run_gcloud_command(describe_cmd, project_id=None)
+    runner.run_gcloud_command(services_cmd, project_id='my-project')
+
+    runner.run_gcloud_command(['services', 'enable', 'iam.googleapis.com'],
+                              project_id='my-project')
+    runner.run_gcloud_command(describe_cmd, project_id=None)
+    runner.run_gcloud_command(services_cmd, project_id='my-project')
+
+    self.assertEqual(self.backend.cmds, [
+        ['gcloud'] + describe_cmd,
+        ['gcloud'] + services_cmd + ['--project', 'my-project'],
+        ['gcloud', 'services', 'enable', 'iam.googleapis.com', '--project',
+         'my-project'],
+        ['gcloud'] + services_cmd + ['--project', 'my-project'],
+    ])
+    self.assertEqual(runner._query_cache.hits, 1)
+    self.assertEqual(runner._query_cache.misses, 3)
+
+  def test_split_gcloud_command(self):
+    self.assertEqual(
+        runner.split_gcloud_command([
+            'alpha', 'resource-manager', 'liens', 'list', '--format',
+            'value(restrictions)', '--project=my-project'
+        ]), ('resource-manager', ['liens', 'list'], {
+            '--format': 'value(restrictions)',
+            '--project': 'my-project',
+        }))
+
+  def test_get_command_name(self):
+    self.assertEqual(
+        runner.get_command_name([
+            'gcloud', 'beta', 'billing', 'projects', 'link', 'my-project',
+            '--billing-account', '01234'
+        ]), 'gcloud billing projects link')
+    self.assertEqual(
+        runner.get_command_name(
+            ['gcloud', 'services', 'enable', 'a', 'b', '--project', 'p']),
+        'gcloud services enable')
+    self.assertEqual(
+        runner.get_command_name(
+            ['gsutil', '-m', 'rsync', '-c', 'dir', 'gs://bucket']),
+        'gsutil rsync')
+    self.assertEqual(
+        runner.get_command_name(['/path/to/apply', '--project', 'p']), 'apply')
+
+  def test_commands_are_instrumented(self):
+    FLAGS.dry_run = False
+    instrumentation.reset()
+    runner.run_gcloud_command(['services', 'list'], project_id='my-project')
+    runner.run_gcloud_command(['services', 'list'], project_id='other-project')
+
+    commands = instrumentation.get_report()['commands']
+    self.assertEqual(commands['gcloud services list']['calls'], 2)
+    self.assertEqual(commands['gcloud services list']['output_bytes'],
+                     2 * len(b'output\n'))
+
+  def test_quota_errors_are_retried(self):
+    FLAGS.dry_run = False
+    instrumentation.reset()
+    sleep = self.enter_context(unittest.mock.patch.object(time, 'sleep'))
+    backend = _FailingBackend(b'ERROR: RESOURCE_EXHAUSTED: Quota exceeded',
+                              failures=2)
+    runner.set_backend(backend)
+    output = runner.run_gcloud_command(['services', 'list'],
+                                       project_id='my-project')
+    self.assertEqual(output, 'output')
+    self.assertLen(backend.cmds, 3)
+    self.assertEqual(sleep.call_count, 2)
+    self.assertEqual(instrumentation.get_report()['retries'],
+                     {'gcloud services list': 2})
+
+  def test_retries_are_limited(self):
+    FLAGS.dry_run = False
+    self.enter_context(unittest.mock.patch.object(time, 'sleep'))
+    backend = _FailingBackend(b'ERROR: UNAVAILABLE', failures=100)
+    runner.set_backend(backend)
+    with self.assertRaises(subprocess.CalledProcessError):
+      runner.run_gcloud_command(['services', 'list'], project_id='my-project')
+    self.assertLen(backend.cmds, FLAGS.max_command_attempts)
+
+  def test_permanent_errors_are_not_retried(self):
+    FLAGS.dry_run = False
+    self.enter_context(unittest.mock.patch.object(time, 'sleep'))
+    backend = _FailingBackend(b'ERROR: PERMISSION_DENIED')
+    runner.set_backend(backend)
+    with self.assertRaises(subprocess.CalledProcessError):
+      runner.run_gcloud_command(['services', 'list'], project_id='my-project')
+    self.assertLen(backend.cmds, 1)
+
+  def test_transient_errors_of_creates_are_not_retried(self):
+    FLAGS.dry_run = False
+    self.enter_context(unittest.mock.patch.object(time, 'sleep'))
+    backend = _FailingBackend(b'ERROR: UNAVAILABLE')
+    runner.set_backend(backend)
+    with self.assertRaises(subprocess.CalledProcessError):
+      runner.run_gcloud_command(['projects', 'create', 'my-project'],
+                                project_id=None)
+    self.assertLen(backend.cmds, 1)
+
+  def test_conflicts_are_retried_unless_setting_a_read_policy(self):
+    FLAGS.dry_run = False
+    self.enter_context(unittest.mock.patch.object(time, 'sleep'))
+    conflict = b'ERROR: ABORTED: There were concurrent policy changes.'
+    backend = _FailingBackend(conflict)
+    runner.set_backend(backend)
+    runner.run_gcloud_command([
+        'projects', 'add-iam-policy-binding', 'my-project', '--member',
+        'user:a@x.com', '--role', 'roles/viewer'
+    ], project_id=None)
+    self.assertLen(backend.cmds, 2)
+
+    backend = _FailingBackend(conflict)
+    runner.set_backend(backend)
+    with self.assertRaises(subprocess.CalledProcessError):
+      runner.run_gcloud_command(
+          ['projects', 'set-iam-policy', 'my-project', 'policy.json'],
+          project_id=None)
+    self.assertLen(backend.cmds, 1)
+
+  def test_binaries_are_not_retried(self):
+    FLAGS.dry_run = False
+    self.enter_context(unittest.mock.patch.object(time, 'sleep'))
+    backend = _FailingBackend(b'ERROR: RESOURCE_EXHAUSTED')
+    runner.set_backend(backend)
+    with self.assertRaises(subprocess.CalledProcessError):
+      runner.run_command(['apply', '--project', 'my-project'])
+    self.assertLen(backend.cmds, 1)
+
+  def test_api_rate_limits(self):
+    FLAGS.dry_run = False
+    FLAGS.api_rate_limits = ['services=5']
+    with unittest.mock.patch.object(retry_policy.RateLimiter,
+                                    'acquire') as mock_acquire:
+      runner.run_gcloud_command(['services', 'list'], project_id='my-project')
+    mock_acquire.assert_called_once_with(['services list', 'services'])
+
+  def test_get_command_families(self):
+    self.assertEqual(
+        runner.get_command_families([
+            'gcloud', 'deployment-manager', 'operations', 'describe', 'op'
+        ]), ['deployment-manager operations', 'deployment-manager'])
+    self.assertEqual(runner.get_command_families(['/path/to/apply']),
+                     ['apply'])
+
+  def test_get_backend_from_flags(self):
+    runner.set_backend(None)
+    self.assertIsInstance(runner.get_backend(), runner.SubprocessBackend)
+
+
+class SubprocessBackendTest(absltest.TestCase):
+
+  def setUp(self):
+    super(SubprocessBackendTest, self).setUp()
+    self.backend = runner.SubprocessBackend()
+
+  def test_stderr_of_successful_command_is_shown(self):
+    cmd = [
+        sys.executable, '-c',
+        'import sys; sys.stderr.write("progress\\n"); print("output")'
+    ]
+    with unittest.mock.patch.object(sys, 'stderr', io.StringIO()) as stderr:
+      self.assertEqual(self.backend.check_output(cmd), b'output\n')
+      self.assertEqual(self.backend.check_call(cmd), 0)
+    self.assertEqual(stderr.getvalue(), 'progress\nprogress\n')
+
+  def test_stderr_is_shown_while_command_runs(self):
+    done_path = os.path.join(self.create_tempdir().full_path, 'done')
+    cmd = [
+        sys.executable, '-c',
+        ('import os, sys, time\n'
+         'sys.stderr.write("Continue [y/N]?")\n'
+         'sys.stderr.flush()\n'
+         'while not os.path.exists({!r}):\n'
+         '  time.sleep(0.01)\n').format(done_path)
+    ]
+    with unittest.mock.patch.object(sys, 'stderr', io.StringIO()) as stderr:
+      thread = threading.Thread(target=self.backend.check_call, args=(cmd,))
+      thread.start()
+      try:
+        deadline = time.time() + 30
+        while not stderr.getvalue() and time.time() < deadline:
+          time.sleep(0.01)
+        self.assertEqual(stderr.getvalue(), 'Continue [y/N]?')
+        self.assertTrue(thread.is_alive())
+      finally:
+        open(done_path, 'w').close()
+        thread.join()
+
+  def test_stderr_is_kept_for_errors(self):
+    cmd = [
+        sys.executable, '-c',
+        'import sys; sys.stderr.write("ERROR: UNAVAILABLE"); sys.exit(1)'
+    ]
+    with unittest.mock.patch.object(sys, 'stderr', io.StringIO()) as stderr:
+      with self.assertRaises(subprocess.CalledProcessError) as cm:
+        self.backend.check_call(cmd)
+    self.assertEqual(cm.exception.stderr, b'ERROR: UNAVAILABLE')
+    self.assertEqual(stderr.getvalue(), 'ERROR: UNAVAILABLE')
+    self.assertEqual(
+        retry_policy.classify_error(cm.exception), retry_policy.TRANSIENT_ERROR)
+
+
+if __name__ == '__main__':
+  absltest.main()
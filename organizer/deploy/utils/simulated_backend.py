@@ -0,0 +1,611 @@
+"""Backend simulating the gcloud commands run by the deployment scripts.
+
+SimulatedBackend keeps the state of projects, IAM policies, services,
+deployments and liens in memory and answers the gcloud commands the deployment
+scripts run the way gcloud would, without credentials or network access.
+Deployments are expanded locally with the Deployment Manager renderer, so
+template errors fail deployments and their VMs show up in instance listings.
+
+Every call can be delayed, failed at random and limited by a quota to model
+the latency, transient errors and quotas of the real services, and is recorded
+in a trace, so the orchestration overhead of the deployment scripts can be
+measured:
+
+  backend = simulated_backend.SimulatedBackend(
+      latencies={'deployment-manager deployments': 30, 'services': 5})
+  runner.set_backend(backend)
+
+Latencies, failure rates and quotas are keyed by command family: the gcloud
+service (e.g. 'services' or 'deployment-manager'), optionally followed by the
+command group (e.g. 'deployment-manager operations'). The most specific key
+applies. Commands other than gcloud (e.g. the Go binaries) change nothing, and
+are keyed by the name of the binary.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import copy
+import functools
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+
+import ruamel.yaml
+
+from deploy.utils import dm_renderer
+from deploy.utils import runner
+
+# Services enabled in new projects.
+_DEFAULT_SERVICES = frozenset([
+    'bigquery-json.googleapis.com',
+    'storage-api.googleapis.com',
+    'storage-component.googleapis.com',
+])
+
+_FIRST_PROJECT_NUMBER = 100000000000
+
+# A call recorded in the trace. Times are in seconds since the backend was
+# created, and error is the error message of failed calls, else None.
+Call = collections.namedtuple('Call', [
+    'command', 'family', 'project', 'thread', 'start_secs', 'duration_secs',
+    'error'
+])
+
+# A command being run: the full command, its service, the positional arguments
+# following the service, the flag values, the project it is run in and its
+# latency.
+_Request = collections.namedtuple('_Request', [
+    'cmd', 'service', 'positionals', 'flag_values', 'project', 'latency'
+])
+
+
+class _CommandError(Exception):
+  """A command failed, with the error gcloud would print."""
+
+
+class _Project(object):
+  """State of a simulated project."""
+
+  def __init__(self, project_id, number, parent, owner):
+    self.project_id = project_id
+    self.number = number
+    self.parent = parent
+    self.billing_account = None
+    self.iam_policy = {
+        'bindings': [{'role': 'roles/owner', 'members': [owner]}],
+        'etag': 'BwAAAAAAAAE=',
+        'version': 1,
+    }
+    self.services = set(_DEFAULT_SERVICES)
+    # Deployments by name, each a dict holding its config, imports and
+    # expanded resources.
+    self.deployments = {}
+    self.liens = []
+    self.images = set()
+    self.metadata = {}
+    # Email addresses of the notification channels, by channel name.
+    self.channels = {}
+    self.alert_policies = []
+    # IDs of the instances, by name, kept across deployment updates.
+    self.instance_ids = {}
+
+
+class SimulatedBackend(object):
+  """Runs gcloud commands against in-memory state.
+
+  Attributes:
+    projects (dict): The simulated projects, by ID.
+    trace (List[Call]): The calls run so far, in the order they finished.
+  """
+
+  def __init__(self,
+               latencies=None,
+               failure_rates=None,
+               quotas=None,
+               jitter=0,
+               seed=None,
+               account='user@domain.com',
+               sleep=time.sleep,
+               clock=time.time):
+    """Initialize.
+
+    Args:
+      latencies (dict): Seconds each call takes, by command family. Calls of
+        other families return at once.
+      failure_rates (dict): Probability that a call fails, by command family.
+        Calls of other families never fail.
+      quotas (dict): Calls allowed per second, by command family. Calls over
+        the quota fail with a RESOURCE_EXHAUSTED error.
+      jitter (float): Latencies vary at random by up to this fraction.
+      seed (int): Seed of the random failures and jitter, for reproducible
+        runs.
+      account (str): The account gcloud is authenticated as, which owns the
+        projects it creates.
+      sleep (Callable): Waits for the given number of seconds.
+      clock (Callable): Returns the current time in seconds.
+    """
+    self._latencies = latencies or {}
+    self._failure_rates = failure_rates or {}
+    self._quotas = quotas or {}
+    # Times of the calls of the last second, by family with a quota.
+    self._quota_calls = collections.defaultdict(collections.deque)
+    self._jitter = jitter
+    self._random = random.Random(seed)
+    self._account = account
+    self._sleep = sleep
+    self._clock = clock
+    self._start = clock()
+    self._lock = threading.Lock()
+    self._operations = {}
+    self._next_id = 0
+    self.projects = {}
+    self.trace = []
+
+  def check_call(self, cmd):
+    """Runs a command without capturing its output."""
+    self.check_output(cmd)
+    return 0
+
+  def check_output(self, cmd):
+    """Runs a command and returns its output as bytes.
+
+    Args:
+      cmd (List[str]): The command to run.
+
+    Returns:
+      bytes: The output of the command, formatted as gcloud would.
+
+    Raises:
+      CalledProcessError: if the command failed.
+    """
+    families = runner.get_command_families(cmd)
+    service, positionals, flag_values = runner.split_gcloud_command(cmd[1:])
+    if cmd[0] != 'gcloud':
+      # Binaries are only traced, but may be given a --project too.
+      service, positionals = None, []
+    request = _Request(cmd, service, positionals, flag_values,
+                       _get_command_project(service, positionals, flag_values),
+                       self._get_latency(families))
+
+    start = self._clock()
+    error = None
+    try:
+      if self._exceeds_quota(families, start):
+        raise _CommandError(
+            'RESOURCE_EXHAUSTED: Quota exceeded for quota metric '
+            '\'{}\' requests per second.'.format(families[-1]))
+      # Operations of asynchronous commands take the latency instead.
+      if '--async' not in cmd and request.latency:
+        self._sleep(request.latency)
+      if self._should_fail(families):
+        raise _CommandError('UNAVAILABLE: Simulated transient failure.')
+      if service is None:
+        output = ''
+      else:
+        with self._lock:
+          output = self._run(request)
+    except _CommandError as e:
+      error = str(e)
+      # Like gcloud, errors are printed to stderr.
+      raise subprocess.CalledProcessError(
+          1, cmd, output=b'', stderr=error.encode())
+    finally:
+      self._record(
+          Call(
+              command=' '.join(cmd),
+              family=families[-1],
+              project=request.project,
+              thread=threading.current_thread().name,
+              start_secs=start - self._start,
+              duration_secs=self._clock() - start,
+              error=error))
+    return output.encode()
+
+  def write_trace(self, path):
+    """Writes the trace to a file, as a JSON list of calls."""
+    with self._lock:
+      trace = [call._asdict() for call in self.trace]
+    with open(path, 'w') as f:
+      json.dump(trace, f, indent=2)
+
+  def _get_latency(self, families):
+    latency = _get_family_value(self._latencies, families)
+    if not latency or not self._jitter:
+      return latency
+    with self._lock:
+      return latency * (1 + self._random.uniform(-self._jitter, self._jitter))
+
+  def _exceeds_quota(self, families, now):
+    """Counts a call towards its family's quota, if any, and checks it."""
+    family = next((f for f in families if f in self._quotas), None)
+    if family is None:
+      return False
+    with self._lock:
+      calls = self._quota_calls[family]
+      while calls and calls[0] <= now - 1:
+        calls.popleft()
+      if len(calls) >= self._quotas[family]:
+        return True
+      calls.append(now)
+      return False
+
+  def _should_fail(self, families):
+    rate = _get_family_value(self._failure_rates, families)
+    if not rate:
+      return False
+    with self._lock:
+      return self._random.random() < rate
+
+  def _record(self, call):
+    with self._lock:
+      self.trace.append(call)
+
+  def _run(self, request):
+    """Runs a gcloud command, with the lock held."""
+    command = (request.service,) + tuple(request.positionals)
+    for prefix, handler in _HANDLERS:
+      if command[:len(prefix)] == prefix:
+        return handler(self, request)
+    raise _CommandError('Unsupported command: gcloud {}'.format(' '.join(
+        command)))
+
+  def _new_id(self):
+    self._next_id += 1
+    return self._next_id
+
+  def _get_project(self, request):
+    project = self.projects.get(request.project)
+    if project is None:
+      raise _CommandError('NOT_FOUND: Project {} not found.'.format(
+          request.project))
+    return project
+
+  def _get_deployment(self, request, name):
+    deployment = self._get_project(request).deployments.get(name)
+    if deployment is None:
+      raise _CommandError('NOT_FOUND: Deployment {} not found.'.format(name))
+    return deployment
+
+  def _projects_create(self, request):
+    project_id = request.positionals[1]
+    if project_id in self.projects:
+      raise _CommandError(
+          'ALREADY_EXISTS: Project {} already exists.'.format(project_id))
+    parent = None
+    if '--folder' in request.flag_values:
+      parent = 'folders/' + request.flag_values['--folder']
+    elif '--organization' in request.flag_values:
+      parent = 'organizations/' + request.flag_values['--organization']
+    self.projects[project_id] = _Project(
+        project_id, _FIRST_PROJECT_NUMBER + len(self.projects), parent,
+        'user:' + self._account)
+    return ''
+
+  def _projects_describe(self, request):
+    project = self._get_project(request)
+    if request.flag_values.get('--format') == 'value(projectNumber)':
+      return str(project.number)
+    return json.dumps({
+        'projectId': project.project_id,
+        'projectNumber': str(project.number),
+        'lifecycleState': 'ACTIVE',
+    })
+
+  def _projects_get_iam_policy(self, request):
+    return json.dumps(self._get_project(request).iam_policy)
+
+  def _projects_set_iam_policy(self, request):
+    project = self._get_project(request)
+    policy = _read_yaml(request.positionals[2])
+    etag = policy.get('etag')
+    if etag and etag != project.iam_policy['etag']:
+      raise _CommandError(
+          'ABORTED: There were concurrent policy changes. Please retry the '
+          'whole read-modify-write with exponential backoff.')
+    self._set_iam_policy(project, policy.get('bindings', []))
+    return json.dumps(project.iam_policy)
+
+  def _modify_iam_policy_binding(self, request, add):
+    """Handles `projects add|remove-iam-policy-binding PROJECT`."""
+    project = self._get_project(request)
+    member = request.flag_values['--member']
+    role = request.flag_values['--role']
+    bindings = [
+        dict(b, members=list(b['members']))
+        for b in project.iam_policy['bindings']
+    ]
+    binding = next((b for b in bindings if b['role'] == role), None)
+    if add:
+      if binding is None:
+        binding = {'role': role, 'members': []}
+        bindings.append(binding)
+      if member not in binding['members']:
+        binding['members'].append(member)
+    elif binding is not None and member in binding['members']:
+      binding['members'].remove(member)
+    self._set_iam_policy(project, bindings)
+    return json.dumps(project.iam_policy)
+
+  def _set_iam_policy(self, project, bindings):
+    project.iam_policy = {
+        'bindings': [b for b in bindings if b['members']],
+        'etag': 'BwAAAAAA{:04d}='.format(self._new_id()),
+        'version': 1,
+    }
+
+  def _billing_projects_link(self, request):
+    project = self._get_project(request)
+    project.billing_account = request.flag_values['--billing-account']
+    return ''
+
+  def _services_list(self, request):
+    return '\n'.join(sorted(self._get_project(request).services))
+
+  def _services_enable(self, request):
+    self._get_project(request).services.update(request.positionals[1:])
+    return ''
+
+  def _services_disable(self, request):
+    self._get_project(request).services.difference_update(
+        request.positionals[1:])
+    return ''
+
+  def _deployments_list(self, request):
+    project = self._get_project(request)
+    return json.dumps([{
+        'name': name,
+        'manifest': deployment['manifest'],
+    } for name, deployment in sorted(project.deployments.items())])
+
+  def _deployments_create_or_update(self, request):
+    """Handles `deployment-manager deployments create|update NAME`."""
+    project = self._get_project(request)
+    verb, name = request.positionals[1:3]
+    if verb == 'create' and name in project.deployments:
+      raise _CommandError(
+          'ALREADY_EXISTS: Deployment {} already exists.'.format(name))
+    if verb == 'update':
+      deployment = self._get_deployment(request, name)
+      if '--config' not in request.flag_values:
+        # Updating without a config commits the preview.
+        preview = deployment.pop('preview', None)
+        if preview is None:
+          raise _CommandError(
+              'FAILED_PRECONDITION: Deployment {} has no preview.'.format(name))
+        self._deploy(project, name, *preview)
+        return self._start_operation(request)
+
+    config_path = request.flag_values['--config']
+    config = _read_yaml(config_path)
+    # Deployment Manager reads imports relative to the config.
+    config_dir = os.path.dirname(config_path)
+    if '--preview' in request.cmd:
+      self._get_deployment(request, name)['preview'] = (config, config_dir)
+    else:
+      self._deploy(project, name, config, config_dir)
+    return self._start_operation(request)
+
+  def _deploy(self, project, name, config, config_dir):
+    """Expands a deployment's config and records its resources."""
+    local_config = copy.deepcopy(config)
+    for imp in local_config.get('imports', []):
+      imp['path'] = os.path.join(config_dir, imp['path'])
+    try:
+      expanded = dm_renderer.render(local_config, project.project_id, name,
+                                    project_number=project.number)
+      imports = []
+      for imp in local_config.get('imports', []):
+        with open(imp['path']) as f:
+          imports.append({'name': imp['path'], 'content': f.read()})
+    except (dm_renderer.RenderError, IOError) as e:
+      raise _CommandError('Error in Operation: {}'.format(e))
+    for resource in expanded['resources']:
+      if resource.get('type') == 'compute.v1.instance':
+        project.instance_ids.setdefault(resource['name'], self._new_id())
+    project.deployments[name] = {
+        'manifest': 'manifest-{}'.format(self._new_id()),
+        'config': config,
+        'imports': imports,
+        'resources': expanded['resources'],
+    }
+
+  def _start_operation(self, request):
+    """Starts the operation of a deployment change, and describes it."""
+    name = 'operation-{}'.format(self._new_id())
+    done_secs = self._clock()
+    if '--async' in request.cmd:
+      done_secs += request.latency
+    self._operations[name] = done_secs
+    if request.flag_values.get('--format') == 'json':
+      return json.dumps({'name': name, 'status': 'PENDING'})
+    return ''
+
+  def _deployments_describe(self, request):
+    name = request.positionals[2]
+    deployment = self._get_deployment(request, name)
+    description = {
+        'name': name,
+        'manifest': 'projects/{}/global/deployments/{}/manifests/{}'.format(
+            request.project, name, deployment['manifest']),
+    }
+    if request.flag_values.get('--format') == 'json':
+      return json.dumps({'deployment': description})
+    return json.dumps(description)
+
+  def _manifests_describe(self, request):
+    deployment = self._get_deployment(request,
+                                      request.flag_values['--deployment'])
+    if request.positionals[2] != deployment['manifest']:
+      raise _CommandError('NOT_FOUND: Manifest {} not found.'.format(
+          request.positionals[2]))
+    return json.dumps({
+        'name': deployment['manifest'],
+        'config': {'content': json.dumps(deployment['config'])},
+        'imports': deployment['imports'],
+    })
+
+  def _resources_list(self, request):
+    deployment = self._get_deployment(request,
+                                      request.flag_values['--deployment'])
+    return json.dumps([{
+        'name': resource['name'],
+        'type': resource.get('type', resource.get('action')),
+    } for resource in deployment['resources']])
+
+  def _operations_describe(self, request):
+    name = request.positionals[2]
+    if name not in self._operations:
+      raise _CommandError('NOT_FOUND: Operation {} not found.'.format(name))
+    done = self._clock() >= self._operations[name]
+    return json.dumps({'name': name, 'status': 'DONE' if done else 'RUNNING'})
+
+  def _liens_list(self, request):
+    return '\n'.join(self._get_project(request).liens)
+
+  def _liens_create(self, request):
+    self._get_project(request).liens.append(
+        request.flag_values['--restrictions'])
+    return ''
+
+  def _instances_list(self, request):
+    project = self._get_project(request)
+    lines = []
+    for deployment in project.deployments.values():
+      for resource in deployment['resources']:
+        if resource.get('type') == 'compute.v1.instance':
+          lines.append('{} {}'.format(resource['name'],
+                                      project.instance_ids[resource['name']]))
+    return '\n'.join(sorted(lines))
+
+  def _images_list(self, request):
+    images = self._get_project(request).images
+    name_filter = request.flag_values.get('--filter', '')
+    if name_filter.startswith('name='):
+      images = images & {name_filter[len('name='):]}
+    return '\n'.join(sorted(images))
+
+  def _images_create(self, request):
+    self._get_project(request).images.add(request.positionals[2])
+    return ''
+
+  def _add_metadata(self, request):
+    project = self._get_project(request)
+    for item in request.flag_values['--metadata'].split(','):
+      key, _, value = item.partition('=')
+      project.metadata[key] = value
+    return ''
+
+  def _channels_list(self, request):
+    channels = self._get_project(request).channels
+    return '\n'.join('{} {}'.format(name, email)
+                     for name, email in sorted(channels.items()))
+
+  def _channels_create(self, request):
+    project = self._get_project(request)
+    channel = _read_yaml(request.flag_values['--channel-content-from-file'])
+    name = 'projects/{}/notificationChannels/{}'.format(
+        request.project, self._new_id())
+    project.channels[name] = channel['labels']['email_address']
+    return name
+
+  def _policies_list(self, request):
+    return '\n'.join(self._get_project(request).alert_policies)
+
+  def _policies_create(self, request):
+    policy = _read_yaml(request.flag_values['--policy-from-file'])
+    self._get_project(request).alert_policies.append(policy['displayName'])
+    return ''
+
+  def _sinks_describe(self, request):
+    project = self._get_project(request)
+    return ('serviceAccount:p{}-123456@gcp-sa-logging.iam.gserviceaccount.com'
+            .format(project.number))
+
+  def _config_list_account(self, request):
+    del request  # Unused.
+    return self._account
+
+
+def _get_family_value(values, families):
+  """Gets the value of the most specific of the given command families."""
+  for family in families:
+    if family in values:
+      return values[family]
+  return 0
+
+
+def _get_command_project(service, positionals, flag_values):
+  """Gets the ID of the project a gcloud command is run in, if any."""
+  if '--project' in flag_values:
+    return flag_values['--project']
+  # Commands like `projects describe PROJECT` or
+  # `billing projects link PROJECT`.
+  args = [service] + positionals
+  if 'projects' in args:
+    args = args[args.index('projects') + 1:]
+    if len(args) >= 2:
+      return args[1]
+  return None
+
+
+def _read_yaml(path):
+  """Reads a YAML (or JSON) file passed to a command."""
+  try:
+    with open(path) as f:
+      return ruamel.yaml.YAML(typ='safe').load(f) or {}
+  except IOError as e:
+    raise _CommandError('Unable to read file {}: {}'.format(path, e))
+
+
+# Handlers of supported commands, keyed by their service and leading positional
+# arguments.
+_HANDLERS = [
+    (('projects', 'create'), SimulatedBackend._projects_create),
+    (('projects', 'describe'), SimulatedBackend._projects_describe),
+    (('projects', 'get-iam-policy'),
+     SimulatedBackend._projects_get_iam_policy),
+    (('projects', 'set-iam-policy'),
+     SimulatedBackend._projects_set_iam_policy),
+    (('projects', 'add-iam-policy-binding'),
+     functools.partial(SimulatedBackend._modify_iam_policy_binding, add=True)),
+    (('projects', 'remove-iam-policy-binding'),
+     functools.partial(
+         SimulatedBackend._modify_iam_policy_binding, add=False)),
+    (('billing', 'projects', 'link'), SimulatedBackend._billing_projects_link),
+    (('services', 'list'), SimulatedBackend._services_list),
+    (('services', 'enable'), SimulatedBackend._services_enable),
+    (('services', 'disable'), SimulatedBackend._services_disable),
+    (('deployment-manager', 'deployments', 'list'),
+     SimulatedBackend._deployments_list),
+    (('deployment-manager', 'deployments', 'create'),
+     SimulatedBackend._deployments_create_or_update),
+    (('deployment-manager', 'deployments', 'update'),
+     SimulatedBackend._deployments_create_or_update),
+    (('deployment-manager', 'deployments', 'describe'),
+     SimulatedBackend._deployments_describe),
+    (('deployment-manager', 'manifests', 'describe'),
+     SimulatedBackend._manifests_describe),
+    (('deployment-manager', 'resources', 'list'),
+     SimulatedBackend._resources_list),
+    (('deployment-manager', 'operations', 'describe'),
+     SimulatedBackend._operations_describe),
+    (('resource-manager', 'liens', 'list'), SimulatedBackend._liens_list),
+    (('resource-manager', 'liens', 'create'), SimulatedBackend._liens_create),
+    (('compute', 'instances', 'list'), SimulatedBackend._instances_list),
+    (('compute', 'images', 'list'), SimulatedBackend._images_list),
+    (('compute', 'images', 'create'), SimulatedBackend._images_create),
+    (('compute', 'project-info', 'add-metadata'),
+     SimulatedBackend._add_metadata),
+    (('monitoring', 'channels', 'list'), SimulatedBackend._channels_list),
+    (('monitoring', 'channels', 'create'), SimulatedBackend._channels_create),
+    (('monitoring', 'policies', 'list'), SimulatedBackend._policies_list),
+    (('monitoring', 'policies', 'create'), SimulatedBackend._policies_create),
+    (('logging', 'sinks', 'describe'), SimulatedBackend._sinks_describe),
+    (('config', 'list', 'account'), SimulatedBackend._config_list_account),
+]
@@ -0,0 +1,196 @@
+"""Tests for deploy.utils.simulated_backend."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+
+from absl.testing import absltest
+
+from deploy.utils import simulated_backend
+
+
+class _FakeClock(object):
+  """Clock advanced by sleeping."""
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def sleep(self, secs):
+    self.now += secs
+
+  def time(self):
+    return self.now
+
+
+class SimulatedBackendTest(absltest.TestCase):
+
+  def setUp(self):
+    super(SimulatedBackendTest, self).setUp()
+    self.clock = _FakeClock()
+    self.backend = simulated_backend.SimulatedBackend(
+        sleep=self.clock.sleep, clock=self.clock.time)
+
+  def gcloud(self, *args, **kwargs):
+    backend = kwargs.get('backend', self.backend)
+    return backend.check_output(['gcloud'] + list(args)).decode()
+
+  def test_create_project(self):
+    self.gcloud('projects', 'create', 'my-project', '--organization', '12345')
+    self.assertEqual(
+        self.gcloud('projects', 'describe', 'my-project', '--format',
+                    'value(projectNumber)'), '100000000000')
+    self.gcloud('services', 'enable', 'compute.googleapis.com', '--project',
+                'my-project')
+    self.assertIn('compute.googleapis.com',
+                  self.gcloud('services', 'list', '--format', 'value(NAME)',
+                              '--project', 'my-project').split('\n'))
+
+    project = self.backend.projects['my-project']
+    self.assertEqual(project.parent, 'organizations/12345')
+
+    with self.assertRaises(subprocess.CalledProcessError):
+      self.gcloud('projects', 'create', 'my-project')
+
+  def test_unknown_project(self):
+    with self.assertRaises(subprocess.CalledProcessError) as cm:
+      self.gcloud('services', 'list', '--project', 'unknown')
+    self.assertIn(b'NOT_FOUND', cm.exception.stderr)
+
+  def test_unsupported_command(self):
+    with self.assertRaises(subprocess.CalledProcessError):
+      self.gcloud('sql', 'instances', 'list')
+
+  def test_iam_policy(self):
+    self.gcloud('projects', 'create', 'my-project')
+    self.gcloud('projects', 'add-iam-policy-binding', 'my-project', '--member',
+                'user:a@domain.com', '--role', 'roles/viewer')
+    policy = json.loads(self.gcloud('projects', 'get-iam-policy', 'my-project',
+                                    '--format', 'json'))
+    self.assertIn({
+        'role': 'roles/viewer',
+        'members': ['user:a@domain.com']
+    }, policy['bindings'])
+
+    policy_path = self.create_tempfile(content=json.dumps(policy)).full_path
+    # Any other change makes the read policy stale.
+    self.gcloud('projects', 'remove-iam-policy-binding', 'my-project',
+                '--member', 'user:a@domain.com', '--role', 'roles/viewer')
+    with self.assertRaises(subprocess.CalledProcessError) as cm:
+      self.gcloud('projects', 'set-iam-policy', 'my-project', policy_path)
+    self.assertIn(b'ABORTED', cm.exception.stderr)
+
+  def test_deployment(self):
+    self.gcloud('projects', 'create', 'my-project')
+    path = os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), 'templates/gce_vms.py')
+    config = {
+        'imports': [{'path': os.path.abspath(path)}],
+        'resources': [{
+            'type': os.path.abspath(path),
+            'name': 'gce-vms',
+            'properties': {
+                'gce_instances': [{
+                    'name': 'vm-1',
+                    'zone': 'us-central1-f',
+                    'machine_type': 'n1-standard-1',
+                    'boot_image_name': 'global/images/my-image',
+                    'start_vm': True,
+                }],
+                'firewall_rules': [],
+            },
+        }],
+    }
+    config_file = self.create_tempfile(
+        file_path='config.yaml', content=json.dumps(config))
+
+    self.gcloud('deployment-manager', 'deployments', 'create', 'gce-vms',
+                '--config', config_file.full_path,
+                '--automatic-rollback-on-error',
+                '--project', 'my-project')
+    deployments = json.loads(
+        self.gcloud('deployment-manager', 'deployments', 'list', '--format',
+                    'json', '--project', 'my-project'))
+    self.assertEqual([d['name'] for d in deployments], ['gce-vms'])
+    instances = self.gcloud('compute', 'instances', 'list', '--format',
+                            'value(name,id)', '--project', 'my-project')
+    self.assertRegex(instances, r'^vm-1 \d+$')
+
+    # Template errors fail the deployment.
+    del config['resources'][0]['properties']['gce_instances'][0]['zone']
+    config_file.write_text(json.dumps(config))
+    with self.assertRaises(subprocess.CalledProcessError):
+      self.gcloud('deployment-manager', 'deployments', 'update', 'gce-vms',
+                  '--config', config_file.full_path, '--project',
+                  'my-project')
+
+  def test_async_operation(self):
+    backend = simulated_backend.SimulatedBackend(
+        latencies={'deployment-manager deployments': 30},
+        sleep=self.clock.sleep,
+        clock=self.clock.time)
+    self.gcloud('projects', 'create', 'my-project', backend=backend)
+    config_path = self.create_tempfile(
+        file_path='config.yaml', content='resources: []').full_path
+
+    operation = json.loads(
+        self.gcloud('deployment-manager', 'deployments', 'create', 'empty',
+                    '--config', config_path, '--async', '--format', 'json',
+                    '--project', 'my-project', backend=backend))
+    describe = ('deployment-manager', 'operations', 'describe',
+                operation['name'], '--format', 'json', '--project',
+                'my-project')
+    self.assertEqual(
+        json.loads(self.gcloud(*describe, backend=backend))['status'],
+        'RUNNING')
+    self.clock.sleep(30)
+    self.assertEqual(
+        json.loads(self.gcloud(*describe, backend=backend))['status'], 'DONE')
+
+  def test_latencies_and_trace(self):
+    backend = simulated_backend.SimulatedBackend(
+        latencies={'projects': 2, 'projects create': 5},
+        sleep=self.clock.sleep,
+        clock=self.clock.time)
+    self.gcloud('projects', 'create', 'my-project', backend=backend)
+    self.gcloud('projects', 'describe', 'my-project', backend=backend)
+    backend.check_call(['apply', '--project', 'my-project'])
+
+    self.assertEqual([(call.family, call.project, call.start_secs,
+                       call.duration_secs, call.error)
+                      for call in backend.trace],
+                     [('projects', 'my-project', 0, 5, None),
+                      ('projects', 'my-project', 5, 2, None),
+                      ('apply', 'my-project', 7, 0, None)])
+
+    trace_path = self.create_tempfile().full_path
+    backend.write_trace(trace_path)
+    with open(trace_path) as f:
+      self.assertLen(json.load(f), 3)
+
+  def test_quotas(self):
+    backend = simulated_backend.SimulatedBackend(
+        quotas={'projects': 1}, sleep=self.clock.sleep, clock=self.clock.time)
+    self.gcloud('projects', 'create', 'my-project', backend=backend)
+    with self.assertRaises(subprocess.CalledProcessError) as cm:
+      self.gcloud('projects', 'describe', 'my-project', backend=backend)
+    self.assertIn(b'RESOURCE_EXHAUSTED', cm.exception.stderr)
+    self.clock.sleep(1)
+    self.gcloud('projects', 'describe', 'my-project', backend=backend)
+
+  def test_failure_rates(self):
+    backend = simulated_backend.SimulatedBackend(
+        failure_rates={'projects': 1}, seed=0)
+    with self.assertRaises(subprocess.CalledProcessError) as cm:
+      self.gcloud('projects', 'create', 'my-project', backend=backend)
+    self.assertIn(b'UNAVAILABLE', cm.exception.stderr)
+    # Failed calls change nothing.
+    self.assertEmpty(backend.projects)
+    self.assertIsNotNone(backend.trace[0].error)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,112 @@
+"""state_store keeps generated_fields in a local SQLite database.
+
+Each project's generated_fields are stored in their own row, so updating a
+project is a small transactional write rather than a rewrite of the whole
+project YAML. Several deployments, in the same or different processes, can
+share a database.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import sqlite3
+import threading
+
+# Seconds to wait for another process to release the database lock.
+_LOCK_TIMEOUT_SECS = 60
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS projects (
+         project_id TEXT PRIMARY KEY,
+         fields TEXT NOT NULL
+       )""",
+    """CREATE TABLE IF NOT EXISTS forseti (
+         id INTEGER PRIMARY KEY CHECK (id = 0),
+         fields TEXT NOT NULL
+       )""",
+]
+
+
+class StateStore(object):
+  """Stores the generated_fields of projects and Forseti in SQLite."""
+
+  def __init__(self, path):
+    """Opens the database, creating it if it does not exist.
+
+    Args:
+      path (str): Path of the SQLite database file.
+    """
+    self.path = path
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(
+        path, timeout=_LOCK_TIMEOUT_SECS, check_same_thread=False)
+    with self._lock, self._conn:
+      # Write-ahead logging lets readers proceed while another process writes.
+      self._conn.execute('PRAGMA journal_mode=WAL')
+      for statement in _SCHEMA:
+        self._conn.execute(statement)
+
+  def close(self):
+    with self._lock:
+      self._conn.close()
+
+  def put_project(self, project_id, fields):
+    """Replaces the generated_fields of a project."""
+    with self._lock, self._conn:
+      self._conn.execute(
+          'INSERT OR REPLACE INTO projects (project_id, fields) VALUES (?, ?)',
+          (project_id, json.dumps(fields, default=str)))
+
+  def put_forseti(self, fields):
+    """Replaces the generated_fields of the Forseti instance."""
+    with self._lock, self._conn:
+      self._conn.execute(
+          'INSERT OR REPLACE INTO forseti (id, fields) VALUES (0, ?)',
+          (json.dumps(fields, default=str),))
+
+  def put_all(self, all_fields):
+    """Replaces the generated_fields of the given projects and Forseti.
+
+    Args:
+      all_fields (dict): A generated_fields block, with the fields of projects
+        under 'projects' and of Forseti under 'forseti'.
+    """
+    with self._lock, self._conn:
+      self._conn.executemany(
+          'INSERT OR REPLACE INTO projects (project_id, fields) VALUES (?, ?)',
+          [(project_id, json.dumps(fields, default=str))
+           for project_id, fields in all_fields.get('projects', {}).items()])
+      if all_fields.get('forseti'):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO forseti (id, fields) VALUES (0, ?)',
+            (json.dumps(all_fields['forseti'], default=str),))
+
+  def get_all(self):
+    """Gets all stored generated_fields.
+
+    Returns:
+      dict: A generated_fields block, with the fields of projects under
+        'projects' and of Forseti (if stored) under 'forseti'.
+    """
+    with self._lock:
+      projects = self._conn.execute(
+          'SELECT project_id, fields FROM projects ORDER BY project_id'
+      ).fetchall()
+      forseti = self._conn.execute(
+          'SELECT fields FROM forseti WHERE id = 0').fetchone()
+    all_fields = {
+        'projects': {
+            project_id: json.loads(fields) for project_id, fields in projects
+        }
+    }
+    if forseti:
+      all_fields['forseti'] = json.loads(forseti[0])
+    return all_fields
+
+  def is_empty(self):
+    with self._lock:
+      return not (
+          self._conn.execute('SELECT 1 FROM projects LIMIT 1').fetchone() or
+          self._conn.execute('SELECT 1 FROM forseti LIMIT 1').fetchone())
@@ -0,0 +1,56 @@
+"""Tests for deploy.utils.state_store."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+from absl.testing import absltest
+
+from deploy.utils import state_store
+
+
+class StateStoreTest(absltest.TestCase):
+
+  def setUp(self):
+    super(StateStoreTest, self).setUp()
+    self.path = os.path.join(self.create_tempdir().full_path, 'state.db')
+    self.store = state_store.StateStore(self.path)
+
+  def tearDown(self):
+    self.store.close()
+    super(StateStoreTest, self).tearDown()
+
+  def test_put_and_get(self):
+    self.assertTrue(self.store.is_empty())
+    self.store.put_all({
+        'projects': {
+            'project-1': {'project_number': '1'},
+            'project-2': {'project_number': '2', 'failed_step': 3},
+        },
+        'forseti': {'server_bucket': 'gs://forseti-server/'},
+    })
+    self.store.put_project('project-2', {'project_number': '2'})
+    self.assertFalse(self.store.is_empty())
+    self.assertEqual(
+        self.store.get_all(), {
+            'projects': {
+                'project-1': {'project_number': '1'},
+                'project-2': {'project_number': '2'},
+            },
+            'forseti': {'server_bucket': 'gs://forseti-server/'},
+        })
+
+  def test_shared_between_stores(self):
+    other = state_store.StateStore(self.path)
+    try:
+      other.put_project('project-1', {'project_number': '1'})
+      self.store.put_forseti({'service_account': 'forseti@x.com'})
+      self.assertEqual(self.store.get_all(), other.get_all())
+    finally:
+      other.close()
+
+
+if __name__ == '__main__':
+  absltest.main()
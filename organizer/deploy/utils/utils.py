@@ -4,23 +4,51 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import copy
 import glob
+import hashlib
+import io
 import json
 import os
+import shutil
 import string
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 
 from absl import flags
+from absl import logging
 
 import jsonschema
 import ruamel.yaml
 
+from deploy.utils import dm_renderer
+from deploy.utils import instrumentation
+from deploy.utils import retry_policy
 from deploy.utils import runner
 
 FLAGS = flags.FLAGS
 
+flags.DEFINE_bool('batch_iam_policy_updates', False,
+                  ('Make all IAM binding changes to a project with a single '
+                   'update of its IAM policy instead of one update per '
+                   'binding.'))
+flags.DEFINE_bool('diff_deployments', False,
+                  ('Skip updating Deployment Manager deployments whose '
+                   'deployed config and imports match the local ones. Other '
+                   'updates are previewed and their resource changes logged '
+                   'before they are applied.'))
+flags.DEFINE_bool('async_deployments', False,
+                  ('Submit Deployment Manager deployments without waiting and '
+                   'poll their operations, instead of blocking a gcloud '
+                   'process per deployment until it is done.'))
+flags.DEFINE_bool('render_deployments_locally', False,
+                  ('Expand Deployment Manager templates locally before '
+                   'submitting deployments, so template errors are reported '
+                   'before any deployment is created or updated.'))
+
 # Schema file for project configuration YAML files.
 _PROJECT_CONFIG_SCHEMA = os.path.join(
     os.path.dirname(__file__), '../project_config.yaml.schema')
@@ -30,6 +58,45 @@ IMPORT_PATTERN_TAG = 'imports'
 # Merge the files in import_files into the dict where it is declared.
 IMPORT_FILES_TAG = 'import_files'
 
+# Number of attempts to update an IAM policy, which fails if the policy was
+# modified since it was read, and the backoff between them.
+_IAM_POLICY_UPDATE_ATTEMPTS = 5
+_IAM_POLICY_RETRY_INITIAL_SECS = 1
+_IAM_POLICY_RETRY_MAX_SECS = 10
+
+# Polling intervals while waiting for IAM bindings to become effective.
+_IAM_BINDINGS_INITIAL_POLL_SECS = 2
+_IAM_BINDINGS_MAX_POLL_SECS = 16
+
+# Intents of resources previewed in a deployment update that change nothing.
+_UNCHANGED_RESOURCE_INTENTS = frozenset(['', 'ACQUIRE'])
+
+# Extensions of Deployment Manager templates, which gcloud uploads with the
+# schema file next to them.
+_TEMPLATE_EXTENSIONS = ('.jinja', '.py')
+
+# Polling intervals while waiting for Deployment Manager operations.
+_DEPLOYMENT_INITIAL_POLL_SECS = 2
+_DEPLOYMENT_MAX_POLL_SECS = 16
+
+# Per-user directory caching the project config schema as JSON, which is much
+# faster to load than the YAML schema.
+_SCHEMA_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'healthcare_deploy', 'schemas')
+
+# Validators of loaded schemas, keyed by path and content hash.
+_schema_validators = {}
+_schema_validators_lock = threading.Lock()
+
+# Parsed YAML files, keyed by path and whether they were parsed for round trip,
+# holding the SHA-256 digest of the parsed content and the parsed document.
+_yaml_cache = {}
+_yaml_cache_lock = threading.Lock()
+
+# Serializes user prompts from projects deployed concurrently.
+_PROMPT_LOCK = threading.Lock()
+
 
 def normalize_path(path):
   """Normalizes paths specified through a local run or Bazel invocation."""
@@ -44,76 +111,264 @@ def normalize_path(path):
   return os.path.abspath(os.path.join(cwd, path))
 
 
-def wait_for_yes_no(text):
-  """Prompt user for Yes/No and return true if Yes/Y. Default to No."""
+def wait_for_yes_no(text, message=None):
+  """Prompt user for Yes/No and return true if Yes/Y. Default to No.
+
+  Args:
+    text (str): The prompt.
+    message (str): Instructions to print before the prompt. They are printed
+      under the same lock as the prompt, so they are not interleaved with the
+      prompts of other projects deployed concurrently.
+
+  Returns:
+    bool: Whether the user answered Yes.
+  """
   if FLAGS.dry_run:
     return True
 
-  while True:
-    # For compatibility with both Python 2 and 3.
-    if sys.version_info[0] < 3:
-      prompt = raw_input(text)
-    else:
-      prompt = input(text)
+  with _PROMPT_LOCK:
+    if message:
+      print(message)
+    while True:
+      # For compatibility with both Python 2 and 3.
+      if sys.version_info[0] < 3:
+        prompt = raw_input(text)
+      else:
+        prompt = input(text)
+
+      if not prompt or prompt[0] in 'nN':
+        # Default to No.
+        return False
+      if prompt[0] in 'yY':
+        return True
+      # Not Y or N, Keep trying.
 
-    if not prompt or prompt[0] in 'nN':
-      # Default to No.
-      return False
-    if prompt[0] in 'yY':
-      return True
-    # Not Y or N, Keep trying.
 
+def _get_cached_yaml(path, round_trip, digest):
+  """Gets a copy of the cached contents of a YAML file, if it is cached."""
+  with _yaml_cache_lock:
+    cached = _yaml_cache.get((os.path.abspath(path), round_trip))
+  if cached and cached[0] == digest:
+    return copy.deepcopy(cached[1])
+  return None
 
-def read_yaml_file(path):
+
+def _cache_yaml(path, round_trip, digest, contents):
+  """Caches a copy of the parsed contents of a YAML file."""
+  key = (os.path.abspath(path), round_trip)
+  entry = (digest, copy.deepcopy(contents))
+  with _yaml_cache_lock:
+    _yaml_cache[key] = entry
+
+
+def _parse_yaml(path, round_trip, data, digest):
+  """Parses the contents of a YAML file and caches a copy."""
+  yaml = ruamel.yaml.YAML(typ='rt' if round_trip else 'safe')
+  contents = yaml.load(data.decode('utf-8'))
+  _cache_yaml(path, round_trip, digest, contents)
+  return contents
+
+
+def read_yaml_file(path, round_trip=True):
   """Reads and parses a YAML file.
 
+  Parsed files are cached by content, so reading an unchanged file again only
+  costs a copy of its contents. Callers are free to modify the returned
+  contents.
+
   Args:
     path (string): The path to the YAML file.
+    round_trip (bool): Whether to keep comments and formatting so the contents
+      can be written back unchanged. Otherwise, the faster safe loader (backed
+      by libyaml if available) is used.
 
   Returns:
     A dict holding the parsed contents of the YAML file, or None if the file
     could not be read or parsed.
   """
+  with open(path, 'rb') as stream:
+    data = stream.read()
+  digest = hashlib.sha256(data).hexdigest()
+  contents = _get_cached_yaml(path, round_trip, digest)
+  if contents is None:
+    contents = _parse_yaml(path, round_trip, data, digest)
+  return contents
+
+
+def dump_yaml(contents):
+  """Serializes a dictionary the way write_yaml_file does.
+
+  Args:
+    contents (dict): The contents to serialize.
+
+  Returns:
+    string: The YAML text.
+  """
   yaml = ruamel.yaml.YAML()
-  with open(path, 'r') as stream:
-    return yaml.load(stream)
+  yaml.default_flow_style = False
+  yaml.Representer.ignore_aliases = lambda *args: True
+  stream = io.StringIO()
+  yaml.dump(contents, stream)
+  return stream.getvalue()
 
 
-def write_yaml_file(contents, path):
+def write_yaml_file(contents, path, atomic=False):
   """Saves a dictionary as a YAML file.
 
   Args:
     contents (dict): The contents to write to the YAML file.
     path (string): The path to the YAML file.
+    atomic (bool): Whether to write to a temporary file first and rename it
+      over the YAML file, so readers (or a crash) never see a partial file.
   """
-  yaml = ruamel.yaml.YAML()
-  yaml.default_flow_style = False
-  yaml.Representer.ignore_aliases = lambda *args: True
+  _write_yaml_text(dump_yaml(contents), path, atomic, contents)
+
+
+def write_yaml_text(text, path):
+  """Saves YAML text serialized by dump_yaml, e.g. in another process.
+
+  Args:
+    text (string): The YAML text to write.
+    path (string): The path to the YAML file.
+  """
+  _write_yaml_text(text, path, False, None)
 
+
+def _write_yaml_text(text, path, atomic, contents):
+  """Writes YAML text, caching contents (if given) for reading it back."""
   if FLAGS.dry_run:
     # If using dry_run mode, don't create the file, just print the contents.
     print('Contents of {}:'.format(path))
     print('===================================================================')
-    yaml.dump(contents, sys.stdout)
+    sys.stdout.write(text)
     print('===================================================================')
     return
-  with open(path, 'w') as outfile:
-    yaml.dump(contents, outfile)
+  data = text.encode('utf-8')
+  if atomic:
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp',
+        delete=False) as outfile:
+      outfile.write(data)
+    if os.path.exists(path):
+      shutil.copymode(path, outfile.name)
+    os.rename(outfile.name, path)
+  else:
+    with open(path, 'wb') as outfile:
+      outfile.write(data)
+  # Reading a config back, e.g. when it is both the input and output config,
+  # does not need to parse it again. Other files, e.g. temporary ones, are not
+  # worth caching.
+  if contents is None:
+    return
+  with _yaml_cache_lock:
+    was_read = (os.path.abspath(path), True) in _yaml_cache
+  if was_read:
+    _cache_yaml(path, True, hashlib.sha256(data).hexdigest(), contents)
+
+
+def _get_schema_cache_dir():
+  """Gets the schema cache directory, or None if it is not safe to use.
+
+  The directory is only readable and writable by the current user, so cached
+  schemas cannot be changed by others.
+  """
+  try:
+    if not os.path.isdir(_SCHEMA_CACHE_DIR):
+      os.makedirs(_SCHEMA_CACHE_DIR, mode=0o700)
+    stat = os.stat(_SCHEMA_CACHE_DIR)
+  except (IOError, OSError) as e:
+    logging.warning('Failed to create schema cache %s: %s', _SCHEMA_CACHE_DIR,
+                    e)
+    return None
+  if hasattr(os, 'getuid') and (stat.st_uid != os.getuid() or
+                                stat.st_mode & 0o077):
+    logging.warning('Not using schema cache %s, which is not private.',
+                    _SCHEMA_CACHE_DIR)
+    return None
+  return _SCHEMA_CACHE_DIR
+
+
+def _load_schema(path, content_hash):
+  """Loads a YAML schema, through the on-disk JSON cache if it has it.
+
+  Args:
+    path (string): The path to the YAML schema.
+    content_hash (string): The SHA-256 hex digest of the YAML schema.
+
+  Returns:
+    dict: The parsed schema.
+  """
+  cache_dir = _get_schema_cache_dir()
+  cache_path = cache_dir and os.path.join(cache_dir, content_hash + '.json')
+  if cache_path:
+    try:
+      with open(cache_path) as f:
+        return json.load(f)
+    except (IOError, OSError, ValueError):
+      pass
+
+  schema = json.loads(json.dumps(read_yaml_file(path)))
+  if not cache_path:
+    return schema
+  # Write the cache atomically, as other processes may be reading it.
+  try:
+    with tempfile.NamedTemporaryFile(
+        'w', dir=cache_dir, suffix='.tmp', delete=False) as f:
+      json.dump(schema, f)
+    os.replace(f.name, cache_path)
+  except (IOError, OSError) as e:
+    logging.warning('Failed to cache schema %s: %s', path, e)
+  return schema
+
+
+def get_schema_validator(path=_PROJECT_CONFIG_SCHEMA):
+  """Gets a validator for a YAML schema, loading it only if it changed.
+
+  Args:
+    path (string): The path to the YAML schema.
+
+  Returns:
+    jsonschema.IValidator: The validator of the schema.
+  """
+  with open(path, 'rb') as f:
+    content_hash = hashlib.sha256(f.read()).hexdigest()
+  key = (os.path.abspath(path), content_hash)
+  with _schema_validators_lock:
+    validator = _schema_validators.get(key)
+    if validator is None:
+      schema = _load_schema(path, content_hash)
+      cls = jsonschema.validators.validator_for(schema)
+      cls.check_schema(schema)
+      validator = _schema_validators[key] = cls(schema)
+    return validator
 
 
 def validate_config_yaml(config):
   """Validates a Project config YAML against the schema.
 
+  All errors are reported at once.
+
   Args:
     config (dict): The parsed contents of the project config YAML file.
 
   Raises:
     jsonschema.exceptions.ValidationError: if the YAML contents do not match the
-      schema.
+      schema. Its context holds every error found.
   """
-  schema = read_yaml_file(_PROJECT_CONFIG_SCHEMA)
-
-  jsonschema.validate(config, schema)
+  errors = sorted(
+      get_schema_validator().iter_errors(config),
+      key=lambda e: [str(p) for p in e.absolute_path])
+  if not errors:
+    return
+  if len(errors) == 1:
+    raise errors[0]
+  messages = [
+      '{}: {}'.format('/'.join(str(p) for p in e.absolute_path) or '<root>',
+                      e.message) for e in errors
+  ]
+  raise jsonschema.exceptions.ValidationError(
+      '{} errors:\n{}'.format(len(errors), '\n'.join(messages)),
+      context=errors)
 
 
 def run_deployment(deployment_template, deployment_name, project_id):
@@ -125,40 +380,245 @@ def run_deployment(deployment_template, deployment_name, project_id):
     deployment_name (string): The name for the deployment.
     project_id (string): The project under which to create the deployment.
   """
+  if FLAGS.render_deployments_locally:
+    _render_deployment(deployment_template, deployment_name, project_id)
+
   # Save the deployment manager template to a temporary file in the same
   # directory as the deployment manager templates.
   dm_template_file = tempfile.NamedTemporaryFile(suffix='.yaml')
   write_yaml_file(deployment_template, dm_template_file.name)
 
-  if deployment_exists(deployment_name, project_id):
-    gcloud_cmd = [
-        'deployment-manager',
-        'deployments',
-        'update',
-        deployment_name,
-        '--config',
-        dm_template_file.name,
-        '--delete-policy',
-        'ABANDON',
-    ]
+  gcloud_cmd = _get_deployment_command(deployment_name, project_id,
+                                       dm_template_file.name)
+  if gcloud_cmd is None:
+    return
+
+  # Create the deployment.
+  if FLAGS.async_deployments:
+    _run_async_deployment(gcloud_cmd, deployment_name, project_id)
   else:
-    gcloud_cmd = [
+    runner.run_gcloud_command(gcloud_cmd, project_id=project_id)
+
+  # Check deployment exists (and wasn't automcatically rolled back)
+  runner.run_gcloud_command(
+      ['deployment-manager', 'deployments', 'describe', deployment_name],
+      project_id=project_id)
+
+
+def _render_deployment(deployment_template, deployment_name, project_id):
+  """Expands a deployment's templates locally to check they are valid.
+
+  Raises:
+    dm_renderer.RenderError: if a template fails to load or expand.
+  """
+  expanded = dm_renderer.render(deployment_template, project_id,
+                                deployment_name)
+  logging.info('Deployment %s expands to %d resources.', deployment_name,
+               len(expanded['resources']))
+
+
+def _get_deployment_command(deployment_name, project_id, config_path):
+  """Gets the command to create or update (if it exists) a deployment.
+
+  With --diff_deployments, the update is previewed and the command commits the
+  preview.
+
+  Args:
+    deployment_name (string): The name of the deployment.
+    project_id (string): The project of the deployment.
+    config_path (string): Path of the deployment manager YAML config.
+
+  Returns:
+    List[string]: The gcloud command, or None if the deployment is unchanged.
+  """
+  if not deployment_exists(deployment_name, project_id):
+    return [
         'deployment-manager',
         'deployments',
         'create',
         deployment_name,
         '--config',
-        dm_template_file.name,
+        config_path,
         '--automatic-rollback-on-error',
     ]
+  update_cmd = [
+      'deployment-manager',
+      'deployments',
+      'update',
+      deployment_name,
+      '--delete-policy',
+      'ABANDON',
+  ]
+  config_args = ['--config', config_path]
+  if not FLAGS.diff_deployments:
+    return update_cmd + config_args
+
+  if _is_deployment_unchanged(deployment_name, project_id, config_path):
+    logging.info('Deployment %s is unchanged, skipping update.',
+                 deployment_name)
+    return None
+  runner.run_gcloud_command(
+      update_cmd + config_args + ['--preview'], project_id=project_id)
+  _log_previewed_changes(deployment_name, project_id)
+  # Updating without a config commits the preview.
+  return update_cmd
 
-  # Create the deployment.
-  runner.run_gcloud_command(gcloud_cmd, project_id=project_id)
 
-  # Check deployment exists (and wasn't automcatically rolled back)
-  runner.run_gcloud_command(
-      ['deployment-manager', 'deployments', 'describe', deployment_name],
-      project_id=project_id)
+def _is_deployment_unchanged(deployment_name, project_id, config_path):
+  """Checks whether a deployment's manifest matches a local config.
+
+  Args:
+    deployment_name (string): The name of the deployment.
+    project_id (string): The project of the deployment.
+    config_path (string): Path of the local deployment manager YAML config.
+
+  Returns:
+    bool: True if the deployed config and the contents of its imports are the
+      same as the local ones.
+  """
+  deployment = json.loads(
+      runner.run_gcloud_command([
+          'deployment-manager', 'deployments', 'describe', deployment_name,
+          '--format', 'json'
+      ],
+                                project_id=project_id))
+  manifest_url = deployment.get('deployment', deployment).get('manifest')
+  if not manifest_url:
+    return False
+  manifest = json.loads(
+      runner.run_gcloud_command([
+          'deployment-manager', 'manifests', 'describe',
+          manifest_url.split('/')[-1], '--deployment', deployment_name,
+          '--format', 'json'
+      ],
+                                project_id=project_id))
+
+  yaml = ruamel.yaml.YAML(typ='safe')
+  deployed_config = yaml.load(manifest.get('config', {}).get('content', ''))
+  with open(config_path) as f:
+    local_config = yaml.load(f) or {}
+  if deployed_config != local_config:
+    return False
+
+  local_imports = _get_deployment_imports(local_config,
+                                          os.path.dirname(config_path))
+  deployed_imports = {
+      imp['name']: imp['content'] for imp in manifest.get('imports', [])
+  }
+  return local_imports == deployed_imports
+
+
+def _get_deployment_imports(config, config_dir):
+  """Gets the files gcloud uploads with a deployment config.
+
+  As gcloud does, the schema next to each template is uploaded with it, and
+  the imports of schemas are followed relative to the schema's directory.
+
+  Args:
+    config (dict): The deployment manager YAML config.
+    config_dir (string): The directory the config's imports are relative to.
+
+  Returns:
+    Dict[string, string]: The contents of the uploaded files, by import name.
+  """
+  yaml = ruamel.yaml.YAML(typ='safe')
+
+  def resolve(imp, parent_dir):
+    return imp.get('name', imp['path']), os.path.join(parent_dir, imp['path'])
+
+  imports = {}
+  pending = [resolve(imp, config_dir) for imp in config.get('imports', [])]
+  while pending:
+    name, path = pending.pop(0)
+    if name in imports:
+      continue
+    with open(path) as f:
+      imports[name] = f.read()
+    if path.endswith(_TEMPLATE_EXTENSIONS):
+      if os.path.exists(path + '.schema'):
+        pending.append((name + '.schema', path + '.schema'))
+    elif path.endswith('.schema'):
+      schema = yaml.load(imports[name]) or {}
+      pending.extend(
+          resolve(imp, os.path.dirname(path))
+          for imp in schema.get('imports', []))
+  return imports
+
+
+def is_deployment_unchanged(deployment_template, deployment_name, project_id):
+  """Checks whether a deployment exists and matches a template.
+
+  Args:
+    deployment_template (dict): The dictionary representation of a deployment
+      manager YAML template.
+    deployment_name (string): The name of the deployment.
+    project_id (string): The project of the deployment.
+
+  Returns:
+    bool: True if the deployment exists, and its deployed config and the
+      contents of its imports are the same as the template's.
+  """
+  if not deployment_exists(deployment_name, project_id):
+    return False
+  with tempfile.NamedTemporaryFile(suffix='.yaml') as dm_template_file:
+    write_yaml_file(deployment_template, dm_template_file.name)
+    return _is_deployment_unchanged(deployment_name, project_id,
+                                    dm_template_file.name)
+
+
+def _log_previewed_changes(deployment_name, project_id):
+  """Logs the resource changes of a deployment's previewed update."""
+  resources = json.loads(
+      runner.run_gcloud_command([
+          'deployment-manager', 'resources', 'list', '--deployment',
+          deployment_name, '--format', 'json'
+      ],
+                                project_id=project_id))
+  changes = []
+  for resource in resources:
+    intent = resource.get('update', {}).get('intent', '')
+    if intent not in _UNCHANGED_RESOURCE_INTENTS:
+      changes.append('{} {} ({})'.format(intent, resource['name'],
+                                         resource.get('type', '')))
+  logging.info('Previewed update of deployment %s changes %d resources:\n%s',
+               deployment_name, len(changes), '\n'.join(changes))
+
+
+def _run_async_deployment(gcloud_cmd, deployment_name, project_id):
+  """Submits a deployment without waiting, then polls its operation.
+
+  Args:
+    gcloud_cmd (List[string]): The gcloud command creating or updating the
+      deployment.
+    deployment_name (string): The name of the deployment.
+    project_id (string): The project of the deployment.
+
+  Raises:
+    CalledProcessError: if the deployment failed.
+  """
+  operation_name = json.loads(
+      runner.run_gcloud_command(
+          gcloud_cmd + ['--async', '--format', 'json'],
+          project_id=project_id))['name']
+
+  delay = _DEPLOYMENT_INITIAL_POLL_SECS
+  while True:
+    operation = json.loads(
+        runner.run_gcloud_command([
+            'deployment-manager', 'operations', 'describe', operation_name,
+            '--format', 'json'
+        ],
+                                  project_id=project_id))
+    if operation.get('status') == 'DONE':
+      break
+    logging.info('Waiting %d seconds for deployment %s.', delay,
+                 deployment_name)
+    runner.run(time.sleep, delay)
+    delay = min(delay * 2, _DEPLOYMENT_MAX_POLL_SECS)
+
+  if operation.get('error'):
+    raise subprocess.CalledProcessError(
+        1, operation_name, output=json.dumps(operation['error']).encode())
 
 
 def deployment_exists(deployment_name, project_id):
@@ -291,6 +751,175 @@ def get_project_number(project_id):
       project_id=None).strip()
 
 
+def get_project_iam_policy(project_id):
+  """Returns the IAM policy of the given project as a dict."""
+  return json.loads(runner.run_gcloud_command(
+      ['projects', 'get-iam-policy', project_id, '--format', 'json'],
+      project_id=None))
+
+
+def _apply_iam_binding_changes(policy, add_bindings, remove_bindings):
+  """Applies binding changes to an IAM policy in place.
+
+  Args:
+    policy (dict): The IAM policy to change.
+    add_bindings (dict): Map of role to the members to add to the role.
+    remove_bindings (dict): Map of role to the members to remove from the role.
+
+  Returns:
+    bool: True if the policy was changed.
+  """
+  role_to_binding = {}
+  for binding in policy.setdefault('bindings', []):
+    role_to_binding[binding['role']] = binding
+
+  changed = False
+  for role, members in add_bindings.items():
+    binding = role_to_binding.get(role)
+    if binding is None:
+      binding = role_to_binding[role] = {'role': role, 'members': []}
+      policy['bindings'].append(binding)
+    for member in members:
+      if member not in binding['members']:
+        binding['members'].append(member)
+        changed = True
+
+  for role, members in remove_bindings.items():
+    binding = role_to_binding.get(role)
+    if binding is None:
+      continue
+    for member in members:
+      if member in binding['members']:
+        binding['members'].remove(member)
+        changed = True
+
+  policy['bindings'] = [b for b in policy['bindings'] if b['members']]
+  return changed
+
+
+def update_project_iam_bindings(project_id, add_bindings=None,
+                                remove_bindings=None):
+  """Adds and removes project IAM bindings with a single policy update.
+
+  The policy is read once, changed locally and written back guarded by its
+  etag. If the policy was concurrently modified, the whole read-modify-write is
+  retried with jittered backoff. Other errors are not retried.
+
+  Args:
+    project_id (string): The project to update the IAM policy of.
+    add_bindings (dict): Map of role to the members to add to the role.
+    remove_bindings (dict): Map of role to the members to remove from the role.
+
+  Returns:
+    bool: True if the policy needed to be updated.
+
+  Raises:
+    CalledProcessError: if the policy could not be updated.
+  """
+  add_bindings = add_bindings or {}
+  remove_bindings = remove_bindings or {}
+  for attempt in range(1, _IAM_POLICY_UPDATE_ATTEMPTS + 1):
+    policy = get_project_iam_policy(project_id)
+    if not _apply_iam_binding_changes(policy, add_bindings, remove_bindings):
+      logging.info('IAM policy of %s is already up to date.', project_id)
+      return False
+
+    policy_file = tempfile.NamedTemporaryFile(suffix='.json')
+    write_yaml_file(policy, policy_file.name)
+    try:
+      runner.run_gcloud_command(
+          ['projects', 'set-iam-policy', project_id, policy_file.name,
+           '--format', 'json'],
+          project_id=None)
+      return True
+    except subprocess.CalledProcessError as e:
+      if (retry_policy.classify_error(e) != retry_policy.CONFLICT_ERROR or
+          attempt == _IAM_POLICY_UPDATE_ATTEMPTS):
+        raise
+      delay = retry_policy.get_backoff_secs(attempt,
+                                            _IAM_POLICY_RETRY_INITIAL_SECS,
+                                            _IAM_POLICY_RETRY_MAX_SECS)
+      logging.warning(
+          'IAM policy of %s was concurrently modified (attempt %d/%d), '
+          'retrying in %.1f seconds.', project_id, attempt,
+          _IAM_POLICY_UPDATE_ATTEMPTS, delay)
+      instrumentation.record_retry('gcloud projects set-iam-policy')
+      runner.run(time.sleep, delay)
+
+
+def project_has_iam_bindings(project_id, bindings):
+  """Returns whether the project's IAM policy grants all the given bindings.
+
+  Args:
+    project_id (string): The project to check the IAM policy of.
+    bindings (dict): Map of role to the members expected to have the role.
+
+  Returns:
+    bool: True if every member has its roles in the project's IAM policy.
+  """
+  policy = get_project_iam_policy(project_id)
+  granted = {b['role']: set(b['members']) for b in policy.get('bindings', [])}
+  return all(
+      set(members).issubset(granted.get(role, ()))
+      for role, members in bindings.items())
+
+
+def wait_for_project_iam_bindings(project_id, bindings, max_wait_secs,
+                                  min_wait_secs=0, probe=None):
+  """Waits until the given bindings of the project's IAM policy are enforced.
+
+  A policy shows a change as soon as it is written, but the change can take a
+  while longer to be enforced. So the policy is first polled until it shows
+  the bindings. Then, if a probe of an operation needing the bindings is given,
+  it is polled until it succeeds; otherwise, the wait lasts at least
+  min_wait_secs. Polls use exponential backoff, and the whole wait lasts at
+  most max_wait_secs seconds.
+
+  Args:
+    project_id (string): The project to check the IAM policy of.
+    bindings (dict): Map of role to the members expected to have the role.
+    max_wait_secs (int): The maximum number of seconds to wait.
+    min_wait_secs (int): The minimum number of seconds to wait if no probe is
+      given.
+    probe (Callable): Returns whether an operation needing the bindings
+      succeeds.
+
+  Returns:
+    bool: True if the bindings became effective before the time ran out.
+  """
+  waited = 0
+  delay = _IAM_BINDINGS_INITIAL_POLL_SECS
+  visible = False
+  while True:
+    if not visible:
+      # Always read the latest policy rather than a cached one.
+      runner.invalidate_cache(project_id)
+      visible = project_has_iam_bindings(project_id, bindings)
+    if visible and (probe() if probe else waited >= min_wait_secs):
+      logging.info('IAM bindings of %s are effective after %d seconds.',
+                   project_id, waited)
+      return True
+    if waited >= max_wait_secs:
+      return False
+    if visible and not probe:
+      # Without a probe, the rest of the minimum wait is spent at once.
+      delay = min_wait_secs - waited
+    delay = min(delay, max_wait_secs - waited)
+    logging.info('Waiting %d seconds for IAM bindings of %s to propagate.',
+                 delay, project_id)
+    # Waited time is summed rather than measured, so dry runs terminate.
+    runner.run(time.sleep, delay)
+    waited += delay
+    delay = min(delay * 2, _IAM_BINDINGS_MAX_POLL_SECS)
+
+
+def get_enabled_services(project_id):
+  """Returns the set of names of the services enabled in the given project."""
+  output = runner.run_gcloud_command(
+      ['services', 'list', '--format', 'value(NAME)'], project_id=project_id)
+  return set(line.strip() for line in output.split('\n') if line.strip())
+
+
 def get_deployment_manager_service_account(project_id):
   """Returns the deployment manager service account for the given project."""
   return 'serviceAccount:{}@cloudservices.gserviceaccount.com'.format(
@@ -412,22 +1041,24 @@ def expand_imports(overall, overall_path):
   return all_files
 
 
-def load_config(overall_path):
+def load_config(overall_path, round_trip=True):
   """Reads and parses a YAML file.
 
   Args:
     overall_path (string): The path to the YAML file.
+    round_trip (bool): Whether to keep comments and formatting so the config
+      can be written back. Loading is much faster without.
 
   Returns:
     A dict holding the parsed contents of the YAML file, or None if the file
     could not be read or parsed.
   """
-  overall = read_yaml_file(overall_path)
+  overall = read_yaml_file(overall_path, round_trip)
   if not overall:
     return None
   import_files = get_import_files(overall, overall_path)
   for inc_file in import_files:
-    inc_contents = read_yaml_file(inc_file)
+    inc_contents = read_yaml_file(inc_file, round_trip)
     merge_dicts(overall, inc_contents)
 
   resolve_env_vars(overall)
@@ -439,7 +1070,9 @@ def call_go_binary(parameter_list):
   if FLAGS.dry_run:
     return
   if FLAGS.enable_new_style_resources:
-    subprocess.check_call(parameter_list)
+    runner.run_command(parameter_list)
+    # The binary may have modified resources read by cached gcloud queries.
+    runner.invalidate_cache()
 
 
 class InvalidConfigError(Exception):
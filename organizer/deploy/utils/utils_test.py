@@ -7,9 +7,17 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import json
+import os
+import subprocess
+import unittest.mock
+
 from absl import flags
 from absl.testing import absltest
 
+import jsonschema
+
+from deploy.utils import runner
 from deploy.utils import utils
 
 FLAGS = flags.FLAGS
@@ -35,6 +43,382 @@ class UtilsTest(absltest.TestCase):
     dict2 = utils.load_config(input_yaml_path)
     self.assertTrue(is_expand_config_equal(dict1, dict2))
 
+  def test_load_config_without_round_trip(self):
+    input_yaml_path = utils.normalize_path(
+        'deploy/samples/spanned_configs/root.yaml')
+    want = utils.load_config(input_yaml_path)
+    self.assertEqual(utils.load_config(input_yaml_path, round_trip=False), want)
+
+  def test_read_yaml_file_is_cached(self):
+    path = self.create_tempfile(content='a:\n  b: 1\n').full_path
+    contents = utils.read_yaml_file(path)
+    contents['a']['b'] = 2
+
+    with unittest.mock.patch.object(utils.ruamel.yaml, 'YAML') as mock_yaml:
+      # Unchanged files are not parsed again and copies are returned.
+      self.assertEqual(utils.read_yaml_file(path), {'a': {'b': 1}})
+      mock_yaml.assert_not_called()
+
+    with open(path, 'w') as f:
+      f.write('a:\n  b: 3\n')
+    self.assertEqual(utils.read_yaml_file(path), {'a': {'b': 3}})
+
+    FLAGS.dry_run = False
+    try:
+      utils.write_yaml_file({'a': {'b': 4}}, path)
+    finally:
+      FLAGS.dry_run = True
+    with unittest.mock.patch.object(utils.ruamel.yaml, 'YAML') as mock_yaml:
+      self.assertEqual(utils.read_yaml_file(path), {'a': {'b': 4}})
+      mock_yaml.assert_not_called()
+
+  @unittest.mock.patch.object(subprocess, 'check_output')
+  def test_run_deployment_async(self, mock_check_output):
+    FLAGS.dry_run = False
+    FLAGS.async_deployments = True
+    runner.reset_cache()
+    operation_status = ['RUNNING', 'DONE']
+    commands = []
+
+    def check_output(cmd, **kwargs):
+      del kwargs  # Unused.
+      commands.append(cmd[1:4])
+      if cmd[2:4] == ['deployments', 'list']:
+        return b'[]'
+      if '--async' in cmd:
+        return b'{"name": "op-a"}'
+      if cmd[2:4] == ['operations', 'describe']:
+        return json.dumps({'status': operation_status.pop(0)}).encode()
+      return b'{}'
+
+    mock_check_output.side_effect = check_output
+    try:
+      with unittest.mock.patch.object(utils.time, 'sleep') as mock_sleep:
+        utils.run_deployment({}, 'dep-a', 'my-project')
+    finally:
+      FLAGS.dry_run = True
+      FLAGS.async_deployments = False
+    self.assertEqual(commands, [
+        ['deployment-manager', 'deployments', 'list'],
+        ['deployment-manager', 'deployments', 'create'],
+        ['deployment-manager', 'operations', 'describe'],
+        ['deployment-manager', 'operations', 'describe'],
+        ['deployment-manager', 'deployments', 'describe'],
+    ])
+    mock_sleep.assert_called_once_with(utils._DEPLOYMENT_INITIAL_POLL_SECS)
+
+  @unittest.mock.patch.object(subprocess, 'check_output')
+  def test_run_deployment_async_failure(self, mock_check_output):
+    FLAGS.dry_run = False
+    FLAGS.async_deployments = True
+    runner.reset_cache()
+
+    def check_output(cmd, **kwargs):
+      del kwargs  # Unused.
+      if cmd[2:4] == ['deployments', 'list']:
+        return b'[]'
+      if '--async' in cmd:
+        return b'{"name": "op-a"}'
+      if cmd[2:4] == ['operations', 'describe']:
+        return b'{"status": "DONE", "error": {"errors": []}}'
+      raise AssertionError('unexpected command: {}'.format(cmd))
+
+    mock_check_output.side_effect = check_output
+    try:
+      with self.assertRaises(subprocess.CalledProcessError) as cm:
+        utils.run_deployment({}, 'dep-a', 'my-project')
+    finally:
+      FLAGS.dry_run = True
+      FLAGS.async_deployments = False
+    self.assertEqual(cm.exception.cmd, 'op-a')
+
+  @unittest.mock.patch.object(subprocess, 'check_output')
+  def test_run_deployment_diff(self, mock_check_output):
+    template_dir = self.create_tempdir()
+    template_path = template_dir.create_file(
+        'template.py', content='# template\n').full_path
+    schema = 'imports:\n- path: template.py\n- path: helper.py\n'
+    template_dir.create_file('template.py.schema', content=schema)
+    template_dir.create_file('helper.py', content='# helper\n')
+    deployment_template = {
+        'imports': [{'path': template_path}],
+        'resources': [{'name': 'dep', 'type': template_path}],
+    }
+    # gcloud uploads the schema of each template and the schema's imports.
+    manifest = {
+        'config': {'content': json.dumps(deployment_template)},
+        'imports': [
+            {'name': template_path, 'content': '# template\n'},
+            {'name': template_path + '.schema', 'content': schema},
+            {'name': 'template.py', 'content': '# template\n'},
+            {'name': 'template.py.schema', 'content': schema},
+            {'name': 'helper.py', 'content': '# helper\n'},
+        ],
+    }
+    commands = []
+
+    def check_output(cmd, **kwargs):
+      del kwargs  # Unused.
+      commands.append(cmd[1:4])
+      if cmd[2:4] == ['deployments', 'list']:
+        return b'[{"name": "dep"}]'
+      if cmd[2:4] == ['deployments', 'describe']:
+        return b'{"deployment": {"manifest": "projects/p/manifests/m-1"}}'
+      if cmd[2:4] == ['manifests', 'describe']:
+        return json.dumps(manifest).encode()
+      if cmd[2:4] == ['resources', 'list']:
+        return b'[{"name": "bucket", "update": {"intent": "UPDATE"}}]'
+      return b''
+
+    mock_check_output.side_effect = check_output
+    FLAGS.dry_run = False
+    FLAGS.diff_deployments = True
+    try:
+      runner.reset_cache()
+      utils.run_deployment(deployment_template, 'dep', 'my-project')
+      self.assertEqual(commands, [
+          ['deployment-manager', 'deployments', 'list'],
+          ['deployment-manager', 'deployments', 'describe'],
+          ['deployment-manager', 'manifests', 'describe'],
+      ])
+
+      # Changed deployments are previewed before being updated, including
+      # when only a file imported by a schema changed.
+      del commands[:]
+      mock_check_output.reset_mock()
+      runner.reset_cache()
+      manifest['imports'][-1]['content'] = '# old helper\n'
+      utils.run_deployment(deployment_template, 'dep', 'my-project')
+    finally:
+      FLAGS.dry_run = True
+      FLAGS.diff_deployments = False
+    self.assertEqual(commands[3:], [
+        ['deployment-manager', 'deployments', 'update'],
+        ['deployment-manager', 'resources', 'list'],
+        ['deployment-manager', 'deployments', 'update'],
+        ['deployment-manager', 'deployments', 'describe'],
+    ])
+    self.assertIn('--preview', mock_check_output.call_args_list[3][0][0])
+    self.assertNotIn('--config', mock_check_output.call_args_list[5][0][0])
+    self.assertIn('--delete-policy', mock_check_output.call_args_list[5][0][0])
+
+  def test_validate_config_yaml(self):
+    config = utils.load_config(
+        utils.normalize_path(
+            'deploy/samples/project_with_remote_audit_logs.yaml'))
+    utils.validate_config_yaml(config)
+
+    del config['overall']
+    config['projects'][0]['project_id'] = 'Invalid'
+    with self.assertRaises(jsonschema.exceptions.ValidationError) as cm:
+      utils.validate_config_yaml(config)
+    self.assertLen(cm.exception.context, 2)
+    self.assertIn('projects/0/project_id', str(cm.exception))
+
+  def test_get_schema_validator_is_cached(self):
+    cache_dir = os.path.join(self.create_tempdir().full_path, 'schemas')
+    with unittest.mock.patch.object(utils, '_SCHEMA_CACHE_DIR', cache_dir):
+      with unittest.mock.patch.object(utils, '_schema_validators', {}):
+        validator = utils.get_schema_validator()
+        self.assertIs(utils.get_schema_validator(), validator)
+      # The cache is private to the user.
+      self.assertEqual(os.stat(cache_dir).st_mode & 0o777, 0o700)
+
+      # A new process loads the schema from the on-disk cache.
+      with unittest.mock.patch.object(utils, '_schema_validators', {}):
+        with unittest.mock.patch.object(utils, 'read_yaml_file') as mock_read:
+          self.assertEqual(utils.get_schema_validator().schema,
+                           validator.schema)
+          mock_read.assert_not_called()
+
+  def test_schema_cache_is_keyed_by_content(self):
+    cache_dir = os.path.join(self.create_tempdir().full_path, 'schemas')
+    schema_file = self.create_tempfile(content='type: object\n')
+    with unittest.mock.patch.object(utils, '_SCHEMA_CACHE_DIR', cache_dir):
+      with unittest.mock.patch.object(utils, '_schema_validators', {}):
+        self.assertEqual(
+            utils.get_schema_validator(schema_file.full_path).schema,
+            {'type': 'object'})
+
+      # A changed schema is loaded again, even with the same modification time.
+      stat = os.stat(schema_file.full_path)
+      schema_file.write_text('type: array\n')
+      os.utime(schema_file.full_path, (stat.st_atime, stat.st_mtime))
+      with unittest.mock.patch.object(utils, '_schema_validators', {}):
+        self.assertEqual(
+            utils.get_schema_validator(schema_file.full_path).schema,
+            {'type': 'array'})
+
+      # Caches which others can write to are not used.
+      os.chmod(cache_dir, 0o777)
+      with unittest.mock.patch.object(utils, '_schema_validators', {}):
+        with unittest.mock.patch.object(
+            utils, 'read_yaml_file',
+            return_value={'type': 'string'}) as mock_read:
+          utils.get_schema_validator(schema_file.full_path)
+          mock_read.assert_called_once()
+
+  def test_apply_iam_binding_changes(self):
+    policy = {
+        'bindings': [
+            {'role': 'roles/owner', 'members': ['group:a@x.com', 'user:b@x.com']},
+            {'role': 'roles/viewer', 'members': ['user:b@x.com']},
+        ]
+    }
+    changed = utils._apply_iam_binding_changes(
+        policy,
+        add_bindings={
+            'roles/owner': ['group:a@x.com'],
+            'roles/editor': ['group:c@x.com'],
+        },
+        remove_bindings={'roles/viewer': ['user:b@x.com']})
+    self.assertTrue(changed)
+    self.assertEqual(policy, {
+        'bindings': [
+            {'role': 'roles/owner', 'members': ['group:a@x.com', 'user:b@x.com']},
+            {'role': 'roles/editor', 'members': ['group:c@x.com']},
+        ]
+    })
+    self.assertFalse(
+        utils._apply_iam_binding_changes(
+            policy, add_bindings={'roles/owner': ['user:b@x.com']},
+            remove_bindings={'roles/viewer': ['user:b@x.com']}))
+
+  @unittest.mock.patch.object(subprocess, 'check_output')
+  def test_update_project_iam_bindings_retries(self, mock_check_output):
+    FLAGS.dry_run = False
+    runner.reset_cache()
+    set_attempts = []
+
+    def check_output(cmd, **kwargs):
+      del kwargs  # Unused.
+      if cmd[1:3] == ['projects', 'get-iam-policy']:
+        return json.dumps({'etag': str(len(set_attempts))}).encode()
+      set_attempts.append(cmd)
+      if len(set_attempts) == 1:
+        raise subprocess.CalledProcessError(
+            1, cmd, stderr=b'ERROR: ABORTED: concurrent policy changes.')
+      return b''
+
+    mock_check_output.side_effect = check_output
+    try:
+      with unittest.mock.patch.object(utils.time, 'sleep') as mock_sleep:
+        self.assertTrue(
+            utils.update_project_iam_bindings(
+                'my-project', add_bindings={'roles/owner': ['group:a@x.com']}))
+    finally:
+      FLAGS.dry_run = True
+    self.assertLen(set_attempts, 2)
+    mock_sleep.assert_called_once()
+
+  @unittest.mock.patch.object(subprocess, 'check_output')
+  def test_update_project_iam_bindings_does_not_retry_other_errors(
+      self, mock_check_output):
+    FLAGS.dry_run = False
+    runner.reset_cache()
+    set_attempts = []
+
+    def check_output(cmd, **kwargs):
+      del kwargs  # Unused.
+      if cmd[1:3] == ['projects', 'get-iam-policy']:
+        return b'{"etag": "abc"}'
+      set_attempts.append(cmd)
+      raise subprocess.CalledProcessError(
+          1, cmd, stderr=b'ERROR: INVALID_ARGUMENT: Invalid member.')
+
+    mock_check_output.side_effect = check_output
+    try:
+      with self.assertRaises(subprocess.CalledProcessError):
+        utils.update_project_iam_bindings(
+            'my-project', add_bindings={'roles/owner': ['group:bad']})
+    finally:
+      FLAGS.dry_run = True
+    self.assertLen(set_attempts, 1)
+
+  @unittest.mock.patch.object(subprocess, 'check_output')
+  def test_wait_for_project_iam_bindings(self, mock_check_output):
+    FLAGS.dry_run = False
+    runner.reset_cache()
+    bindings = {'roles/owner': ['serviceAccount:sa@x.com']}
+    policies = [
+        {'bindings': []},
+        {'bindings': [{'role': 'roles/owner', 'members': ['group:a@x.com']}]},
+        {'bindings': [{
+            'role': 'roles/owner',
+            'members': ['group:a@x.com', 'serviceAccount:sa@x.com'],
+        }]},
+    ]
+    mock_check_output.side_effect = (
+        lambda cmd, **kwargs: json.dumps(policies.pop(0)).encode())
+    try:
+      with unittest.mock.patch.object(utils.time, 'sleep') as mock_sleep:
+        self.assertTrue(
+            utils.wait_for_project_iam_bindings('my-project', bindings, 60))
+    finally:
+      FLAGS.dry_run = True
+    self.assertEqual(mock_sleep.call_args_list,
+                     [unittest.mock.call(2), unittest.mock.call(4)])
+
+  @unittest.mock.patch.object(subprocess, 'check_output')
+  def test_wait_for_project_iam_bindings_visible_before_enforced(
+      self, mock_check_output):
+    FLAGS.dry_run = False
+    runner.reset_cache()
+    bindings = {'roles/owner': ['serviceAccount:sa@x.com']}
+    # The policy shows the bindings as soon as they are written.
+    mock_check_output.return_value = json.dumps({
+        'bindings': [{
+            'role': 'roles/owner',
+            'members': ['serviceAccount:sa@x.com'],
+        }]
+    }).encode()
+    enforced = [False, False, True]
+    try:
+      # Without a probe, the minimum wait still applies.
+      with unittest.mock.patch.object(utils.time, 'sleep') as mock_sleep:
+        self.assertTrue(
+            utils.wait_for_project_iam_bindings(
+                'my-project', bindings, 120, min_wait_secs=60))
+      self.assertEqual(mock_sleep.call_args_list, [unittest.mock.call(60)])
+
+      # With a probe, the wait lasts until the bindings are enforced.
+      with unittest.mock.patch.object(utils.time, 'sleep') as mock_sleep:
+        self.assertTrue(
+            utils.wait_for_project_iam_bindings(
+                'my-project', bindings, 120, min_wait_secs=60,
+                probe=lambda: enforced.pop(0)))
+      self.assertEqual(mock_sleep.call_args_list,
+                       [unittest.mock.call(2), unittest.mock.call(4)])
+    finally:
+      FLAGS.dry_run = True
+
+  def test_wait_for_project_iam_bindings_times_out(self):
+    bindings = {'roles/owner': ['serviceAccount:sa@x.com']}
+    # The dry run policy never has the bindings.
+    self.assertFalse(
+        utils.wait_for_project_iam_bindings('my-project', bindings, 60))
+
+  def test_wait_for_yes_no_prints_message_with_prompt(self):
+    FLAGS.dry_run = False
+    events = []
+
+    def fake_print(message):
+      events.append(('print', message, utils._PROMPT_LOCK.locked()))
+
+    def fake_input(text):
+      events.append(('input', text, utils._PROMPT_LOCK.locked()))
+      return 'y'
+
+    try:
+      with unittest.mock.patch('builtins.print', fake_print), \
+          unittest.mock.patch('builtins.input', fake_input):
+        self.assertTrue(
+            utils.wait_for_yes_no('my-project [y/N]?', message='Do this.'))
+    finally:
+      FLAGS.dry_run = True
+    self.assertEqual(events, [('print', 'Do this.', True),
+                              ('input', 'my-project [y/N]?', True)])
+
 
 def is_expand_config_equal(config_a, config_b):
 